@@ -0,0 +1,838 @@
+"""
+Almacenes en SQLite: identidades consultadas, caché negativa, ledger de
+cupo por token y cola de reintentos, más la caché compacta en memoria.
+"""
+
+import array
+import hashlib
+import itertools
+import json
+import mmap
+import random
+import threading
+import sys
+import time
+import os
+import numpy as np
+import re
+import shutil
+
+from metricas import METRICAS
+from normalizacion import palabras_normalizadas, prefijo_cedula, terminos_busqueda
+from persistencia import (
+    COLA_PATH,
+    HISTORIC_PATH,
+    LEDGER_PATH,
+    NEGATIVOS_PATH,
+    PENDIENTES_PATH,
+    STORE_PATH,
+    BaseSQLite,
+    escribir_atomico,
+    vaciar_escritores,
+)
+
+
+# --- COLA DE REINTENTOS ---
+# Lo que falló o quedó sin cupo espera en COLA_PATH. Tras el n-ésimo error se
+# reintenta en REINTENTO_BASE * 2^(n-1) segundos (tope REINTENTO_MAX), con
+# jitter para que no vuelva todo junto; tras REINTENTOS_MAX errores queda
+# retenida (sigue en la cola, pero no se reintenta sola). Las agotadas no
+# cuentan como error: vuelven apenas hay cupo.
+REINTENTO_BASE = 60
+REINTENTO_MAX = 6 * 3600
+REINTENTOS_MAX = 8
+DRENADO_INTERVALO = 30    # segundos entre rondas del drenado automático
+DRENADO_LOTE = 200        # cédulas por ronda como máximo
+
+
+# --- ALMACENES ---
+# CacheCompacta delante del almacén (CACHE_COMPACTA=1): foto en memoria o mmap
+CACHE_COMPACTA = os.environ.get("CACHE_COMPACTA", "0") == "1"
+
+# Tiempo que se recuerda que una cédula no existe antes de volver a consultarla
+TTL_NEGATIVO = 30 * 24 * 3600
+
+# Ventana en la que el proveedor reinicia el cupo de cada token
+VENTANA_CUOTA = "mensual"
+_FORMATOS_VENTANA = {"mensual": "%Y-%m", "diaria": "%Y-%m-%d"}
+
+
+# --- CUPO POR TOKEN ---
+
+class LedgerCuotas(BaseSQLite):
+    """
+    Registro durable del cupo gastado por cada token (app_id + token).
+    Vive en SQLite, así que todas las sesiones, hilos y procesos ven el mismo
+    consumo y un reinicio de Streamlit no lo pone en cero. El uso se cuenta por
+    ventana de reinicio ("mensual" o "diaria").
+    """
+    def __init__(self, ruta=LEDGER_PATH, ventana=VENTANA_CUOTA):
+        super().__init__(ruta)
+        self.ventana = ventana
+        self._conexion().execute("""
+            CREATE TABLE IF NOT EXISTS uso_tokens (
+                app_id TEXT NOT NULL,
+                token TEXT NOT NULL,
+                ventana TEXT NOT NULL,
+                usados INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (app_id, token, ventana)
+            )""")
+
+    def _clave(self, token):
+        # El token no se guarda en claro, solo su huella
+        huella = hashlib.sha256(str(token.token_id).encode("utf-8")).hexdigest()[:16]
+        return (str(token.app_id), huella, time.strftime(_FORMATOS_VENTANA[self.ventana]))
+
+    def usados(self, token):
+        fila = self._conexion().execute(
+            "SELECT usados FROM uso_tokens WHERE app_id=? AND token=? AND ventana=?",
+            self._clave(token)).fetchone()
+        return fila[0] if fila else 0
+
+    def reservar(self, token):
+        """Suma 1 al uso si queda cupo (atómico entre procesos). Retorna True si lo logró."""
+        conn = self._conexion()
+        clave = self._clave(token)
+        conn.execute("INSERT OR IGNORE INTO uso_tokens (app_id, token, ventana, usados) VALUES (?, ?, ?, 0)", clave)
+        cur = conn.execute(
+            "UPDATE uso_tokens SET usados = usados + 1 WHERE app_id=? AND token=? AND ventana=? AND usados < ?",
+            clave + (token.capacity,))
+        return cur.rowcount == 1
+
+    def liberar(self, token):
+        self._conexion().execute(
+            "UPDATE uso_tokens SET usados = MAX(usados - 1, 0) WHERE app_id=? AND token=? AND ventana=?",
+            self._clave(token))
+
+
+# --- LÓGICA DE BÚSQUEDA Y CACHÉ ---
+
+class AlmacenIdentidades(BaseSQLite):
+    """
+    Almacén local de identidades (cédula -> nombre) en SQLite con WAL.
+    Se consulta por cédula o por lotes sin cargar todo en memoria y admite
+    varios escritores a la vez (hilos, sesiones o procesos). Se comporta como
+    un dict (`in`, `[]`, `get`, `len`, `items`) para no cambiar a quien lo usa.
+    Junto a cada nombre guarda sus palabras normalizadas (`palabras`), que se
+    calculan al escribir y, para registros viejos, la primera vez que se piden.
+    Esas palabras alimentan además un índice invertido (`indice_nombres`) que
+    permite buscar por prefijo de palabra sin recorrer toda la tabla.
+    """
+    FIN_PREFIJO = "\uffff"  # cota superior para rangos "empieza por"
+    TOPE_SELECTIVIDAD = 5000
+
+    def __init__(self, ruta=STORE_PATH):
+        super().__init__(ruta)
+        conn = self._conexion()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS identidades (
+                cedula TEXT PRIMARY KEY,
+                nombre TEXT NOT NULL,
+                actualizado REAL NOT NULL,
+                palabras TEXT
+            )""")
+        columnas = {fila[1] for fila in conn.execute("PRAGMA table_info(identidades)")}
+        if "palabras" not in columnas:
+            conn.execute("ALTER TABLE identidades ADD COLUMN palabras TEXT")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT)")
+        # Índice invertido palabra -> cédula. La clave (palabra, cedula) deja
+        # las cédulas de cada palabra contiguas; el índice inverso sirve para
+        # borrar las palabras viejas de una cédula al actualizarla.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS indice_nombres (
+                palabra TEXT NOT NULL,
+                cedula TEXT NOT NULL,
+                PRIMARY KEY (palabra, cedula)
+            ) WITHOUT ROWID""")
+        conn.execute("CREATE INDEX IF NOT EXISTS indice_nombres_cedula ON indice_nombres (cedula, palabra)")
+        self.indexar_nombres()
+
+    # --- Interfaz tipo dict ---
+
+    def __contains__(self, cedula):
+        return self._conexion().execute(
+            "SELECT 1 FROM identidades WHERE cedula=?", (str(cedula),)).fetchone() is not None
+
+    def __getitem__(self, cedula):
+        nombre = self.get(cedula)
+        if nombre is None:
+            raise KeyError(cedula)
+        return nombre
+
+    def __setitem__(self, cedula, nombre):
+        self.guardar_lote([(cedula, nombre)])
+
+    def __len__(self):
+        return self._conexion().execute("SELECT COUNT(*) FROM identidades").fetchone()[0]
+
+    def __bool__(self):
+        return self._conexion().execute("SELECT 1 FROM identidades LIMIT 1").fetchone() is not None
+
+    def get(self, cedula, default=None):
+        fila = self._conexion().execute(
+            "SELECT nombre FROM identidades WHERE cedula=?", (str(cedula),)).fetchone()
+        return fila[0] if fila else default
+
+    def keys(self):
+        for cedula, _ in self.items():
+            yield cedula
+
+    def firma(self):
+        """[total, última escritura]: cambia si el almacén cambió."""
+        return list(self._conexion().execute("SELECT COUNT(*), MAX(actualizado) FROM identidades").fetchone())
+
+    def items(self, tamano_bloque=5000):
+        """Recorre el almacén por bloques ordenados por cédula (memoria constante)."""
+        ultima = ""
+        while True:
+            filas = self._conexion().execute(
+                "SELECT cedula, nombre FROM identidades WHERE cedula > ? ORDER BY cedula LIMIT ?",
+                (ultima, tamano_bloque)).fetchall()
+            if not filas:
+                return
+            yield from filas
+            ultima = filas[-1][0]
+
+    # --- Operaciones por lote ---
+
+    def obtener_lote(self, cedulas):
+        """Retorna {cedula: nombre} solo para las cédulas que existen."""
+        encontrados = {}
+        conn = self._conexion()
+        for bloque, marcas in self._bloques(cedulas):
+            encontrados.update(conn.execute(
+                f"SELECT cedula, nombre FROM identidades WHERE cedula IN ({marcas})", bloque).fetchall())
+        return encontrados
+
+    def contiene_lote(self, cedulas):
+        return set(self.obtener_lote(cedulas))
+
+    def palabras_lote(self, cedulas):
+        """
+        Retorna {cedula: (palabras normalizadas, ...)} de las cédulas que existen.
+        Los registros que aún no las tenían se normalizan aquí y se guardan.
+        """
+        resultado = {}
+        viejos = []
+        conn = self._conexion()
+        for bloque, marcas in self._bloques(cedulas):
+            for cedula, nombre, palabras in conn.execute(
+                    f"SELECT cedula, nombre, palabras FROM identidades WHERE cedula IN ({marcas})", bloque):
+                if palabras is None:
+                    palabras = " ".join(palabras_normalizadas(nombre))
+                    viejos.append((palabras, cedula))
+                resultado[cedula] = tuple(sys.intern(p) for p in palabras.split())
+        if viejos:
+            conn.executemany("UPDATE identidades SET palabras=? WHERE cedula=?", viejos)
+        return resultado
+
+    def guardar_lote(self, pares):
+        """Inserta o actualiza [(cedula, nombre), ...] en una sola transacción."""
+        ahora = time.time()
+        filas = [(str(c), n, ahora, " ".join(palabras_normalizadas(n))) for c, n in pares]
+        if not filas:
+            return
+        conn = self._conexion()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany("""
+                INSERT INTO identidades (cedula, nombre, actualizado, palabras) VALUES (?, ?, ?, ?)
+                ON CONFLICT(cedula) DO UPDATE SET
+                    nombre=excluded.nombre, actualizado=excluded.actualizado, palabras=excluded.palabras""",
+                filas)
+            self._indexar(conn, [(c, p) for c, _, _, p in filas], reemplazar=True)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    # --- Búsqueda ---
+
+    @staticmethod
+    def _indexar(conn, pares, reemplazar=False):
+        """Agrega al índice invertido [(cedula, "PALABRA PALABRA ..."), ...]."""
+        if reemplazar:
+            conn.executemany("DELETE FROM indice_nombres WHERE cedula=?", [(c,) for c, _ in pares])
+        conn.executemany("INSERT OR IGNORE INTO indice_nombres (palabra, cedula) VALUES (?, ?)",
+                         [(p, c) for c, palabras in pares for p in palabras.split()])
+
+    def indexar_nombres(self, tamano_bloque=10000):
+        """
+        Llena el índice invertido con los registros que existían antes de él
+        (una sola vez; después se mantiene solo en cada guardar_lote).
+        Las palabras se juntan en una tabla temporal y se cargan ordenadas de
+        una vez: insertarlas al azar en el índice es varias veces más lento.
+        """
+        conn = self._conexion()
+        if conn.execute("SELECT 1 FROM meta WHERE clave='indice_nombres'").fetchone():
+            return 0
+        total = 0
+        ultima = ""
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS indice_temporal (palabra TEXT, cedula TEXT)")
+        conn.execute("DELETE FROM temp.indice_temporal")
+        # 1. Palabras de cada registro (se calculan y guardan las que faltaban)
+        while True:
+            filas = conn.execute(
+                "SELECT cedula, nombre, palabras FROM identidades WHERE cedula > ? ORDER BY cedula LIMIT ?",
+                (ultima, tamano_bloque)).fetchall()
+            if not filas:
+                break
+            pares = [(c, p if p is not None else " ".join(palabras_normalizadas(n))) for c, n, p in filas]
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany("UPDATE identidades SET palabras=? WHERE cedula=? AND palabras IS NULL",
+                                 [(p, c) for (c, p), (_, _, viejo) in zip(pares, filas) if viejo is None])
+                conn.executemany("INSERT INTO temp.indice_temporal (palabra, cedula) VALUES (?, ?)",
+                                 [(p, c) for c, palabras in pares for p in palabras.split()])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            total += len(filas)
+            ultima = filas[-1][0]
+
+        # 2. Carga ordenada; el índice por cédula se arma al final, ya lleno
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DROP INDEX IF EXISTS indice_nombres_cedula")
+            conn.execute("""
+                INSERT OR IGNORE INTO indice_nombres (palabra, cedula)
+                SELECT palabra, cedula FROM temp.indice_temporal ORDER BY palabra, cedula""")
+            conn.execute("CREATE INDEX indice_nombres_cedula ON indice_nombres (cedula, palabra)")
+            conn.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('indice_nombres', ?)",
+                         (str(time.time()),))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.execute("DROP TABLE temp.indice_temporal")
+        return total
+
+    def buscar(self, texto, limite=100, desplazamiento=0):
+        """
+        Busca en el histórico y retorna solo la página pedida [(cedula, nombre), ...].
+        - Solo dígitos (admite "V-12.345" y "E-841"): cédulas que empiezan
+          por ellos; con E, solo las extranjeras.
+        - Texto: personas con alguna palabra que empiece por cada término
+          ("PER JOS" encuentra a "JOSE PEREZ"), usando el índice invertido.
+        - Vacío: todo el histórico ordenado por cédula.
+        """
+        conn = self._conexion()
+        texto = str(texto or "").strip()
+        terminos = terminos_busqueda(texto)
+        prefijo = prefijo_cedula(texto)
+
+        # 1. Por cédula (o sin filtro): rango sobre la clave primaria
+        if not terminos or prefijo is not None:
+            prefijo = prefijo or ""
+            return conn.execute(
+                "SELECT cedula, nombre FROM identidades WHERE cedula >= ? AND cedula < ? "
+                "ORDER BY cedula LIMIT ? OFFSET ?",
+                (prefijo, prefijo + self.FIN_PREFIJO, limite, desplazamiento)).fetchall()
+
+        # 2. Por nombre: se recorre el rango del término más selectivo (el de
+        # menos entradas, contando hasta un tope) y los demás se verifican por
+        # cédula en el índice inverso
+        if len(terminos) > 1:
+            terminos.sort(key=lambda t: conn.execute(
+                "SELECT COUNT(*) FROM (SELECT 1 FROM indice_nombres WHERE palabra >= ? AND palabra < ? LIMIT ?)",
+                (t, t + self.FIN_PREFIJO, self.TOPE_SELECTIVIDAD)).fetchone()[0])
+        guia, resto = terminos[0], terminos[1:]
+        condiciones = "".join(
+            " AND EXISTS (SELECT 1 FROM indice_nombres o WHERE o.cedula = g.cedula"
+            " AND o.palabra >= ? AND o.palabra < ?)" for _ in resto)
+        parametros = [guia, guia + self.FIN_PREFIJO]
+        for t in resto:
+            parametros += [t, t + self.FIN_PREFIJO]
+        cedulas = [c for (c,) in conn.execute(
+            "SELECT DISTINCT g.cedula FROM indice_nombres g WHERE g.palabra >= ? AND g.palabra < ?"
+            f"{condiciones} LIMIT ? OFFSET ?", parametros + [limite, desplazamiento])]
+
+        # 3. Solo se leen los nombres de la página
+        nombres = self.obtener_lote(cedulas)
+        return [(c, nombres[c]) for c in cedulas if c in nombres]
+
+    # --- Migración ---
+
+    def migrar_jsonl(self, historial_path=HISTORIC_PATH, tamano_bloque=10000):
+        """Importa una sola vez el historic.jsonl de versiones anteriores."""
+        conn = self._conexion()
+        if conn.execute("SELECT 1 FROM meta WHERE clave='migracion_jsonl'").fetchone():
+            return 0
+        total = 0
+        vaciar_escritores()
+        if os.path.exists(historial_path):
+            bloque = {}
+            with open(historial_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        item = json.loads(line)
+                        bloque[str(item["cedula"])] = item["nombre"]
+                    except: continue
+                    if len(bloque) >= tamano_bloque:
+                        self.guardar_lote(bloque.items())
+                        total += len(bloque)
+                        bloque = {}
+            self.guardar_lote(bloque.items())
+            total += len(bloque)
+        conn.execute("INSERT OR REPLACE INTO meta (clave, valor) VALUES ('migracion_jsonl', ?)", (str(time.time()),))
+        return total
+
+
+class CacheNegativa(BaseSQLite):
+    """
+    Recuerda las cédulas que la API reportó como inexistentes durante `ttl`
+    segundos, para no gastar cupo volviendo a preguntar por ellas.
+    Tiene su propio archivo SQLite, independiente del almacén de identidades.
+    """
+    def __init__(self, ruta=NEGATIVOS_PATH, ttl=TTL_NEGATIVO):
+        super().__init__(ruta)
+        self.ttl = ttl
+        conn = self._conexion()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS no_encontrados (
+                cedula TEXT PRIMARY KEY,
+                registrado REAL NOT NULL
+            )""")
+        self.purgar()
+
+    def _limite(self):
+        return time.time() - self.ttl
+
+    def __contains__(self, cedula):
+        return self._conexion().execute(
+            "SELECT 1 FROM no_encontrados WHERE cedula=? AND registrado > ?",
+            (str(cedula), self._limite())).fetchone() is not None
+
+    def contiene_lote(self, cedulas):
+        vigentes = set()
+        conn = self._conexion()
+        limite = self._limite()
+        for bloque, marcas in self._bloques(cedulas):
+            vigentes.update(c for (c,) in conn.execute(
+                f"SELECT cedula FROM no_encontrados WHERE cedula IN ({marcas}) AND registrado > ?",
+                bloque + [limite]))
+        return vigentes
+
+    def registrar(self, cedula):
+        self._conexion().execute(
+            "INSERT OR REPLACE INTO no_encontrados (cedula, registrado) VALUES (?, ?)",
+            (str(cedula), time.time()))
+
+    def purgar(self):
+        """Borra las entradas vencidas."""
+        self._conexion().execute("DELETE FROM no_encontrados WHERE registrado <= ?", (self._limite(),))
+
+
+class CacheCompacta():
+    """
+    Foto compacta y de solo lectura del almacén, para consultas por lote sin
+    ir a SQLite. Las cédulas se guardan como int64 en un arreglo ordenado
+    (búsqueda binaria vectorizada con numpy) y los nombres en un solo buffer
+    UTF-8, en el mismo orden, con un arreglo de posiciones: 16 bytes más el
+    nombre por registro, contra más de 150 de un dict de str. Guardada en
+    disco (`guardar`), se abre con mmap: arranca al instante y varios
+    procesos comparten las mismas páginas.
+
+    Se comporta como un dict, igual que AlmacenIdentidades. Las escrituras
+    van al `respaldo` (el almacén); lo que no está en la foto se busca ahí.
+    Un dict chico en memoria guarda lo que la foto no sabe guardar como
+    número (ceros a la izquierda, letras) y los cambios a cédulas que ya
+    están en la foto (que si no, seguiría dando el nombre viejo). Sin
+    respaldo, ese dict es el único lugar de las escrituras.
+    """
+    DIGITOS_MAX = 18   # cabe en int64
+
+    def __init__(self, claves, posiciones, nombres, extra=None, respaldo=None):
+        self._claves = claves
+        self._posiciones = posiciones   # nombre i = nombres[posiciones[i]:posiciones[i + 1]]
+        self._nombres = nombres
+        self._extra = dict(extra or {})
+        self.respaldo = respaldo
+
+    @classmethod
+    def desde_pares(cls, pares, respaldo=None):
+        """Construye la foto recorriendo (cedula, nombre) una sola vez."""
+        claves, posiciones = array.array("q"), array.array("q", [0])
+        nombres = bytearray()
+        extra = {}
+        for cedula, nombre in pares:
+            cedula = str(cedula)
+            if not cls._numerica(cedula):
+                extra[cedula] = nombre
+                continue
+            claves.append(int(cedula))
+            nombres += nombre.encode("utf-8")
+            posiciones.append(len(nombres))
+        claves = np.frombuffer(claves, dtype=np.int64)
+        posiciones = np.frombuffer(posiciones, dtype=np.int64)
+        # El almacén recorre por texto: solo hace falta reordenar si hay cédulas de distinto largo
+        if len(claves) > 1 and not (claves[1:] > claves[:-1]).all():
+            orden = np.argsort(claves, kind="stable")
+            inicio, fin = posiciones[:-1][orden].tolist(), posiciones[1:][orden].tolist()
+            nombres = b"".join(nombres[a:b] for a, b in zip(inicio, fin))
+            claves = claves[orden]
+            posiciones = np.concatenate(([0], np.cumsum(np.subtract(fin, inicio))))
+        return cls(claves, posiciones, bytes(nombres), extra, respaldo)
+
+    @classmethod
+    def desde_almacen(cls, store, directorio=None):
+        """
+        Foto de `store`. Con `directorio` se reutiliza la guardada ahí si
+        sigue al día (misma `firma` del almacén) y si no, se reconstruye y se
+        guarda.
+        """
+        firma = store.firma()
+        if directorio is not None:
+            actual = cls._version_actual(directorio)
+            if actual is not None and actual.get("firma") == firma:
+                try:
+                    return cls.cargar(os.path.join(directorio, actual["version"]), respaldo=store)
+                except (OSError, ValueError):
+                    pass
+        cache = cls.desde_pares(store.items(), respaldo=store)
+        if directorio is not None:
+            cache.guardar(directorio, firma)
+        return cache
+
+    @staticmethod
+    def _version_actual(directorio):
+        """{"version": carpeta, "firma": ...} de la foto vigente, o None."""
+        try:
+            with open(os.path.join(directorio, "actual.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def guardar(self, directorio, firma=None):
+        """
+        Escribe la foto (sin las escrituras posteriores) en una carpeta nueva
+        dentro de `directorio` y recién al final apunta `actual.json` a ella.
+        Nunca se reescribe un archivo que otro proceso pueda tener en mmap.
+        Retorna la ruta de la carpeta.
+        """
+        os.makedirs(directorio, exist_ok=True)
+        anterior = self._version_actual(directorio)
+        version = f"v{time.time_ns()}-{os.getpid()}"
+        carpeta = os.path.join(directorio, version)
+        os.makedirs(carpeta)
+        # 1. Los datos, en archivos nuevos
+        np.save(os.path.join(carpeta, "claves.npy"), np.ascontiguousarray(self._claves))
+        np.save(os.path.join(carpeta, "posiciones.npy"), np.ascontiguousarray(self._posiciones))
+        with open(os.path.join(carpeta, "nombres.bin"), "wb") as f:
+            f.write(self._nombres[:])
+        with open(os.path.join(carpeta, "extra.json"), "w", encoding="utf-8") as f:
+            json.dump(self._extra, f, ensure_ascii=False)
+        # 2. El puntero al final (rename atómico): hasta acá se sigue leyendo la anterior
+        escribir_atomico(os.path.join(directorio, "actual.json"), [json.dumps({"version": version, "firma": firma})])
+
+        # 3. Borrar la versión reemplazada y las más viejas. Quien la tenga en
+        # mmap la sigue leyendo entera (en Windows no se deja borrar: queda).
+        # Las que no llegaron a ser vigentes pueden estar escribiéndose en otro proceso.
+        if anterior is not None:
+            tope = self._orden_version(anterior["version"])
+            for nombre in os.listdir(directorio):
+                orden = self._orden_version(nombre)
+                if nombre != version and orden is not None and orden <= tope:
+                    shutil.rmtree(os.path.join(directorio, nombre), ignore_errors=True)
+        return carpeta
+
+    @staticmethod
+    def _orden_version(nombre):
+        partes = re.match(r"^v(\d+)-\d+$", nombre)
+        return int(partes.group(1)) if partes else None
+
+    @classmethod
+    def cargar(cls, directorio, respaldo=None, usar_mmap=True):
+        modo = "r" if usar_mmap else None
+        claves = np.load(os.path.join(directorio, "claves.npy"), mmap_mode=modo)
+        posiciones = np.load(os.path.join(directorio, "posiciones.npy"), mmap_mode=modo)
+        with open(os.path.join(directorio, "nombres.bin"), "rb") as f:
+            if usar_mmap and os.fstat(f.fileno()).st_size:
+                nombres = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                nombres = f.read()
+        with open(os.path.join(directorio, "extra.json"), "r", encoding="utf-8") as f:
+            extra = json.load(f)
+        return cls(claves, posiciones, nombres, extra, respaldo)
+
+    @classmethod
+    def _numerica(cls, cedula):
+        return cedula.isdigit() and cedula.isascii() and len(cedula) <= cls.DIGITOS_MAX and (
+            cedula[0] != "0" or cedula == "0")
+
+    def _buscar(self, cedulas):
+        """Índice de cada cédula en la foto (-1 si no está)."""
+        if not cedulas or not len(self._claves):
+            return np.full(len(cedulas), -1, dtype=np.int64)
+        texto = np.array(cedulas, dtype=str)
+        try:
+            numeros = texto.astype(np.int64)
+            # Solo cuentan las que escritas como número dan el mismo texto ("0123", "+1" no)
+            numeros[numeros.astype(str) != texto] = -1
+        except (ValueError, OverflowError):
+            numeros = np.fromiter((int(c) if self._numerica(c) else -1 for c in cedulas),
+                                  dtype=np.int64, count=len(cedulas))
+        pos = np.searchsorted(self._claves, numeros)
+        pos[pos >= len(self._claves)] = 0
+        return np.where((numeros >= 0) & (self._claves[pos] == numeros), pos, -1)
+
+    def _nombres_en(self, indices):
+        inicio = self._posiciones[indices].tolist()
+        fin = self._posiciones[indices + 1].tolist()
+        nombres = self._nombres
+        return [nombres[a:b].decode("utf-8") for a, b in zip(inicio, fin)]
+
+    # --- Interfaz tipo dict ---
+
+    def __contains__(self, cedula):
+        return self.get(cedula) is not None
+
+    def __getitem__(self, cedula):
+        nombre = self.get(cedula)
+        if nombre is None:
+            raise KeyError(cedula)
+        return nombre
+
+    def __setitem__(self, cedula, nombre):
+        self.guardar_lote([(cedula, nombre)])
+
+    def __len__(self):
+        if self.respaldo is not None:
+            return len(self.respaldo)
+        nuevas = [c for c in self._extra if self._buscar([c])[0] < 0]
+        return len(self._claves) + len(nuevas)
+
+    def __bool__(self):
+        return bool(len(self._claves) or self._extra or (self.respaldo is not None and self.respaldo))
+
+    def get(self, cedula, default=None):
+        return self.obtener_lote([cedula]).get(str(cedula), default)
+
+    def keys(self):
+        for cedula, _ in self.items():
+            yield cedula
+
+    def items(self, tamano_bloque=5000):
+        if self.respaldo is not None:
+            yield from self.respaldo.items(tamano_bloque)
+            return
+        for inicio in range(0, len(self._claves), tamano_bloque):
+            indices = np.arange(inicio, min(inicio + tamano_bloque, len(self._claves)))
+            for cedula, nombre in zip(self._claves[indices].tolist(), self._nombres_en(indices)):
+                if str(cedula) not in self._extra:
+                    yield str(cedula), nombre
+        yield from self._extra.items()
+
+    # --- Operaciones por lote ---
+
+    def obtener_lote(self, cedulas):
+        """Retorna {cedula: nombre} solo para las cédulas que existen."""
+        cedulas = [str(c) for c in cedulas]
+        indices = self._buscar(cedulas)
+        esta = indices >= 0
+        encontrados = dict(zip(itertools.compress(cedulas, esta.tolist()), self._nombres_en(indices[esta])))
+        # 1. Lo escrito después de la foto manda
+        if self._extra:
+            encontrados.update((c, self._extra[c]) for c in cedulas if c in self._extra)
+        # 2. Lo que la foto no tiene puede haber llegado al almacén (otra sesión o proceso)
+        if self.respaldo is not None and len(encontrados) < len(cedulas):
+            faltan = [c for c in cedulas if c not in encontrados]
+            if faltan:
+                encontrados.update(self.respaldo.obtener_lote(faltan))
+        return encontrados
+
+    def contiene_lote(self, cedulas):
+        return set(self.obtener_lote(cedulas))
+
+    def guardar_lote(self, pares):
+        pares = [(str(c), n) for c, n in pares]
+        if self.respaldo is None:
+            self._extra.update(pares)
+            return
+        self.respaldo.guardar_lote(pares)
+        # Lo nuevo ya lo encuentra el respaldo; en memoria solo lo que la foto taparía
+        en_foto = self._buscar([c for c, _ in pares]) >= 0
+        self._extra.update(par for par, esta in zip(pares, en_foto.tolist()) if esta or par[0] in self._extra)
+
+    def __getattr__(self, nombre):
+        # buscar, palabras_lote, ruta...: los resuelve el almacén
+        respaldo = self.__dict__.get("respaldo")
+        if respaldo is None:
+            raise AttributeError(nombre)
+        return getattr(respaldo, nombre)
+
+
+def inicializar_sistema(historial_path=HISTORIC_PATH, ruta_store=STORE_PATH, compacta=CACHE_COMPACTA):
+    """
+    Abre el almacén de identidades (migrando el JSONL la primera vez). Con
+    compacta=True retorna una CacheCompacta encima del almacén, guardada junto
+    a él en `<ruta_store>.compacta/`.
+    """
+    store = AlmacenIdentidades(ruta_store)
+    store.migrar_jsonl(historial_path)
+    if compacta:
+        return CacheCompacta.desde_almacen(store, f"{ruta_store}.compacta")
+    return store
+
+
+def buscar_en_cache(cache, id_list):
+    """Retorna {cedula: nombre} de las cédulas que ya están en caché (en lote si se puede)."""
+    if hasattr(cache, "obtener_lote"):
+        return cache.obtener_lote(id_list)
+    return {_id: cache[_id] for _id in id_list if _id in cache}
+
+
+def is_id_in_cache(id_list, cache: dict):
+    ids_set = set(id_list)
+    if hasattr(cache, "contiene_lote"):
+        cached = cache.contiene_lote(ids_set)
+    else:
+        cached = ids_set.intersection(cache.keys())
+    non_cached = ids_set.difference(cached)
+    return list(cached), list(non_cached)
+
+
+# --- COLA DE REINTENTOS ---
+
+def guardar_pendientes(lista_pendientes, error="Agotado"):
+    """Encola las cédulas que no se pudieron procesar por falta de tokens o error."""
+    obtener_cola().encolar((_id, error) for _id in lista_pendientes)
+
+
+def cargar_pendientes():
+    """Cédulas que siguen en la cola de reintentos (de esta sesión o de anteriores)."""
+    return obtener_cola().cedulas()
+
+
+class ColaReintentos(BaseSQLite):
+    """
+    Cola durable (SQLite) de consultas que fallaron o quedaron sin cupo.
+    Por cédula guarda intentos, clase del último error y desde cuándo se
+    puede reintentar. Nada sale de la cola hasta que se resuelve (la API
+    contestó o ya está en el caché), así que ninguna consulta se pierde.
+    Reemplaza a pendientes.jsonl, que se migra la primera vez.
+    """
+    def __init__(self, ruta=COLA_PATH, pendientes_path=PENDIENTES_PATH):
+        super().__init__(ruta)
+        self._azar = random.Random()
+        self._conexion().execute("""
+            CREATE TABLE IF NOT EXISTS reintentos (
+                cedula TEXT PRIMARY KEY,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                proximo REAL,
+                creado REAL NOT NULL,
+                actualizado REAL NOT NULL
+            )""")
+        self._conexion().execute("CREATE INDEX IF NOT EXISTS reintentos_proximo ON reintentos (proximo)")
+        self.migrar_jsonl(pendientes_path)
+
+    def __len__(self):
+        return self._conexion().execute("SELECT COUNT(*) FROM reintentos").fetchone()[0]
+
+    def espera(self, intentos):
+        """Backoff exponencial con jitter (entre la mitad y el total del paso)."""
+        paso = min(REINTENTO_MAX, REINTENTO_BASE * 2 ** max(intentos - 1, 0))
+        return paso * self._azar.uniform(0.5, 1.0)
+
+    def encolar(self, fallos):
+        """
+        Agrega o actualiza [(cedula, clase_error), ...]. "Agotado" no suma
+        intento y queda lista enseguida (el drenado espera a que haya cupo);
+        un error suma un intento y espera su backoff.
+        """
+        ahora = time.time()
+        fallos = list(fallos)
+        if not fallos:
+            return
+        conn = self._conexion()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for cedula, error in fallos:
+                fila = conn.execute("SELECT intentos FROM reintentos WHERE cedula=?", (str(cedula),)).fetchone()
+                intentos = fila[0] if fila else 0
+                if error == "Agotado":
+                    # Repartidas en una ronda de drenado: no vuelven todas a la vez
+                    proximo = ahora + self._azar.uniform(0, DRENADO_INTERVALO)
+                else:
+                    intentos += 1
+                    proximo = ahora + self.espera(intentos) if intentos < REINTENTOS_MAX else None
+                conn.execute("""
+                    INSERT INTO reintentos (cedula, intentos, ultimo_error, proximo, creado, actualizado)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(cedula) DO UPDATE SET intentos=excluded.intentos,
+                        ultimo_error=excluded.ultimo_error, proximo=excluded.proximo,
+                        actualizado=excluded.actualizado""",
+                    (str(cedula), intentos, str(error), proximo, ahora, ahora))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        METRICAS.contar("cola_reintentos_encoladas_total", len(fallos))
+
+    def quitar(self, cedulas):
+        """Saca de la cola las cédulas ya resueltas."""
+        conn = self._conexion()
+        for bloque, marcas in self._bloques(cedulas):
+            conn.execute(f"DELETE FROM reintentos WHERE cedula IN ({marcas})", bloque)
+
+    def listas(self, limite=DRENADO_LOTE, ahora=None):
+        """Cédulas que ya se pueden reintentar, las que más esperaron primero."""
+        ahora = time.time() if ahora is None else ahora
+        return [c for (c,) in self._conexion().execute(
+            "SELECT cedula FROM reintentos WHERE proximo <= ? ORDER BY proximo LIMIT ?", (ahora, limite))]
+
+    def cedulas(self):
+        return [c for (c,) in self._conexion().execute("SELECT cedula FROM reintentos ORDER BY creado")]
+
+    def depurar(self, cedulas, cache_dict, cache_negativa=None):
+        """
+        Quita las que otra sesión ya resolvió (están en el caché positivo o
+        negativo) y retorna las que siguen pendientes.
+        """
+        resueltas = set(buscar_en_cache(cache_dict, cedulas))
+        if cache_negativa is not None:
+            resueltas |= cache_negativa.contiene_lote([c for c in cedulas if c not in resueltas])
+        if resueltas:
+            self.quitar(resueltas)
+        return [c for c in cedulas if c not in resueltas]
+
+    def resumen(self):
+        """Conteo por clase de error, retenidas y próximo reintento (para la interfaz)."""
+        conn = self._conexion()
+        por_error = dict(conn.execute("SELECT ultimo_error, COUNT(*) FROM reintentos GROUP BY ultimo_error"))
+        retenidas, proximo = conn.execute(
+            "SELECT SUM(proximo IS NULL), MIN(proximo) FROM reintentos").fetchone()
+        return {"total": sum(por_error.values()), "por_error": por_error,
+                "retenidas": retenidas or 0, "proximo": proximo}
+
+    def liberar_retenidas(self):
+        """Vuelve a poner en cola (ya) las que superaron REINTENTOS_MAX."""
+        self._conexion().execute(
+            "UPDATE reintentos SET intentos=0, proximo=? WHERE proximo IS NULL", (time.time(),))
+
+    def migrar_jsonl(self, pendientes_path=PENDIENTES_PATH):
+        """Importa el pendientes.jsonl de versiones anteriores (una sola vez)."""
+        if not pendientes_path or not os.path.exists(pendientes_path):
+            return 0
+        with open(pendientes_path, "r", encoding="utf-8") as file:
+            cedulas = [json.loads(line)["cedula"] for line in file if line.strip()]
+        self.encolar((c, "Agotado") for c in cedulas)
+        os.replace(pendientes_path, f"{pendientes_path}.migrado")
+        return len(cedulas)
+
+
+_colas = {}
+_colas_lock = threading.Lock()
+
+
+def obtener_cola(ruta=None):
+    """Una ColaReintentos por archivo y por proceso (COLA_PATH por defecto)."""
+    ruta = os.path.abspath(ruta or COLA_PATH)
+    with _colas_lock:
+        cola = _colas.get(ruta)
+        if cola is None:
+            cola = _colas[ruta] = ColaReintentos(ruta, os.path.join(os.path.dirname(ruta), PENDIENTES_PATH))
+        return cola
@@ -1,37 +1,111 @@
+import functools
+import itertools
+import os
+import tempfile
 import streamlit as st
 import pandas as pd
 from utils import (
-    normalizar_cedula, 
+    validar_cedulas_lote,
+    detectar_formato_csv,
+    leer_columnas_csv,
+    contar_filas_csv,
+    leer_csv_por_bloques,
     inicializar_sistema, 
     cargar_configuracion,
-    procesar_cedula_individual
+    CacheNegativa,
+    DrenadorCola,
+    obtener_cola,
+    TrabajoLote,
+    crear_trabajo,
+    obtener_trabajo,
+    descartar_trabajo,
+    exportar_historico,
+    exportar_resultados,
+    formatos_disponibles,
+    CODIFICACIONES_EXPORTACION,
+    METRICAS
 )
 
 # --- CONFIGURACIÓN DE PÁGINA ---
 st.set_page_config(page_title="Validador de Cédulas VZLA", page_icon="💎", layout="wide")
+FILAS_POR_PAGINA = 50
+INTERVALO_SONDEO = 1.0   # segundos entre actualizaciones del progreso
+MIME_EXPORTACION = {"csv": "text/csv", "csv.gz": "application/gzip", "parquet": "application/vnd.apache.parquet"}
 
 
 # --- INICIALIZACIÓN DE ESTADO ---
-if 'tokens' not in st.session_state:
+# Los mismos objetos Token para todas las sesiones: ritmo, salud y circuito
+# de cada token son del proceso, no de cada pestaña abierta
+@st.cache_resource
+def tokens_compartidos():
     # Intentamos cargar desde secrets (Cloud) o localmente
-    tokens = cargar_configuracion()
+    return cargar_configuracion()
+
+if 'tokens' not in st.session_state:
+    tokens = tokens_compartidos()
     if not tokens:
+        tokens_compartidos.clear()   # que se reintente al corregir secrets.toml
         st.error("⚠️ No se encontraron los Tokens. Revisa tu archivo secrets.toml.")
         st.stop()
     st.session_state.tokens = tokens
 
 if 'resultados' not in st.session_state:
     st.session_state.resultados = []
-if 'ejecutando' not in st.session_state:
-    st.session_state.ejecutando = False
-if 'cache' not in st.session_state:
-    st.session_state.cache = inicializar_sistema()
+if 'df_resultados' not in st.session_state:
+    st.session_state.df_resultados = pd.DataFrame()
+if 'trabajo_id' not in st.session_state:
+    st.session_state.trabajo_id = None
+# Un solo caché por proceso del servidor, compartido por todas las sesiones:
+# lo que consulta una sesión lo ve el resto al instante (ver COALESCEDOR en utils)
+@st.cache_resource
+def recursos_compartidos():
+    return inicializar_sistema(), CacheNegativa()
+
+st.session_state.cache, st.session_state.cache_negativa = recursos_compartidos()
+
+# Lo que quedó sin cupo o falló se reintenta solo en segundo plano (una vez por proceso)
+@st.cache_resource
+def drenado_cola(_tokens):
+    return DrenadorCola(_tokens, *recursos_compartidos()).iniciar()
+
+drenado_cola(st.session_state.tokens)
+
+# Con METRICAS_PUERTO definido se exponen /metrics y /metrics.json (una vez por proceso)
+@st.cache_resource
+def servidor_metricas(puerto):
+    return METRICAS.servir(puerto)
+
+if os.environ.get("METRICAS_PUERTO") and METRICAS.habilitadas:
+    servidor_metricas(int(os.environ["METRICAS_PUERTO"]))
+
+# Las exportaciones se generan recién al hacer clic (en cada clic), por
+# bloques y en un archivo temporal: nunca se arma el texto entero ni un
+# DataFrame. `fuente` es una función que retorna las filas en ese momento.
+# Streamlit sirve la descarga desde memoria, así que el archivo final
+# (comprimido con csv.gz o parquet) sí se lee entero como bytes.
+def descarga(exportar, fuente, formato, encoding):
+    def generar():
+        with tempfile.TemporaryFile() as archivo:
+            exportar(fuente(), archivo, formato, encoding)
+            archivo.seek(0)
+            return archivo.read()
+    return generar
+
+
+def opciones_exportacion(clave):
+    e1, e2 = st.columns(2)
+    with e1:
+        formato = st.selectbox("Formato", formatos_disponibles(), key=f"formato_{clave}")
+    with e2:
+        encoding = st.selectbox("Codificación", CODIFICACIONES_EXPORTACION, key=f"encoding_{clave}",
+                                disabled=formato == "parquet")
+    return formato, encoding
 
 # --- INTERFAZ STREAMLIT ---
 st.title("💎 Validador de Identidad API")
 st.markdown("Consulta masiva optimizada con gestión de tokens y caché local.")
 
-tab1, tab2 = st.tabs(["🚀 Procesar Lista", "📁 Histórico"])
+tab1, tab2, tab3 = st.tabs(["🚀 Procesar Lista", "📁 Histórico", "📊 Métricas"])
 
 with tab1:
     col1, col2 = st.columns([1, 2])
@@ -52,32 +126,49 @@ with tab1:
                     "nombre_lista": ["PEDRO PEREZ", "MARIA GOMEZ"]
                 }))
         
+        estrategia = "exacta"
+        if modo == "Comparar con mi lista":
+            comparacion = st.radio("Comparación de nombres:", ["Exacta", "Difusa (tolera errores de tipeo)"], horizontal=True)
+            estrategia = "difusa" if comparacion.startswith("Difusa") else "exacta"
+
         metodo_entrada = st.radio("Método de entrada:", ["Sube un CSV", "Pega las Cédulas"], horizontal=True)
         
-        raw_ids = []
-        nombres_ref = {}
+        # Fuente de cédulas: un generador de bloques (ids, nombres_ref) que se
+        # consume recién al iniciar, para no cargar archivos enormes de una vez
+        fuente_bloques = None
+        total_estimado = 0
 
         if metodo_entrada == "Sube un CSV":
             uploaded_file = st.file_uploader("Sube tu archivo", type=["csv"])
             if uploaded_file:
-                try:
-                    df = pd.read_csv(uploaded_file, sep=None, engine='python')
-                except:
-                    uploaded_file.seek(0)
-                    df = pd.read_csv(uploaded_file, sep=None, engine='python', encoding="latin-1")
+                formato = detectar_formato_csv(uploaded_file)
+                columnas = leer_columnas_csv(uploaded_file, formato)
+                total_estimado = contar_filas_csv(uploaded_file)
                 
-                st.success(f"✅ {len(df)} filas cargadas.")
-                col_id = st.selectbox("Selecciona columna de Cédula", df.columns)
-                raw_ids = df[col_id].dropna().astype(str).tolist()
+                st.success(f"✅ {total_estimado} filas detectadas (separador '{formato[0]}', {formato[1]}).")
+                col_id = st.selectbox("Selecciona columna de Cédula", columnas)
+                col_nom = None
                 
                 if modo == "Comparar con mi lista":
-                    col_nom = st.selectbox("Selecciona columna de Nombre (Tu Lista)", df.columns)
-                    nombres_ref = dict(zip([normalizar_cedula(c) for c in raw_ids], df[col_nom].astype(str)))
+                    col_nom = st.selectbox("Selecciona columna de Nombre (Tu Lista)", columnas)
+
+                def fuente_bloques():
+                    return leer_csv_por_bloques(uploaded_file, col_id, col_nom, formato=formato)
         
         else:
             txt_input = st.text_area("Pega las cédulas (una por línea):", height=150, placeholder="12345678\n87654321")
             if txt_input:
-                raw_ids = txt_input.split('\n')
+                ids_pegados, rechazos = validar_cedulas_lote(txt_input.split('\n'))
+                ids_pegados = [i for i in ids_pegados if i]
+                total_estimado = len(ids_pegados)
+                if rechazos:
+                    st.warning(f"⚠️ {len(rechazos)} valores no son cédulas válidas: saldrán como rechazados, sin consultarlos.")
+                repetidas = total_estimado - len(set(ids_pegados))
+                if repetidas:
+                    st.warning(f"⚠️ {repetidas} cédulas están repetidas: saldrán como \"Repetida\", sin consultarlas de nuevo.")
+
+                def fuente_bloques():
+                    yield ids_pegados, {}
                 if modo == "Comparar con mi lista":
                     st.warning("⚠️ El modo manual no soporta comparación. Usa un CSV para comparar nombres.")
 
@@ -89,102 +180,188 @@ with tab1:
 
     with col2:
         st.subheader("Resultados")
+        # El procesamiento corre en un hilo (TrabajoLote); la página solo lo consulta
+        trabajo = obtener_trabajo(st.session_state.trabajo_id)
         
         # Botones de control
         c1, c2, c3 = st.columns(3)
         with c1:
-            # Iniciamos el proceso
-            btn_iniciar = st.button("🚀 Iniciar", use_container_width=True)
+            btn_iniciar = st.button("🚀 Iniciar", use_container_width=True,
+                                    disabled=trabajo is not None and trabajo.activo)
         with c2:
-            # Botón para detener (usa st.stop() para romper la ejecución de Streamlit)
-            if st.button("🛑 Detener", use_container_width=True):
-                st.session_state.ejecutando = False
-                st.rerun()
+            # Detener es cooperativo: el trabajo termina la fila en curso y queda para reanudar
+            if trabajo is not None and trabajo.estado in (TrabajoLote.DETENIDO, TrabajoLote.AGOTADO):
+                if st.button("▶️ Reanudar", use_container_width=True):
+                    trabajo.reanudar()
+                    st.rerun()
+            elif st.button("🛑 Detener", use_container_width=True, disabled=trabajo is None or not trabajo.activo):
+                trabajo.detener()
         with c3:
             if st.button("🗑️ Limpiar", use_container_width=True):
+                descartar_trabajo(st.session_state.trabajo_id)
+                st.session_state.trabajo_id = None
                 st.session_state.resultados = []
+                st.session_state.df_resultados = pd.DataFrame()
                 st.rerun()
 
-        # Contenedores visuales
-        prog_bar = st.progress(0)
-        status_txt = st.empty()
-
-        if btn_iniciar and raw_ids:
+        if btn_iniciar and fuente_bloques:
+            descartar_trabajo(st.session_state.trabajo_id)
+            trabajo = crear_trabajo(fuente_bloques(), st.session_state.tokens, st.session_state.cache, modo,
+                                    cache_negativa=st.session_state.cache_negativa,
+                                    estrategia=estrategia, total=total_estimado).iniciar()
+            st.session_state.trabajo_id = trabajo.id
             st.session_state.resultados = []
-            ids_limpios = list(dict.fromkeys([normalizar_cedula(c) for c in raw_ids if normalizar_cedula(c)]))
-            
-            token_idx = 0
-            for i, _id in enumerate(ids_limpios):
-                # Llama a la lógica del backend para UNA cédula
-                resultado, token_idx, status = procesar_cedula_individual(
-                    _id, 
-                    st.session_state.tokens, 
-                    st.session_state.cache, 
-                    token_idx, 
-                    nombres_ref, 
-                    modo
-                )
-                
-                if status == "Agotado":
-                    st.error("⚠️ Tokens agotados. Se detuvo el proceso.")
-                    break
-                    
-                if resultado:
-                    st.session_state.resultados.append(resultado)
+            st.session_state.df_resultados = pd.DataFrame()
+            st.rerun()
+
+        # Solo este bloque se repinta cada INTERVALO_SONDEO segundos mientras el trabajo corre
+        @st.fragment(run_every=INTERVALO_SONDEO if trabajo is not None and trabajo.activo else None)
+        def panel_trabajo():
+            trabajo = obtener_trabajo(st.session_state.trabajo_id)
+            if trabajo is not None:
+                progreso = trabajo.progreso()
+                total = max(progreso["total"], 1)
+                st.progress(min(progreso["procesados"] / total, 1.0))
+                st.text(f"Trabajo {progreso['id']} ({progreso['estado']}): {progreso['procesados']}/{progreso['total']}")
+
+                # Solo se agregan a la tabla las filas nuevas desde el último sondeo
+                nuevas = trabajo.filas_desde(len(st.session_state.resultados))
+                if nuevas:
+                    st.session_state.resultados.extend(nuevas)
+                    st.session_state.df_resultados = pd.concat(
+                        [st.session_state.df_resultados, pd.DataFrame(nuevas)], ignore_index=True)
+
+                if progreso["estado"] == TrabajoLote.AGOTADO:
+                    st.error("⚠️ Tokens agotados. Se detuvo el proceso; puedes reanudarlo cuando se renueve el cupo.")
+                elif progreso["estado"] == TrabajoLote.FALLIDO:
+                    st.error(f"⚠️ El proceso falló: {progreso['error']}")
+                # Terminó mientras se sondeaba: repintar la página para actualizar los botones
+                if not trabajo.activo and st.session_state.get("sondeando"):
+                    st.session_state.sondeando = False
+                    st.rerun(scope="app")
+                st.session_state.sondeando = trabajo.activo
+
+            # MUESTRA LA TABLA SIEMPRE QUE HAYA DATOS
+            if st.session_state.resultados:
+                df_final = st.session_state.df_resultados
                 
-                # ACTUALIZACIÓN DE BARRA DE PROGRESO (Aquí en el front)
-                prog_bar.progress((i + 1) / len(ids_limpios))
-                status_txt.text(f"Procesando {i+1}/{len(ids_limpios)}...")
-
-        # MUESTRA LA TABLA SIEMPRE QUE HAYA DATOS (Fuera del if del botón)
-        if st.session_state.resultados:
-            df_final = pd.DataFrame(st.session_state.resultados)
-            
-            if modo == "Comparar con mi lista":
-                # Filtro que ahora sí funciona porque st.session_state persiste
-                ver_errores = st.toggle("🔍 Mostrar solo discrepancias", key="toggle_filtro")
-                if ver_errores:
-                    df_final = df_final[df_final["Resultado"] != "IGUAL"]
-
-            st.dataframe(df_final, use_container_width=True)
+                if "Resultado" in df_final.columns:
+                    # Filtro que ahora sí funciona porque st.session_state persiste
+                    ver_errores = st.toggle("🔍 Mostrar solo discrepancias", key="toggle_filtro")
+                    if ver_errores:
+                        df_final = df_final[df_final["Resultado"] != "IGUAL"]
+
+                st.dataframe(df_final, use_container_width=True)
+
+                formato, encoding = opciones_exportacion("resultados")
+                # Solo las filas que hay al hacer clic: el trabajo puede seguir agregando mientras se exporta
+                resultados = st.session_state.resultados
+                # Columnas del modo con que corrió el trabajo (no del que está elegido ahora)
+                modo_trabajo = trabajo.modo if trabajo is not None else modo
+                st.download_button(
+                    label="📥 Descargar Resultados",
+                    data=descarga(functools.partial(exportar_resultados, modo=modo_trabajo),
+                                  lambda: itertools.islice(resultados, len(resultados)), formato, encoding),
+                    file_name=f"resultados.{formato}",
+                    mime=MIME_EXPORTACION[formato],
+                    on_click="ignore"
+                )
+
+        panel_trabajo()
 with tab2:
     st.header("📁 Base de Datos Local (Caché)")
     
     if st.session_state.cache:
-        # Convertimos el dict de caché a DataFrame
-        df_hist = pd.DataFrame([
-            {"Cédula": k, "Nombre": v} 
-            for k, v in st.session_state.cache.items()
-        ])
+        store = st.session_state.cache
         
         # --- MÉTRICAS Y BUSCADOR ---
         c1, c2 = st.columns([1, 3])
         with c1:
-            st.metric("Total en Memoria", len(df_hist))
+            st.metric("Total en Base", len(store))
         with c2:
             search = st.text_input("🔍 Buscar por Cédula o Nombre en el histórico:", placeholder="Ej: 123456 o PEREZ")
 
-        # Aplicar búsqueda si existe
-        if search:
-            df_hist = df_hist[
-                df_hist["Cédula"].str.contains(search) | 
-                df_hist["Nombre"].str.contains(search.upper())
-            ]
+        # La búsqueda se resuelve en el índice del almacén y solo se trae la página visible
+        if st.session_state.get("busqueda_hist") != search:
+            st.session_state.busqueda_hist = search
+            st.session_state.pagina_hist = 0
+        pagina = st.session_state.get("pagina_hist", 0)
+        # Se pide una fila de más para saber si hay página siguiente
+        filas = store.buscar(search, limite=FILAS_POR_PAGINA + 1, desplazamiento=pagina * FILAS_POR_PAGINA)
+        hay_siguiente = len(filas) > FILAS_POR_PAGINA
+        df_hist = pd.DataFrame(filas[:FILAS_POR_PAGINA], columns=["Cédula", "Nombre"])
 
         # --- MOSTRAR TABLA ---
         st.dataframe(df_hist, use_container_width=True, height=400)
+
+        p1, p2, p3 = st.columns([1, 2, 1])
+        with p1:
+            if st.button("⬅️ Anterior", disabled=pagina == 0):
+                st.session_state.pagina_hist = pagina - 1
+                st.rerun()
+        with p2:
+            st.caption(f"Página {pagina + 1}")
+        with p3:
+            if st.button("Siguiente ➡️", disabled=not hay_siguiente):
+                st.session_state.pagina_hist = pagina + 1
+                st.rerun()
         
         # Opción para exportar TODO el histórico acumulado
-        csv_hist = df_hist.to_csv(index=False).encode('latin-1')
+        formato, encoding = opciones_exportacion("historico")
         st.download_button(
             label="📥 Exportar Base de Datos Completa",
-            data=csv_hist,
-            file_name="historico_total_api.csv",
-            mime="text/csv"
+            data=descarga(exportar_historico, lambda: store, formato, encoding),
+            file_name=f"historico_total_api.{formato}",
+            mime=MIME_EXPORTACION[formato],
+            on_click="ignore"
         )
     else:
         st.info("El historial está vacío. Comienza a procesar cédulas en la primera pestaña para alimentar la base de datos.")
 
+with tab3:
+    st.header("📊 Métricas del Proceso")
+
+    if not METRICAS.habilitadas:
+        st.info("Las métricas están deshabilitadas (variable de entorno METRICAS=0).")
+    else:
+        datos = METRICAS.instantanea()
+        cache_total = {m["etiquetas"]["resultado"]: m["valor"] for m in datos["contadores"]
+                       if m["nombre"] == "cache_consultas_total"}
+        consultas_cache = sum(cache_total.values())
+        velocidad = {m["etiquetas"]["funcion"]: m["valor"] for m in datos["valores"]
+                     if m["nombre"] == "lote_filas_por_segundo"}
+
+        m1, m2, m3, m4 = st.columns(4)
+        with m1:
+            st.metric("Aciertos de caché", f"{cache_total.get('acierto', 0) / max(consultas_cache, 1):.0%}")
+        with m2:
+            st.metric("Caché negativa", f"{cache_total.get('negativo', 0) / max(consultas_cache, 1):.0%}")
+        with m3:
+            st.metric("Fueron a la API", cache_total.get("fallo", 0))
+        with m4:
+            st.metric("Filas/s (último lote)", velocidad.get("iterar_lista", velocidad.get("process_full_list", 0)))
+
+        # Un token con latencia o errores en alza es el que va a frenar el lote
+        st.subheader("Tokens")
+        st.dataframe(pd.DataFrame(METRICAS.resumen_tokens()), use_container_width=True)
+
+        st.download_button("📥 Métricas (Prometheus)", data=METRICAS.prometheus(),
+                           file_name="metricas.prom", mime="text/plain")
+
+    st.subheader("Cola de reintentos")
+    cola = obtener_cola().resumen()
+    if not cola["total"]:
+        st.caption("No hay consultas pendientes.")
+    else:
+        st.write(f"{cola['total']} cédulas pendientes; se reintentan solas a medida que hay cupo.")
+        st.dataframe(pd.DataFrame(list(cola["por_error"].items()), columns=["Último error", "Cédulas"]),
+                     use_container_width=True)
+        if cola["retenidas"]:
+            st.warning(f"{cola['retenidas']} cédulas fallaron demasiadas veces y ya no se reintentan solas.")
+            if st.button("🔁 Reintentar las retenidas"):
+                obtener_cola().liberar_retenidas()
+                st.rerun()
+
 # --- FOOTER ---
 st.divider()
 st.caption("Sistema de protección de tokens activo (Balanceo de carga).")
@@ -0,0 +1,300 @@
+"""
+Benchmarks del motor contra la API simulada (stub_api.py), sin red.
+
+    python benchmark.py
+    python benchmark.py --n 5000 --latencia lognormal:-3,0.5 --tasa-429 0.02 --salida base.json
+    python benchmark.py --comparar base.json      # muestra la diferencia contra una corrida anterior
+
+Cada escenario corre en un directorio temporal (SQLite, historic.jsonl y
+pendientes no tocan los del proyecto) y el resultado sale en JSON: segundos,
+elementos por segundo y los contadores del servidor simulado. Por stdout solo
+sale el JSON (los avisos del motor van a stderr), así que se puede encadenar:
+
+    python benchmark.py --n 500 | python -c "import json, sys; json.load(sys.stdin)"
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import motor
+import utils
+from stub_api import ServidorStub, nombre_de
+
+ESCENARIOS = ["motor", "individual", "lista_completa", "cuota", "token_degradado", "carga_cache", "comparacion", "reconciliacion"]
+
+
+def crear_tokens(cantidad, capacidad, intervalo, concurrencia):
+    return [utils.Token(f"token{i}", f"app{i}", capacity=capacidad, concurrencia=concurrencia, intervalo=intervalo)
+            for i in range(cantidad)]
+
+
+def cedulas(n, inicio=10_000_000):
+    return [str(inicio + i) for i in range(n)]
+
+
+def medir(nombre, elementos, funcion):
+    inicio = time.perf_counter()
+    extra = funcion() or {}
+    segundos = time.perf_counter() - inicio
+    return {"escenario": nombre, "elementos": elementos, "segundos": round(segundos, 4),
+            "por_segundo": round(elementos / segundos, 1) if segundos else None, **extra}
+
+
+# --- ESCENARIOS ---
+
+def bench_motor(args, servidor):
+    ids = cedulas(args.n)
+    tokens = crear_tokens(args.tokens, args.n, args.intervalo, args.concurrencia)
+
+    def correr():
+        items = utils.manage_api_requests(ids, tokens, utils.AlmacenIdentidades())
+        return {"devueltos": len(items)}
+    return medir("motor", len(ids), correr)
+
+
+def bench_individual(args, servidor):
+    ids = cedulas(min(args.n, args.n_individual), inicio=20_000_000)
+    tokens = crear_tokens(args.tokens, args.n, args.intervalo, args.concurrencia)
+    store = utils.AlmacenIdentidades()
+
+    def correr():
+        token_idx = 0
+        origenes = {}
+        for _id in ids:
+            _, token_idx, origen = utils.procesar_cedula_individual(_id, tokens, store, token_idx, {}, "Solo Consultar")
+            origenes[origen] = origenes.get(origen, 0) + 1
+        return {"origenes": origenes}
+    return medir("individual", len(ids), correr)
+
+
+def bench_lista_completa(args, servidor):
+    # La mitad ya está en caché: mide caché + API + comparación juntas
+    ids = cedulas(args.n, inicio=30_000_000)
+    store = utils.AlmacenIdentidades()
+    store.guardar_lote((c, _nombre_completo(c)) for c in ids[::2])
+    nombres_ref = {c: _nombre_completo(c) if i % 3 else "OTRO NOMBRE" for i, c in enumerate(ids)}
+    tokens = crear_tokens(args.tokens, args.n, args.intervalo, args.concurrencia)
+
+    def correr():
+        filas = utils.process_full_list(ids, tokens, store, nombres_ref, "Comparar con mi lista")
+        fuentes = {}
+        for fila in filas:
+            fuentes[fila["Fuente"]] = fuentes.get(fila["Fuente"], 0) + 1
+        return {"fuentes": fuentes}
+    return medir("lista_completa", len(ids), correr)
+
+
+def bench_cuota(args, servidor):
+    # El cupo total alcanza para la mitad: mide el camino de agotamiento
+    ids = cedulas(args.n, inicio=40_000_000)
+    capacidad = max(args.n // (2 * args.tokens), 1)
+    servidor.cuota = capacidad
+    tokens = crear_tokens(args.tokens, capacidad, args.intervalo, args.concurrencia)
+
+    def correr():
+        items = utils.manage_api_requests(ids, tokens, utils.AlmacenIdentidades())
+        pendientes = len(utils.cargar_pendientes())
+        return {"devueltos": len(items), "pendientes": pendientes}
+    try:
+        return medir("cuota", len(ids), correr)
+    finally:
+        servidor.cuota = None
+
+
+def bench_token_degradado(args, servidor):
+    # Un token lento que falla la mitad de las veces y otro revocado (401):
+    # no deberían frenar el lote ni convertir sus cédulas en errores
+    ids = cedulas(args.n, inicio=45_000_000)
+    tokens = crear_tokens(args.tokens, args.n, args.intervalo, args.concurrencia)
+    servidor.degradados = {tokens[0].app_id: {"latencia": 0.5, "tasa_5xx": 0.5},
+                           tokens[-1].app_id: {"status": 401}}
+
+    def correr():
+        items = utils.manage_api_requests(ids, tokens, utils.AlmacenIdentidades())
+        return {"devueltos": len(items), "cobradas_token_degradado": servidor.uso.get(
+            (tokens[0].app_id, tokens[0].token_id), 0)}
+    try:
+        return medir("token_degradado", len(ids), correr)
+    finally:
+        servidor.degradados = {}
+
+
+def bench_carga_cache(args, servidor):
+    # historic.jsonl de versiones anteriores -> almacén SQLite (migración + índice)
+    n = args.n_cache
+    with open(utils.HISTORIC_PATH, "w", encoding="utf-8") as f:
+        for c in cedulas(n, inicio=50_000_000):
+            f.write(json.dumps({"cedula": c, "nombre": _nombre_completo(c)}) + "\n")
+    resultado = medir("carga_cache", n, lambda: {"registros": len(utils.inicializar_sistema(ruta_store="carga.sqlite3"))})
+
+    store = utils.AlmacenIdentidades("carga.sqlite3")
+    muestra = random.sample(cedulas(n, inicio=50_000_000), min(n, 10_000))
+    inicio = time.perf_counter()
+    store.obtener_lote(muestra)
+    resultado["busqueda_lote_por_segundo"] = round(len(muestra) / (time.perf_counter() - inicio), 1)
+
+    # La misma búsqueda con la foto compacta: construirla, abrirla (mmap) y consultar
+    inicio = time.perf_counter()
+    utils.CacheCompacta.desde_almacen(store, "carga.compacta")
+    resultado["construccion_compacta_segundos"] = round(time.perf_counter() - inicio, 4)
+    inicio = time.perf_counter()
+    compacta = utils.CacheCompacta.desde_almacen(store, "carga.compacta")
+    resultado["apertura_compacta_segundos"] = round(time.perf_counter() - inicio, 4)
+    inicio = time.perf_counter()
+    compacta.obtener_lote(muestra)
+    resultado["busqueda_lote_compacta_por_segundo"] = round(len(muestra) / (time.perf_counter() - inicio), 1)
+    return resultado
+
+
+def bench_comparacion(args, servidor):
+    n = args.n_comparacion
+    ids = cedulas(n, inicio=60_000_000)
+    api = [_nombre_completo(c) for c in ids]
+    # Un tercio igual, un tercio con un apellido menos, un tercio con un error de tipeo
+    usuario = [a if i % 3 == 0 else " ".join(a.split()[:3]) if i % 3 == 1 else a[:-1] + "X"
+               for i, a in enumerate(api)]
+    resultados = []
+    for estrategia in utils.ESTRATEGIAS_COMPARACION:
+        resultados.append(medir(f"comparacion_{estrategia}", n,
+                                lambda: {"distintos": int((utils.comparar_nombres_lote(
+                                    usuario, api, estrategia=estrategia)["Resultado"] != "IGUAL").sum())}))
+    return resultados
+
+
+def bench_reconciliacion(args, servidor):
+    # Lista grande contra caché caliente: solo CPU (normalizar + caché + comparar)
+    n = args.n_comparacion
+    ids = cedulas(n, inicio=70_000_000)
+    store = utils.AlmacenIdentidades()
+    store.guardar_lote((c, _nombre_completo(c)) for c in ids)
+    crudos = [f"V-{c[:2]}.{c[2:5]}.{c[5:]}" for c in ids]
+    nombres = [_nombre_completo(c) if i % 3 else "OTRO NOMBRE" for i, c in enumerate(ids)]
+    tam = args.tam_fragmento
+    resultados = []
+    for procesos in args.procesos:
+        def correr():
+            fragmentos = ((crudos[i:i + tam], nombres[i:i + tam]) for i in range(0, n, tam))
+            filas = sum(len(f) for _, f, _ in utils.reconciliar_en_procesos(
+                fragmentos, [], store, "Comparar con mi lista", estrategia="difusa", procesos=procesos))
+            return {"procesos": procesos, "filas": filas}
+        resultados.append(medir(f"reconciliacion_{procesos}p", n, correr))
+    return resultados
+
+
+def _nombre_completo(cedula):
+    return " ".join(nombre_de(cedula).values())
+
+
+BENCHMARKS = {
+    "motor": bench_motor,
+    "individual": bench_individual,
+    "lista_completa": bench_lista_completa,
+    "cuota": bench_cuota,
+    "token_degradado": bench_token_degradado,
+    "carga_cache": bench_carga_cache,
+    "comparacion": bench_comparacion,
+    "reconciliacion": bench_reconciliacion,
+}
+
+
+# --- EJECUCIÓN ---
+
+def ejecutar(args):
+    random.seed(args.semilla)
+    servidor = ServidorStub(latencia=args.latencia, tasa_429=args.tasa_429, tasa_5xx=args.tasa_5xx,
+                            tasa_no_existe=args.tasa_no_existe, retry_after=args.retry_after,
+                            semilla=args.semilla).iniciar()
+    motor.API_URL = servidor.url
+    motor.BACKOFF_BASE = args.backoff_base
+    utils.configurar_sesion(args.tokens * args.concurrencia)
+
+    reporte = {
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("salida", "comparar")},
+        "resultados": [],
+    }
+    directorio_original = os.getcwd()
+    # Los avisos de utils ("Error en ID ...") son diagnóstico: a stderr, stdout queda para el JSON
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            for nombre in args.escenarios:
+                directorio = tempfile.mkdtemp(prefix=f"bench_{nombre}_")
+                os.chdir(directorio)
+                servidor.reiniciar_contadores()
+                # Cada escenario con planificador propio: un 429 largo o un circuito abierto no pasa al siguiente
+                utils.descartar_planificadores()
+                try:
+                    resultado = BENCHMARKS[nombre](args, servidor)
+                    utils.vaciar_escritores()
+                finally:
+                    os.chdir(directorio_original)
+                    shutil.rmtree(directorio, ignore_errors=True)
+                for r in resultado if isinstance(resultado, list) else [resultado]:
+                    r["servidor"] = dict(servidor.contadores)
+                    reporte["resultados"].append(r)
+                    print(f"{r['escenario']:>20}: {r['elementos']:>7} en {r['segundos']:>8.3f}s "
+                          f"({r['por_segundo']}/s)", file=sys.stderr)
+    finally:
+        servidor.detener()
+    return reporte
+
+
+def comparar(reporte, ruta_base):
+    """Imprime la variación de por_segundo contra un reporte anterior."""
+    with open(ruta_base, "r", encoding="utf-8") as f:
+        base = {r["escenario"]: r for r in json.load(f)["resultados"]}
+    for r in reporte["resultados"]:
+        anterior = base.get(r["escenario"])
+        if anterior and anterior.get("por_segundo") and r.get("por_segundo"):
+            cambio = (r["por_segundo"] / anterior["por_segundo"] - 1) * 100
+            print(f"{r['escenario']:>20}: {anterior['por_segundo']:>10}/s -> {r['por_segundo']:>10}/s ({cambio:+.1f}%)",
+                  file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks contra la API simulada.")
+    parser.add_argument("--escenarios", nargs="+", choices=ESCENARIOS, default=ESCENARIOS)
+    parser.add_argument("--n", type=int, default=1000, help="cédulas por escenario de API")
+    parser.add_argument("--n-individual", type=int, default=200, help="tope de cédulas para el escenario individual")
+    parser.add_argument("--n-cache", type=int, default=100_000, help="registros para la carga de caché")
+    parser.add_argument("--n-comparacion", type=int, default=100_000, help="pares para la comparación")
+    parser.add_argument("--procesos", type=int, nargs="+", default=[1, utils.PROCESOS_MAX],
+                        help="cantidades de procesos a medir en la reconciliación")
+    parser.add_argument("--tam-fragmento", type=int, default=20_000, help="filas por tarea del pool")
+    parser.add_argument("--tokens", type=int, default=4)
+    parser.add_argument("--concurrencia", type=int, default=motor.CONCURRENCIA_POR_TOKEN)
+    parser.add_argument("--intervalo", type=float, default=0.0, help="ritmo por token (0 = sin pausa)")
+    parser.add_argument("--latencia", default="lognormal:-3.5,0.5",
+                        help="fija:s | uniforme:a,b | exponencial:media | lognormal:mu,sigma")
+    parser.add_argument("--tasa-429", type=float, default=0.0)
+    parser.add_argument("--tasa-5xx", type=float, default=0.0)
+    parser.add_argument("--tasa-no-existe", type=float, default=0.05)
+    parser.add_argument("--retry-after", type=int, default=0, help="Retry-After de los 429 simulados")
+    parser.add_argument("--backoff-base", type=float, default=0.01)
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--salida", default=None, help="archivo JSON (por defecto: stdout)")
+    parser.add_argument("--comparar", default=None, help="JSON de una corrida anterior")
+    args = parser.parse_args(argv)
+
+    reporte = ejecutar(args)
+    texto = json.dumps(reporte, ensure_ascii=False, indent=2)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto)
+    else:
+        print(texto)
+    if args.comparar:
+        comparar(reporte, args.comparar)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""
+Procesamiento masivo sin Streamlit (p. ej. desde cron).
+
+    python cli.py entrada.csv salida.csv --columna cedula
+    python cli.py entrada.csv salida.csv --columna cedula --columna-nombre nombre --estrategia difusa
+    python cli.py entrada.csv salida.csv --columna cedula --columna-nombre nombre --procesos 8 --checkpoint-cada 20000
+
+Escribe los resultados en `salida.csv` a medida que avanza y cada
+--checkpoint-cada filas de la entrada guarda un punto de control en
+`salida.csv.checkpoint.json` (filas de entrada leídas y cédulas que quedaron
+sin resultado). Si el proceso se cae o se agota el cupo, volver a correr el
+mismo comando primero reintenta esas cédulas y luego sigue desde esa fila, sin
+volver a consultar las que ya están en la salida.
+
+Con --procesos N la normalización, el caché y la comparación corren en N
+procesos (conviene con listas enormes y caché caliente; cada tanda de
+--checkpoint-cada cédulas es una tarea del pool). La salida es la misma, en
+el mismo orden, con o sin --procesos.
+
+Con --drenar-cola primero se reintenta lo que quedó en la cola de reintentos
+(cédulas agotadas o fallidas de corridas anteriores) mientras haya cupo.
+
+Códigos de salida: 0 terminado, 1 error de configuración, 3 cupo agotado
+(quedan cédulas pendientes, reanudar cuando se renueve el cupo).
+"""
+import argparse
+import csv
+from collections import Counter
+import json
+import os
+import sys
+import time
+
+from utils import (
+    CACHE_COMPACTA,
+    ESTRATEGIAS_COMPARACION,
+    METRICAS,
+    CacheNegativa,
+    cargar_configuracion,
+    columnas_resultados,
+    detectar_formato_csv,
+    drenar_cola,
+    escribir_atomico,
+    inicializar_sistema,
+    leer_csv_fragmentos,
+    leer_csv_por_bloques,
+    process_full_list,
+    reconciliar_en_procesos,
+)
+
+SALIDA_OK = 0
+SALIDA_CONFIG = 1
+SALIDA_AGOTADO = 3
+
+
+def ruta_checkpoint(salida):
+    return f"{salida}.checkpoint.json"
+
+
+def cargar_checkpoint(salida):
+    ruta = ruta_checkpoint(salida)
+    if not os.path.exists(ruta):
+        return None
+    with open(ruta, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def guardar_checkpoint(salida, estado):
+    estado["actualizado"] = time.time()
+    escribir_atomico(ruta_checkpoint(salida), [json.dumps(estado, ensure_ascii=False)])
+
+
+def preparar_salida(salida, checkpoint):
+    """
+    Deja la salida tal como estaba en el último punto de control (lo escrito
+    después pudo quedar a medias) y retorna el set de cédulas que ya tienen
+    fila (las que vuelvan a aparecer en la entrada salen como "Repetida").
+    """
+    if not os.path.exists(salida):
+        return set()
+    if checkpoint is not None:
+        with open(salida, "r+b") as f:
+            f.truncate(checkpoint["bytes_salida"])
+    else:
+        # Salida sin checkpoint: no sabemos si está completa, se empieza de cero
+        os.remove(salida)
+        return set()
+
+    terminadas = set()
+    for ids, _ in leer_csv_por_bloques(salida, "Cédula", formato=(",", "utf-8")):
+        terminadas.update(ids)
+    return terminadas
+
+
+def ejecutar(args):
+    tokens = cargar_configuracion(args.secrets)
+    if not tokens:
+        print("⚠️ No se encontraron los Tokens. Revisa tu archivo secrets.toml.")
+        return SALIDA_CONFIG
+
+    cache = inicializar_sistema(compacta=args.cache_compacta)
+    cache_negativa = CacheNegativa()
+    if args.drenar_cola:
+        # Primero lo que quedó pendiente de corridas anteriores (tiene prioridad sobre lo nuevo)
+        resueltas = 0
+        while True:
+            ronda = drenar_cola(tokens, cache, cache_negativa)
+            if not ronda:
+                break
+            resueltas += ronda
+        if resueltas:
+            print(f"Cola de reintentos: {resueltas} cédulas resueltas.")
+    modo = "Comparar con mi lista" if args.columna_nombre else "Solo Consultar"
+    columnas = columnas_resultados(modo)
+
+    # 1. Retomar donde se quedó
+    checkpoint = cargar_checkpoint(args.salida)
+    if checkpoint is not None and checkpoint.get("entrada") != os.path.abspath(args.entrada):
+        print(f"⚠️ {ruta_checkpoint(args.salida)} pertenece a otra entrada ({checkpoint.get('entrada')}).")
+        return SALIDA_CONFIG
+    if checkpoint is not None and "filas_entrada" not in checkpoint:
+        # Punto de control de una versión anterior (sin posición en la entrada): se empieza de cero
+        print(f"⚠️ {ruta_checkpoint(args.salida)} no guarda la posición en la entrada; se empieza de cero.")
+        checkpoint = None
+    terminadas = preparar_salida(args.salida, checkpoint)
+    checkpoint = checkpoint or {}
+    estado = {
+        "entrada": os.path.abspath(args.entrada),
+        "procesadas": checkpoint.get("procesadas", 0),      # filas escritas en la salida
+        "filas_entrada": checkpoint.get("filas_entrada", 0),
+        "pendientes": checkpoint.get("pendientes", {}),     # cédula -> nombre de referencia, sin fila aún
+        "completado": False,
+    }
+    if estado["filas_entrada"]:
+        print(f"Reanudando: {estado['filas_entrada']} filas de la entrada ya leídas, "
+              f"{len(estado['pendientes'])} cédulas pendientes.")
+
+    # Lo que vuelva a aparecer de lo ya escrito o pendiente sale como "Repetida"
+    vistos = terminadas | set(estado["pendientes"])
+    formato = detectar_formato_csv(args.entrada)
+    tam = args.checkpoint_cada
+    if args.procesos:
+        fragmentos = leer_csv_fragmentos(args.entrada, args.columna, args.columna_nombre, tam_bloque=tam,
+                                         formato=formato, saltar=estado["filas_entrada"])
+        tandas = reconciliar_en_procesos(fragmentos, tokens, cache, modo, cache_negativa=cache_negativa,
+                                         estrategia=args.estrategia, procesos=args.procesos, vistos=vistos)
+    else:
+        bloques = leer_csv_por_bloques(args.entrada, args.columna, args.columna_nombre, tam_bloque=tam,
+                                       formato=formato, saltar=estado["filas_entrada"])
+        tandas = ((ids, process_full_list(ids, tokens, cache, nombres_ref, modo, cache_negativa=cache_negativa,
+                                          estrategia=args.estrategia, vistos=vistos), nombres_ref)
+                  for ids, nombres_ref in bloques)
+
+    nueva = not os.path.exists(args.salida) or os.path.getsize(args.salida) == 0
+    inicio = time.time()
+    agotado = False
+    with open(args.salida, "a", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columnas, extrasaction="ignore")
+        if nueva:
+            writer.writeheader()
+
+        def guardar_tanda(ids, filas, nombres_ref):
+            """Escribe la tanda y guarda el punto de control. Retorna las cédulas que quedaron sin fila."""
+            writer.writerows(filas)
+            f.flush()
+            os.fsync(f.fileno())
+            # Solo la primera aparición de una cédula puede faltar (las demás salen como "Repetida")
+            faltan = Counter(ids) - Counter(fila["Cédula"] for fila in filas)
+            estado["pendientes"].update({_id: nombres_ref.get(_id, "") for _id in faltan})
+            estado["procesadas"] += len(filas)
+            estado["bytes_salida"] = f.tell()
+            guardar_checkpoint(args.salida, estado)
+
+            velocidad = estado["procesadas"] / max(time.time() - inicio, 1e-9)
+            print(f"{estado['procesadas']} cédulas listas ({velocidad:.1f}/s).")
+            if args.metricas:
+                METRICAS.exportar(args.metricas)
+            return faltan
+
+        # 2. Lo que quedó sin resultado en la corrida anterior (cupo agotado o fallo)
+        if estado["pendientes"]:
+            pendientes, estado["pendientes"] = estado["pendientes"], {}
+            filas = process_full_list(list(pendientes), tokens, cache, pendientes, modo,
+                                      cache_negativa=cache_negativa, estrategia=args.estrategia)
+            agotado = bool(guardar_tanda(list(pendientes), filas, pendientes)) and not any(
+                t.has_capacity() for t in tokens)
+
+        # 3. Procesar por tandas de --checkpoint-cada filas de la entrada
+        for ids, filas, nombres_ref in (() if agotado else tandas):
+            # Los bloques están alineados a múltiplos de `tam` desde el inicio de la entrada
+            estado["filas_entrada"] = (estado["filas_entrada"] // tam + 1) * tam
+            faltan = guardar_tanda(ids, filas, nombres_ref)
+
+            # Lo que no volvió es porque se agotó el cupo o falló: queda para la próxima corrida
+            if faltan and not any(t.has_capacity() for t in tokens):
+                agotado = True
+                break
+
+        if not agotado:
+            estado["bytes_salida"] = f.tell()
+
+    if args.metricas:
+        METRICAS.exportar(args.metricas)
+    if agotado:
+        print("⚠️ Tokens agotados. Vuelve a correr el mismo comando cuando se renueve el cupo.")
+        return SALIDA_AGOTADO
+
+    estado["completado"] = True
+    guardar_checkpoint(args.salida, estado)
+    print(f"✅ Terminado: {estado['procesadas']} cédulas en {args.salida}.")
+    return SALIDA_OK
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Validación masiva de cédulas sin interfaz.")
+    parser.add_argument("entrada", help="CSV con las cédulas")
+    parser.add_argument("salida", help="CSV de resultados (se va escribiendo y se reanuda)")
+    parser.add_argument("--columna", default="cedula", help="columna de la cédula (por defecto: cedula)")
+    parser.add_argument("--columna-nombre", default=None, help="columna del nombre para comparar")
+    parser.add_argument("--estrategia", choices=ESTRATEGIAS_COMPARACION, default="exacta")
+    parser.add_argument("--checkpoint-cada", type=int, default=500, help="cédulas entre puntos de control")
+    parser.add_argument("--procesos", type=int, default=0,
+                        help="procesos para normalizar y comparar (0 = todo en este proceso)")
+    parser.add_argument("--cache-compacta", action="store_true", default=CACHE_COMPACTA,
+                        help="consultar el caché con la foto compacta en mmap (también CACHE_COMPACTA=1)")
+    parser.add_argument("--drenar-cola", action="store_true",
+                        help="antes de empezar, reintentar lo que quedó en la cola de reintentos")
+    parser.add_argument("--secrets", default=".streamlit/secrets.toml", help="archivo TOML con los tokens")
+    parser.add_argument("--metricas", default=None,
+                        help="archivo de métricas a actualizar en cada checkpoint (.json o texto Prometheus)")
+    return ejecutar(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Exportación del histórico y de los resultados a CSV, CSV comprimido o Parquet.
+"""
+
+import csv
+import gzip
+import importlib.util
+import io
+import itertools
+import os
+import pandas as pd
+
+
+# --- EXPORTACIÓN ---
+# Los CSV se escriben con errors="replace": un nombre que no entra en la
+# codificación elegida sale con "?" en vez de cortar la descarga.
+# "parquet" necesita pyarrow (opcional).
+FORMATOS_EXPORTACION = ("csv", "csv.gz", "parquet")
+CODIFICACIONES_EXPORTACION = ("utf-8", "utf-8-sig", "latin-1")
+TAMANO_BLOQUE_EXPORTACION = 50000   # filas por escritura
+COLUMNAS_CONSULTA = ["Cédula", "Nombre API", "Fuente"]
+COLUMNAS_COMPARACION = COLUMNAS_CONSULTA + ["Tu Lista", "Resultado", "Confianza %", "Faltó en API"]
+# Solo las filas "Rechazada" (validación previa) lo traen
+COLUMNA_MOTIVO = "Motivo"
+
+
+def formatos_disponibles():
+    """Formatos de FORMATOS_EXPORTACION que se pueden escribir en este entorno."""
+    if importlib.util.find_spec("pyarrow") is None:
+        return tuple(f for f in FORMATOS_EXPORTACION if f != "parquet")
+    return FORMATOS_EXPORTACION
+
+
+def exportar_filas(filas, destino, columnas, formato="csv", encoding="utf-8", tamano_bloque=TAMANO_BLOQUE_EXPORTACION):
+    """
+    Escribe `filas` (tuplas en el orden de `columnas`, o dicts con esas
+    claves) en `destino`, una ruta o un archivo binario abierto. Se consume el
+    iterable de a `tamano_bloque` filas: la memoria no depende del total.
+    Retorna la cantidad de filas escritas.
+    """
+    if formato not in FORMATOS_EXPORTACION:
+        raise ValueError(f"Formato de exportación desconocido: {formato}")
+    bloques = _bloques_exportacion(filas, columnas, tamano_bloque)
+    if formato == "parquet":
+        return _exportar_parquet(bloques, destino, columnas)
+
+    propio = isinstance(destino, (str, os.PathLike))
+    binario = open(destino, "wb") if propio else destino
+    crudo = gzip.GzipFile(fileobj=binario, mode="wb", compresslevel=6) if formato == "csv.gz" else binario
+    texto = io.TextIOWrapper(crudo, encoding=encoding, errors="replace", newline="")
+    total = 0
+    try:
+        writer = csv.writer(texto)
+        writer.writerow(columnas)
+        for bloque in bloques:
+            writer.writerows(bloque)
+            total += len(bloque)
+        texto.flush()
+    finally:
+        # Cerrar el gzip escribe su cola; el archivo de quien llama queda abierto
+        texto.detach()
+        if crudo is not binario:
+            crudo.close()
+        if propio:
+            binario.close()
+    return total
+
+
+def _bloques_exportacion(filas, columnas, tamano_bloque):
+    iterador = iter(filas)
+    while True:
+        bloque = list(itertools.islice(iterador, tamano_bloque))
+        if not bloque:
+            return
+        if isinstance(bloque[0], dict):
+            bloque = [tuple(fila.get(c) for c in columnas) for fila in bloque]
+        yield bloque
+
+
+def _exportar_parquet(bloques, destino, columnas):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError("Exportar a Parquet requiere pyarrow (pip install pyarrow).")
+    escritor = None
+    total = 0
+    try:
+        for bloque in bloques:
+            df = pd.DataFrame(bloque, columns=columnas)
+            if escritor is None:
+                # El esquema sale del primer bloque; una columna que vino toda
+                # vacía queda como texto para que los bloques siguientes encajen
+                esquema = pa.Schema.from_pandas(df, preserve_index=False)
+                esquema = pa.schema([pa.field(c.name, pa.string()) if pa.types.is_null(c.type) else c
+                                     for c in esquema]).remove_metadata()
+                escritor = pq.ParquetWriter(destino, esquema, compression="zstd")
+            escritor.write_table(pa.Table.from_pandas(df, schema=esquema, preserve_index=False))
+            total += len(bloque)
+        if escritor is None:
+            esquema = pa.schema([pa.field(c, pa.string()) for c in columnas])
+            escritor = pq.ParquetWriter(destino, esquema, compression="zstd")
+    finally:
+        if escritor is not None:
+            escritor.close()
+    return total
+
+
+def exportar_historico(store, destino, formato="csv", encoding="utf-8"):
+    """Todo el almacén de identidades, recorrido por bloques ordenados por cédula."""
+    return exportar_filas(store.items(), destino, ["Cédula", "Nombre"], formato, encoding)
+
+
+def columnas_resultados(modo="Solo Consultar"):
+    """Columnas fijas de los resultados de cada modo (las mismas que usa cli.py)."""
+    columnas = COLUMNAS_COMPARACION if modo == "Comparar con mi lista" else COLUMNAS_CONSULTA
+    return columnas + [COLUMNA_MOTIVO]
+
+
+def exportar_resultados(filas, destino, formato="csv", encoding="utf-8", modo="Solo Consultar"):
+    """
+    Filas de resultados (dicts de construir_fila / comparar_filas) con las
+    columnas del modo: no dependen de qué fila venga primero (una rechazada
+    no trae las de comparación).
+    """
+    return exportar_filas(filas, destino, columnas_resultados(modo), formato, encoding)
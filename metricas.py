@@ -0,0 +1,225 @@
+"""
+Métricas del proceso (contadores, medidores e histogramas) con exportación
+a JSON y formato Prometheus.
+"""
+
+import functools
+import hashlib
+import json
+import threading
+import os
+
+from persistencia import escribir_atomico
+
+
+# --- MÉTRICAS ---
+# METRICAS=0 en el entorno las apaga (cada registro pasa a ser un if y nada más)
+METRICAS_HABILITADAS = os.environ.get("METRICAS", "1") != "0"
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1, 2.5, 5, 7.5, 10)
+
+
+class Metricas():
+    """
+    Contadores, valores instantáneos e histogramas en memoria del proceso,
+    con etiquetas (token, estado, ...). Se exportan en formato de texto de
+    Prometheus o como dict/JSON. Deshabilitadas, los métodos retornan sin
+    hacer nada.
+    """
+    def __init__(self, habilitadas=METRICAS_HABILITADAS, buckets=BUCKETS_LATENCIA):
+        self.habilitadas = habilitadas
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._contadores = {}    # (nombre, etiquetas) -> valor
+        self._valores = {}
+        self._histogramas = {}   # (nombre, etiquetas) -> [conteos por bucket..., +Inf, suma]
+        self._tokens = []
+
+    @staticmethod
+    def _clave(nombre, etiquetas):
+        return nombre, tuple(sorted(etiquetas.items()))
+
+    def contar(self, nombre, valor=1, **etiquetas):
+        if not self.habilitadas:
+            return
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            self._contadores[clave] = self._contadores.get(clave, 0) + valor
+
+    def fijar(self, nombre, valor, **etiquetas):
+        if not self.habilitadas:
+            return
+        with self._lock:
+            self._valores[self._clave(nombre, etiquetas)] = valor
+
+    def observar(self, nombre, valor, **etiquetas):
+        if not self.habilitadas:
+            return
+        clave = self._clave(nombre, etiquetas)
+        with self._lock:
+            h = self._histogramas.get(clave)
+            if h is None:
+                h = self._histogramas[clave] = [0] * (len(self.buckets) + 2)
+            h[next((i for i, b in enumerate(self.buckets) if valor <= b), len(self.buckets))] += 1
+            h[-1] += valor
+
+    def registrar_tokens(self, tokens):
+        """El cupo restante de estos tokens se lee al exportar (no en cada consulta)."""
+        self._tokens = list(tokens)
+
+    def reiniciar(self):
+        with self._lock:
+            self._contadores.clear()
+            self._valores.clear()
+            self._histogramas.clear()
+
+    def instantanea(self):
+        """Todo como dict serializable: {"contadores": [...], "valores": [...], "histogramas": [...]}."""
+        with self._lock:
+            contadores = dict(self._contadores)
+            valores = dict(self._valores)
+            histogramas = {k: list(v) for k, v in self._histogramas.items()}
+        for token in self._tokens:
+            valores[("token_cupo_restante", (("token", token.etiqueta),))] = token.capacity - token.current_usage
+
+        def filas(d):
+            return [{"nombre": n, "etiquetas": dict(e), "valor": v} for (n, e), v in sorted(d.items())]
+        return {
+            "contadores": filas(contadores),
+            "valores": filas(valores),
+            "histogramas": [{"nombre": n, "etiquetas": dict(e), "buckets": list(self.buckets),
+                             "conteos": h[:-1], "total": sum(h[:-1]), "suma": h[-1]}
+                            for (n, e), h in sorted(histogramas.items())],
+        }
+
+    def resumen_tokens(self):
+        """
+        Una fila por token: consultas, errores, reintentos, latencia p50/p95
+        (cota superior del bucket) y cupo restante. Sirve para ver qué token
+        se está degradando.
+        """
+        from motor import ENCONTRADO, NO_ENCONTRADO   # motor importa este módulo
+        datos = self.instantanea()
+        filas = {}
+
+        def fila(token):
+            return filas.setdefault(token, {"token": token, "consultas": 0, "errores": 0, "reintentos": 0,
+                                            "latencia_p50": None, "latencia_p95": None, "cupo_restante": None})
+        for m in datos["contadores"]:
+            token = m["etiquetas"].get("token")
+            if token is None:
+                continue
+            if m["nombre"] == "api_respuestas_total":
+                fila(token)["consultas"] += m["valor"]
+                if m["etiquetas"].get("estado") not in (ENCONTRADO, NO_ENCONTRADO):
+                    fila(token)["errores"] += m["valor"]
+            elif m["nombre"] == "api_reintentos_total":
+                fila(token)["reintentos"] += m["valor"]
+        for h in datos["histogramas"]:
+            if h["nombre"] == "api_latencia_segundos" and h["total"]:
+                f = fila(h["etiquetas"]["token"])
+                f["latencia_p50"] = self._cuantil(h, 0.5)
+                f["latencia_p95"] = self._cuantil(h, 0.95)
+        for m in datos["valores"]:
+            if m["nombre"] == "token_cupo_restante":
+                fila(m["etiquetas"]["token"])["cupo_restante"] = m["valor"]
+        return list(filas.values())
+
+    @staticmethod
+    def _cuantil(histograma, q):
+        objetivo = q * histograma["total"]
+        acumulado = 0
+        for limite, conteo in zip(list(histograma["buckets"]) + [float("inf")], histograma["conteos"]):
+            acumulado += conteo
+            if acumulado >= objetivo:
+                return limite
+        return float("inf")
+
+    def prometheus(self, prefijo="validador_"):
+        """Texto en el formato de exposición de Prometheus."""
+        def etiquetas(e, extra=None):
+            pares = list(e.items()) + (extra or [])
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pares) + "}" if pares else ""
+
+        datos = self.instantanea()
+        lineas = []
+        for tipo, clave in (("counter", "contadores"), ("gauge", "valores")):
+            vistos = set()
+            for m in datos[clave]:
+                if m["nombre"] not in vistos:
+                    vistos.add(m["nombre"])
+                    lineas.append(f"# TYPE {prefijo}{m['nombre']} {tipo}")
+                lineas.append(f"{prefijo}{m['nombre']}{etiquetas(m['etiquetas'])} {m['valor']}")
+        vistos = set()
+        for h in datos["histogramas"]:
+            nombre = prefijo + h["nombre"]
+            if nombre not in vistos:
+                vistos.add(nombre)
+                lineas.append(f"# TYPE {nombre} histogram")
+            acumulado = 0
+            for limite, conteo in zip(list(h["buckets"]) + ["+Inf"], h["conteos"]):
+                acumulado += conteo
+                lineas.append(f"{nombre}_bucket{etiquetas(h['etiquetas'], [('le', limite)])} {acumulado}")
+            lineas.append(f"{nombre}_sum{etiquetas(h['etiquetas'])} {h['suma']}")
+            lineas.append(f"{nombre}_count{etiquetas(h['etiquetas'])} {h['total']}")
+        return "\n".join(lineas) + "\n"
+
+    def exportar(self, ruta):
+        """Escribe las métricas en `ruta` (JSON si termina en .json, si no texto Prometheus)."""
+        if ruta.endswith(".json"):
+            contenido = json.dumps(self.instantanea(), ensure_ascii=False)
+        else:
+            contenido = self.prometheus()
+        escribir_atomico(ruta, [contenido.rstrip("\n")])
+
+    def servir(self, puerto, host="0.0.0.0"):
+        """Expone /metrics (Prometheus) y /metrics.json en un hilo aparte. Retorna el servidor."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metricas = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith("/metrics.json"):
+                    cuerpo, tipo = json.dumps(metricas.instantanea()).encode(), "application/json"
+                elif self.path.startswith("/metrics"):
+                    cuerpo, tipo = metricas.prometheus().encode(), "text/plain; version=0.0.4"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", tipo)
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, *args):
+                pass
+
+        servidor = ThreadingHTTPServer((host, puerto), Manejador)
+        servidor.daemon_threads = True
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        return servidor
+
+
+METRICAS = Metricas()
+
+
+@functools.lru_cache(maxsize=None)
+def etiqueta_token(app_id, token):
+    """Nombre del token para métricas: app_id + huella corta (nunca el token en claro)."""
+    return f"{app_id}:{hashlib.sha256(str(token).encode('utf-8')).hexdigest()[:6]}"
+
+
+def registrar_cache(aciertos=0, negativos=0, fallos=0):
+    """Métricas de caché: aciertos, aciertos de la caché negativa y fallos (van a la API)."""
+    if METRICAS.habilitadas:
+        METRICAS.contar("cache_consultas_total", aciertos, resultado="acierto")
+        METRICAS.contar("cache_consultas_total", negativos, resultado="negativo")
+        METRICAS.contar("cache_consultas_total", fallos, resultado="fallo")
+
+
+def registrar_lote(funcion, filas, segundos):
+    """Métricas de un lote terminado: filas y filas por segundo."""
+    if METRICAS.habilitadas:
+        METRICAS.contar("lote_filas_total", filas, funcion=funcion)
+        METRICAS.contar("lotes_total", funcion=funcion)
+        METRICAS.fijar("lote_filas_por_segundo", round(filas / max(segundos, 1e-9), 2), funcion=funcion)
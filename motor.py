@@ -0,0 +1,799 @@
+"""
+Consultas a la API: tokens y su planificación, cliente HTTP, motor de
+consultas concurrente y drenado de la cola de reintentos.
+"""
+
+import json
+import queue
+import random
+import requests
+import threading
+import time
+import toml
+from concurrent.futures import Future
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+from almacen import DRENADO_INTERVALO, DRENADO_LOTE, VENTANA_CUOTA, LedgerCuotas, obtener_cola
+from metricas import METRICAS, etiqueta_token
+from normalizacion import separar_cedula
+from persistencia import LEDGER_PATH, add_to_historic
+
+
+# --- CONCURRENCIA ---
+# Consultas simultáneas por token y segundos mínimos entre dos consultas del
+# mismo token. Se pueden sobreescribir por token en secrets.toml.
+CONCURRENCIA_POR_TOKEN = 2
+INTERVALO_TOKEN = 0.3
+
+
+# --- CLIENTE HTTP ---
+API_URL = "https://api.cedula.com.ve/api/v1"
+TAMANO_POOL = 32          # conexiones keep-alive reutilizables por host
+TIMEOUT_API = 10
+REINTENTOS_API = 3        # reintentos ante 429 / 5xx / fallos de red
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30          # un Retry-After mayor no se espera en línea, se devuelve
+
+
+# --- TOKENS ---
+
+class Token():
+    def __init__(self, token, app_id, capacity=200, concurrencia=CONCURRENCIA_POR_TOKEN, intervalo=INTERVALO_TOKEN, ledger=None):
+        self.capacity = capacity
+        self.token_id = token
+        self.app_id = app_id
+        self.concurrencia = concurrencia
+        self.intervalo = intervalo
+        # Sin ledger el uso solo vive en memoria (útil para pruebas)
+        self.ledger = ledger
+        self._uso = 0
+        self._lock = threading.Lock()
+        self._proximo_turno = 0.0
+        self.etiqueta = etiqueta_token(app_id, token)
+
+    @property
+    def clave(self):
+        """Identifica al token por sus credenciales (dos objetos del mismo token comparten salud)."""
+        return (self.app_id, self.token_id)
+
+    @property
+    def current_usage(self):
+        if self.ledger is not None:
+            return self.ledger.usados(self)
+        return self._uso
+
+    def has_capacity(self):
+        return self.current_usage < self.capacity
+
+    def reservar(self):
+        """Aparta una consulta del cupo. Retorna False si el token está agotado."""
+        if self.ledger is not None:
+            return self.ledger.reservar(self)
+        with self._lock:
+            if self._uso >= self.capacity:
+                return False
+            self._uso += 1
+            return True
+
+    def liberar(self):
+        """Devuelve al cupo una consulta reservada que no se llegó a gastar."""
+        if self.ledger is not None:
+            self.ledger.liberar(self)
+            return
+        with self._lock:
+            self._uso = max(0, self._uso - 1)
+
+    def esperar_turno(self):
+        """Bloquea hasta que el token pueda lanzar otra consulta (ritmo por token)."""
+        with self._lock:
+            ahora = time.monotonic()
+            turno = max(ahora, self._proximo_turno)
+            self._proximo_turno = turno + self.intervalo
+        if turno > ahora:
+            time.sleep(turno - ahora)
+
+    def enfriar(self, segundos):
+        """Aplaza el próximo turno del token (p. ej. tras un 429 con Retry-After)."""
+        with self._lock:
+            self._proximo_turno = max(self._proximo_turno, time.monotonic() + segundos)
+
+    def espera(self, ahora=None):
+        """Segundos que faltan para que el token pueda lanzar otra consulta."""
+        return max(0.0, self._proximo_turno - (time.monotonic() if ahora is None else ahora))
+
+    def get_credentials(self):
+        return {"app_id": self.app_id, "token": self.token_id}
+
+
+def cargar_configuracion(ruta_toml=".streamlit/secrets.toml", ruta_ledger=LEDGER_PATH):
+    """
+    Lee los tokens del archivo TOML y retorna una lista de objetos Token.
+    El consumo de cada token se lleva en el ledger persistente de `ruta_ledger`
+    (None para contarlo solo en memoria).
+    """
+    try:
+        config = toml.load(ruta_toml)
+        ledger = None
+        if ruta_ledger:
+            ledger = LedgerCuotas(ruta_ledger, ventana=config.get("ventana_cuota", VENTANA_CUOTA))
+        tokens_objs = []
+        for t in config.get("tokens", []):
+            tokens_objs.append(Token(
+                token=t["token"],
+                app_id=t["app_id"],
+                capacity=t.get("capacity", 200),
+                concurrencia=t.get("concurrencia", CONCURRENCIA_POR_TOKEN),
+                intervalo=t.get("intervalo", INTERVALO_TOKEN),
+                ledger=ledger,
+            ))
+        METRICAS.registrar_tokens(tokens_objs)
+        return tokens_objs
+    except Exception as e:
+        print(f"Error cargando configuración: {e}")
+        return []
+
+
+# --- PLANIFICACIÓN DE TOKENS ---
+ALFA_EWMA = 0.2                 # peso de la última consulta en latencia y tasa de error
+UMBRAL_FALLOS = 5               # fallos seguidos que abren el circuito de un token
+ENFRIAMIENTO_CIRCUITO = 10      # segundos con el circuito abierto (se duplica si la prueba falla)
+ENFRIAMIENTO_MAX = 300
+REFRESCO_CUPO = 60              # cada cuánto se relee del ledger el cupo de cada token
+
+
+class SaludToken():
+    """
+    Estado reciente de un token: latencia y tasa de error (promedios móviles
+    exponenciales), consultas en vuelo y circuit breaker. Con el circuito
+    abierto el token no recibe consultas hasta `abierto_hasta`; después deja
+    pasar una sola de prueba (semiabierto) que lo cierra o lo vuelve a abrir.
+    """
+    def __init__(self, token):
+        self.token = token
+        self.latencia = None
+        self.tasa_error = 0.0
+        self.fallos_seguidos = 0
+        self.abierto_hasta = 0.0
+        self.enfriamiento = ENFRIAMIENTO_CIRCUITO
+        self.probando = False
+        self.en_vuelo = 0
+        self.restante = token.capacity - token.current_usage
+        self.agotado = self.restante <= 0
+
+    @property
+    def abierto(self):
+        return self.fallos_seguidos >= UMBRAL_FALLOS
+
+    def disponible(self, ahora, espera_max):
+        if self.agotado or self.en_vuelo >= max(1, self.token.concurrencia):
+            return False
+        if self.token.espera(ahora) > espera_max:
+            return False    # enfriado por un Retry-After largo
+        if self.abierto:
+            return ahora >= self.abierto_hasta and not self.probando
+        return True
+
+    def falta(self, ahora, espera_max):
+        """Segundos hasta que vuelva a estar disponible (sin contar consultas en vuelo)."""
+        circuito = self.abierto_hasta - ahora if self.abierto else 0.0
+        return max(circuito, self.token.espera(ahora) - espera_max, 0.0)
+
+    def puntaje(self, ahora):
+        """Costo esperado de mandarle la próxima consulta (menor es mejor)."""
+        latencia = self.latencia if self.latencia is not None else 0.0
+        ocupacion = 1 + self.en_vuelo / max(1, self.token.concurrencia)
+        fraccion_cupo = min(1.0, self.restante / max(1, self.token.capacity))
+        return ((self.token.espera(ahora) + latencia) * ocupacion
+                / max(1 - self.tasa_error, 0.05) / (0.5 + fraccion_cupo))
+
+
+class PlanificadorTokens():
+    """
+    Elige el token de cada consulta por cupo restante, latencia reciente,
+    tasa de error y ritmo pendiente, en vez de rotar a ciegas. La elección es
+    O(1): se comparan dos tokens al azar (power of two choices) y solo si
+    ninguno sirve se recorre la lista. Un token que falla UMBRAL_FALLOS veces
+    seguidas queda fuera (circuito abierto) durante su enfriamiento.
+    Lo comparten el motor y procesar_cedula_individual (ver obtener_planificador).
+    `saludes` ({clave: SaludToken}) permite compartir la salud de cada
+    credencial entre planificadores; cada registro pasa a usar el Token de
+    `tokens` (su cupo, ledger y ritmo).
+    """
+    def __init__(self, tokens, espera_max=BACKOFF_MAX, saludes=None):
+        self.tokens = list(tokens)
+        self.espera_max = espera_max
+        saludes = {} if saludes is None else saludes
+        self._salud = {}
+        for t in self.tokens:
+            s = saludes.get(t.clave)
+            if s is None:
+                s = saludes[t.clave] = SaludToken(t)
+            s.token = t
+            self._salud[t.clave] = s
+        self._lista = list(self._salud.values())
+        self._cupo_leido = time.monotonic()
+        self._lock = threading.Lock()
+        self._cambio = threading.Condition(self._lock)
+        self._refrescar_cupo(self._cupo_leido)
+        self._azar = random.Random()
+
+    def salud(self, token):
+        return self._salud[token.clave]
+
+    def refrescar_cupo(self):
+        """Relee del ledger el cupo de todos los tokens (p. ej. al empezar un lote)."""
+        with self._lock:
+            self._refrescar_cupo(time.monotonic())
+
+    def _refrescar_cupo(self, ahora):
+        # El estimado se desvía (liberaciones, otros procesos) y la ventana del
+        # cupo puede renovarse: cada REFRESCO_CUPO segundos se relee del ledger
+        for s in self._lista:
+            s.restante = s.token.capacity - s.token.current_usage
+            s.agotado = s.restante <= 0
+        self._vivos = sum(not s.agotado for s in self._lista)
+        self._cupo_leido = ahora
+
+    def _elegir(self, ahora, evitar=None):
+        # 1. Dos candidatos al azar; gana el de menor puntaje
+        candidatos = [s for s in (self._azar.choice(self._lista), self._azar.choice(self._lista))
+                      if s.token.clave != evitar and s.disponible(ahora, self.espera_max)]
+        # 2. Si ninguno sirve, recorrer (pasa cuando casi todos están ocupados o fuera);
+        #    `evitar` solo si es el único disponible
+        if not candidatos:
+            disponibles = [s for s in self._lista if s.disponible(ahora, self.espera_max)]
+            candidatos = [s for s in disponibles if s.token.clave != evitar] or disponibles
+        return min(candidatos, key=lambda s: s.puntaje(ahora)) if candidatos else None
+
+    def adquirir(self, evitar=None):
+        """
+        Elige un token y le reserva una consulta. Con `evitar` (clave de un
+        token) se prefiere cualquier otro, p. ej. al reintentar lo que ese
+        token no pudo consultar.
+        Retorna (token, None), o (None, motivo) con motivo "Agotado" (ningún
+        token con cupo), "circuito_abierto" o "limitado" (429 con Retry-After
+        largo) si los que quedan no van a estar disponibles en menos de
+        `espera_max` segundos.
+        """
+        while True:
+            with self._cambio:
+                while True:
+                    ahora = time.monotonic()
+                    if ahora - self._cupo_leido > REFRESCO_CUPO:
+                        self._refrescar_cupo(ahora)
+                    if not self._vivos:
+                        return None, "Agotado"
+                    elegido = self._elegir(ahora, evitar)
+                    if elegido is not None:
+                        elegido.en_vuelo += 1
+                        if elegido.abierto:
+                            elegido.probando = True
+                        break
+                    # Nadie disponible ya: ¿cuánto falta para que alguno lo esté?
+                    vivos = [s for s in self._lista if not s.agotado]
+                    ocupados = any(s.en_vuelo >= max(1, s.token.concurrencia) for s in vivos)
+                    proximo = min(vivos, key=lambda s: s.falta(ahora, self.espera_max))
+                    espera = proximo.falta(ahora, self.espera_max)
+                    if not ocupados and espera > self.espera_max:
+                        return None, "circuito_abierto" if proximo.abierto else LIMITADO
+                    # Se despierta al soltarse un token o cuando vence la espera
+                    self._cambio.wait(min(max(espera, 0.01), 0.5))
+
+            # 3. Reserva en el ledger (la fuente de verdad del cupo)
+            if elegido.token.reservar():
+                with self._lock:
+                    elegido.restante -= 1
+                return elegido.token, None
+            with self._cambio:
+                elegido.en_vuelo -= 1
+                elegido.probando = False
+                if not elegido.agotado:
+                    elegido.agotado = True
+                    self._vivos -= 1
+                elegido.restante = 0
+                self._cambio.notify_all()
+
+    def soltar(self, token):
+        """Fin de la consulta: el token vuelve a tener un lugar libre."""
+        s = self.salud(token)
+        with self._cambio:
+            s.en_vuelo -= 1
+            self._cambio.notify_all()
+
+    def registrar(self, token, estado, segundos):
+        """Actualiza la salud del token con el resultado de una consulta."""
+        s = self.salud(token)
+        fallo = estado not in (ENCONTRADO, NO_ENCONTRADO)
+        with self._lock:
+            s.latencia = segundos if s.latencia is None else (1 - ALFA_EWMA) * s.latencia + ALFA_EWMA * segundos
+            s.tasa_error = (1 - ALFA_EWMA) * s.tasa_error + ALFA_EWMA * fallo
+            estaba_abierto = s.abierto
+            s.probando = False
+            if not fallo:
+                s.fallos_seguidos = 0
+                s.enfriamiento = ENFRIAMIENTO_CIRCUITO
+                return
+            s.fallos_seguidos += 1
+            if s.abierto:
+                # Se abre (o la prueba falló): fuera por un rato, cada vez más largo
+                if estaba_abierto:
+                    s.enfriamiento = min(s.enfriamiento * 2, ENFRIAMIENTO_MAX)
+                s.abierto_hasta = time.monotonic() + s.enfriamiento
+        if s.abierto and not estaba_abierto:
+            print(f"Token {token.etiqueta} fuera por {s.enfriamiento}s tras {s.fallos_seguidos} fallos seguidos")
+        METRICAS.fijar("token_circuito_abierto", int(s.abierto), token=token.etiqueta)
+
+
+_planificadores = {}
+_saludes = {}     # clave del token -> SaludToken, una por credencial y por proceso
+_planificadores_lock = threading.Lock()
+
+
+def obtener_planificador(tokens):
+    """
+    Un PlanificadorTokens por conjunto de credenciales y por proceso. La
+    salud y los circuitos son de cada credencial y se comparten aunque cada
+    sesión cree sus Token; si llegan otros objetos Token (p. ej. se recargó
+    secrets.toml con otro cupo) se arma un planificador nuevo con ellos.
+    """
+    clave = tuple(t.clave for t in tokens)
+    with _planificadores_lock:
+        planificador = _planificadores.get(clave)
+        if planificador is None or any(a is not b for a, b in zip(planificador.tokens, tokens)):
+            planificador = _planificadores[clave] = PlanificadorTokens(tokens, saludes=_saludes)
+        return planificador
+
+
+def descartar_planificadores():
+    """Olvida planificadores y salud de los tokens (p. ej. entre escenarios del benchmark)."""
+    with _planificadores_lock:
+        _planificadores.clear()
+        _saludes.clear()
+
+
+# --- LÓGICA DE API ---
+
+def parse_api_response(data):
+    d = data.get("data", {})
+    if not d: return None
+    full_name = f"{d.get('primer_nombre', '')} {d.get('segundo_nombre', '')} {d.get('primer_apellido', '')} {d.get('segundo_apellido', '')}"
+    return " ".join(full_name.split()).upper()
+
+# Clasificación de cada consulta a la API
+ENCONTRADO = "encontrado"
+NO_ENCONTRADO = "no_encontrado"
+LIMITADO = "limitado"                  # 429: el proveedor nos frenó
+ERROR_TRANSPORTE = "error_transporte"  # red, timeout, 5xx o respuesta ilegible
+RECHAZADO = "rechazado"                # otros 4xx (token inválido, parámetros)
+CODIGOS_TOKEN = (401, 403)             # rechazos por la credencial, no por la cédula
+
+
+class RespuestaAPI():
+    """Resultado tipado de una consulta: nunca confunde un fallo con "NO ENCONTRADO"."""
+    def __init__(self, estado, datos=None, status_code=None, detalle="", intentos=1, retry_after=None):
+        self.estado = estado
+        self.datos = datos or {}
+        self.status_code = status_code
+        self.detalle = detalle
+        self.intentos = intentos
+        self.retry_after = retry_after
+
+    def __repr__(self):
+        return f"RespuestaAPI({self.estado!r}, status_code={self.status_code}, intentos={self.intentos})"
+
+
+_sesion = None
+_sesion_lock = threading.Lock()
+
+
+def obtener_sesion():
+    """Sesión HTTP compartida por todo el proceso (keep-alive + pool de conexiones)."""
+    global _sesion
+    with _sesion_lock:
+        if _sesion is None:
+            _sesion = _crear_sesion(TAMANO_POOL)
+        return _sesion
+
+
+def configurar_sesion(tamano_pool=TAMANO_POOL):
+    """Reemplaza la sesión compartida por una con otro tamaño de pool."""
+    global _sesion
+    with _sesion_lock:
+        anterior, _sesion = _sesion, _crear_sesion(tamano_pool)
+    if anterior is not None:
+        anterior.close()
+
+
+def _crear_sesion(tamano_pool):
+    sesion = requests.Session()
+    adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=tamano_pool)
+    sesion.mount("https://", adaptador)
+    sesion.mount("http://", adaptador)
+    return sesion
+
+
+def _leer_retry_after(valor):
+    """Retry-After puede venir en segundos o como fecha HTTP."""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _clasificar_respuesta(response):
+    if response.status_code == 200:
+        try:
+            data = response.json()
+        except ValueError:
+            return RespuestaAPI(ERROR_TRANSPORTE, status_code=200, detalle="JSON inválido")
+        if data.get("data"):
+            return RespuestaAPI(ENCONTRADO, data, 200)
+        return RespuestaAPI(NO_ENCONTRADO, data, 200)
+    if response.status_code == 404:
+        return RespuestaAPI(NO_ENCONTRADO, status_code=404)
+    if response.status_code == 429:
+        return RespuestaAPI(LIMITADO, status_code=429, detalle="HTTP 429",
+                            retry_after=_leer_retry_after(response.headers.get("Retry-After")))
+    if response.status_code >= 500:
+        return RespuestaAPI(ERROR_TRANSPORTE, status_code=response.status_code, detalle=f"HTTP {response.status_code}",
+                            retry_after=_leer_retry_after(response.headers.get("Retry-After")))
+    return RespuestaAPI(RECHAZADO, status_code=response.status_code, detalle=f"HTTP {response.status_code}")
+
+
+def consultar_api(query_params, api_url=None, reintentos=REINTENTOS_API, timeout=TIMEOUT_API):
+    """
+    Hace la petición con la sesión compartida y la clasifica (ver RespuestaAPI).
+    Ante 429, 5xx o fallos de red reintenta con backoff exponencial con jitter,
+    respetando Retry-After cuando el servidor lo manda.
+    """
+    sesion = obtener_sesion()
+    token = None
+    if METRICAS.habilitadas:
+        token = etiqueta_token(query_params.get("app_id"), query_params.get("token"))
+    for intento in range(reintentos + 1):
+        inicio = time.perf_counter()
+        try:
+            response = sesion.get(api_url or API_URL, params=query_params, timeout=timeout)
+            resultado = _clasificar_respuesta(response)
+        except requests.RequestException as e:
+            resultado = RespuestaAPI(ERROR_TRANSPORTE, detalle=f"{type(e).__name__}: {e}")
+            METRICAS.contar("api_excepciones_total", token=token, tipo=type(e).__name__)
+        resultado.intentos = intento + 1
+        if token is not None:
+            METRICAS.observar("api_latencia_segundos", time.perf_counter() - inicio, token=token)
+            METRICAS.contar("api_respuestas_total", token=token, estado=resultado.estado)
+            if intento:
+                METRICAS.contar("api_reintentos_total", token=token)
+
+        if resultado.estado not in (LIMITADO, ERROR_TRANSPORTE) or intento == reintentos:
+            return resultado
+
+        espera = resultado.retry_after
+        if espera is None:
+            espera = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** intento))
+        elif espera > BACKOFF_MAX:
+            # Que decida el llamador (p. ej. enfriar el token) en vez de bloquear el hilo
+            return resultado
+        time.sleep(espera)
+    return resultado
+
+
+def api_request_and_parse_data(query_params, api_url=None):
+    """Compatibilidad: retorna el JSON si hubo respuesta válida, {} en cualquier otro caso."""
+    respuesta = consultar_api(query_params, api_url)
+    if respuesta.estado in (ENCONTRADO, NO_ENCONTRADO):
+        return respuesta.datos
+    print(f"Fallo de consulta ({respuesta.estado}): {respuesta.detalle}")
+    return {}
+
+class CoalescedorConsultas():
+    """
+    Single-flight: si varios hilos (de la misma o de distintas sesiones) piden
+    la misma cédula a la vez, solo el primero ("líder") sale a la API y el
+    resto espera su resultado sin gastar cupo.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._en_vuelo = {}
+
+    def unirse(self, clave):
+        """Retorna (future, es_lider). Si es líder, debe llamar a resolver() siempre."""
+        with self._lock:
+            futuro = self._en_vuelo.get(clave)
+            if futuro is not None:
+                return futuro, False
+            futuro = self._en_vuelo[clave] = Future()
+            return futuro, True
+
+    def resolver(self, clave, resultado):
+        """`resultado` None indica que el líder no llegó a una respuesta definitiva."""
+        with self._lock:
+            futuro = self._en_vuelo.pop(clave, None)
+        if futuro is not None:
+            futuro.set_result(resultado)
+
+
+# Uno por proceso: lo comparten todas las sesiones de Streamlit
+COALESCEDOR = CoalescedorConsultas()
+
+
+class MotorConsultas():
+    """
+    Motor concurrente de consultas a la API.
+    Arranca tantos hilos como la suma de `token.concurrencia`; cada hilo toma
+    una cédula de la cola compartida y le pide un token al PlanificadorTokens
+    (el más sano y con más cupo, respetando el ritmo `token.intervalo`), así
+    un token lento o fallando deja de recibir trabajo sin frenar el lote.
+    Por cada cédula enviada sale exactamente un resultado por `recibir()`:
+    {"idx", "cedula", "nombre", "status", "error"} con status "API",
+    "No existe", "Error" (con la clase de error) o "Agotado" (sin tokens con
+    cupo o motor detenido). Un 429 enfría el token y la cédula vuelve a la cola
+    para otro token, hasta `reintentos` veces; lo mismo (sin enfriar) con las
+    fallas que dependen del token: 401/403, 5xx y fallos de red. Las cédulas
+    inexistentes se anotan en `cache_negativa` si se pasa una.
+    """
+    def __init__(self, tokens, cache_dict, reintentos=REINTENTOS_API, cache_negativa=None, planificador=None):
+        self.tokens = tokens
+        self.cache_dict = cache_dict
+        self.cache_negativa = cache_negativa
+        self.reintentos = reintentos
+        self.planificador = planificador or obtener_planificador(tokens)
+        self._entrada = queue.Queue()
+        self._salida = queue.Queue()
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilos = []
+        self._vivos = 0
+        self._sin_hilos = False
+        self._cerrado = False
+
+    def iniciar(self):
+        self.planificador.refrescar_cupo()
+        hilos = sum(max(1, token.concurrencia) for token in self.tokens)
+        for _ in range(hilos):
+            self._hilos.append(threading.Thread(target=self._trabajar, daemon=True))
+        self._vivos = len(self._hilos)
+        self._sin_hilos = not self._hilos
+        for hilo in self._hilos:
+            hilo.start()
+        return self
+
+    def enviar(self, idx, _id):
+        with self._lock:
+            if self._sin_hilos:
+                self._salida.put(self._resultado(idx, _id, None, "Agotado"))
+            else:
+                self._entrada.put((idx, _id, 0, None))
+
+    def cerrar(self):
+        """Indica que no se enviarán más cédulas: los hilos salen al vaciar la cola."""
+        self._cerrado = True
+
+    def recibir(self, timeout=None):
+        """Retorna el siguiente resultado o lanza queue.Empty si vence el timeout."""
+        return self._salida.get(timeout=timeout)
+
+    def detener(self):
+        """Parada cooperativa: las consultas en vuelo terminan, el resto sale como "Agotado"."""
+        self._detener.set()
+
+    # --- Internos ---
+
+    def _resultado(self, idx, _id, nombre, status, error=None):
+        METRICAS.contar("motor_resultados_total", estado=status)
+        return {"idx": idx, "cedula": _id, "nombre": nombre, "status": status, "error": error}
+
+    def _tomar(self):
+        while not self._detener.is_set():
+            try:
+                return self._entrada.get(timeout=0.05)
+            except queue.Empty:
+                if self._cerrado:
+                    return None
+        return None
+
+    def _trabajar(self):
+        try:
+            while not self._detener.is_set():
+                item = self._tomar()
+                if item is None:
+                    break
+                # 1. Si otra consulta ya está pidiendo esta cédula, esperar la suya
+                idx, _id, _, evitar = item
+                futuro, lider = COALESCEDOR.unirse(_id)
+                if not lider:
+                    compartido = futuro.result()
+                    if compartido is None:
+                        self._entrada.put(item)
+                    else:
+                        self._salida.put(self._resultado(idx, _id, *compartido))
+                    continue
+                resultado = None
+                try:
+                    # 2. El planificador elige token y reserva cupo
+                    token, motivo = self.planificador.adquirir(evitar)
+                    if token is None:
+                        resultado = self._resultado(idx, _id, None, "Agotado" if motivo == "Agotado" else "Error",
+                                                    None if motivo == "Agotado" else motivo)
+                    else:
+                        # 3. Respetar el ritmo del token y consultar
+                        try:
+                            token.esperar_turno()
+                            resultado = self._consultar(item, token)
+                        finally:
+                            self.planificador.soltar(token)
+                except Exception as e:
+                    # Cualquier otra falla (p. ej. el caché no pudo escribir) sale como
+                    # "Error": si el hilo muriera sin resultado, quien espera se colgaría
+                    print(f"Error en ID {_id}: {e}")
+                    resultado = self._resultado(idx, _id, None, "Error", type(e).__name__)
+                finally:
+                    COALESCEDOR.resolver(_id, None if resultado is None else
+                                         (resultado["nombre"], resultado["status"], resultado["error"]))
+                if resultado is not None:
+                    self._salida.put(resultado)
+        finally:
+            self._retirar_hilo()
+
+    def _consultar(self, item, token):
+        idx, _id, intentos, _ = item
+        inicio = time.perf_counter()
+        try:
+            params = token.get_credentials()
+            nacionalidad, numero = separar_cedula(_id)
+            params.update({"cedula": numero, "nacionalidad": nacionalidad})
+            respuesta = consultar_api(params)
+            nombre_api = parse_api_response(respuesta.datos) if respuesta.estado == ENCONTRADO else None
+        except Exception as e:
+            token.liberar()
+            self.planificador.registrar(token, ERROR_TRANSPORTE, time.perf_counter() - inicio)
+            print(f"Error en ID {_id}: {e}")
+            return self._resultado(idx, _id, None, "Error", type(e).__name__)
+        self.planificador.registrar(token, respuesta.estado, time.perf_counter() - inicio)
+
+        if respuesta.estado == LIMITADO:
+            # El proveedor frenó este token: se enfría y la cédula vuelve a la cola
+            token.liberar()
+            token.enfriar(respuesta.retry_after or BACKOFF_BASE * 2 ** intentos)
+            if intentos < self.reintentos:
+                self._entrada.put((idx, _id, intentos + 1, token.clave))
+                return None
+            return self._resultado(idx, _id, None, "Error", LIMITADO)
+
+        if respuesta.estado == ERROR_TRANSPORTE or respuesta.status_code in CODIGOS_TOKEN:
+            # Falla del token (credencial revocada, servidor o red de su lado): otro token puede responder
+            token.liberar()
+            if intentos < self.reintentos:
+                self._entrada.put((idx, _id, intentos + 1, token.clave))
+                return None
+            print(f"Error en ID {_id}: {respuesta.estado} {respuesta.detalle}")
+            return self._resultado(idx, _id, None, "Error", respuesta.estado)
+
+        if respuesta.estado == RECHAZADO:
+            token.liberar()
+            print(f"Error en ID {_id}: {respuesta.estado} {respuesta.detalle}")
+            return self._resultado(idx, _id, None, "Error", respuesta.estado)
+
+        if not nombre_api:
+            token.liberar()
+            if self.cache_negativa is not None:
+                self.cache_negativa.registrar(_id)
+            return self._resultado(idx, _id, None, "No existe")
+
+        self.cache_dict[_id] = nombre_api
+        add_to_historic(json.dumps({"cedula": _id, "nombre": nombre_api}))
+        return self._resultado(idx, _id, nombre_api, "API")
+
+    def _retirar_hilo(self):
+        # El último hilo en salir devuelve lo que quedó en cola como "Agotado"
+        with self._lock:
+            self._vivos -= 1
+            if self._vivos > 0:
+                return
+            self._sin_hilos = True
+            while True:
+                try:
+                    item = self._entrada.get_nowait()
+                except queue.Empty:
+                    break
+                self._salida.put(self._resultado(item[0], item[1], None, "Agotado"))
+
+
+def manage_api_requests(non_cached_ids, tokens, cache_dict, cache_negativa=None):
+    """
+    EL MOTOR: Reparte las cédulas entre todos los tokens en paralelo
+    (ver MotorConsultas) y deja en la cola de reintentos lo que no se pudo
+    procesar (con su clase de error). Retorna las encontradas ("API") y las
+    inexistentes ("No existe").
+    """
+    results = []
+    fallos = []
+    respuestas = [None] * len(non_cached_ids)
+
+    motor = MotorConsultas(tokens, cache_dict, cache_negativa=cache_negativa).iniciar()
+    try:
+        for i, _id in enumerate(non_cached_ids):
+            motor.enviar(i, _id)
+        motor.cerrar()
+        for _ in non_cached_ids:
+            r = motor.recibir()
+            respuestas[r["idx"]] = r
+    finally:
+        motor.detener()
+
+    # Se devuelven en el mismo orden de entrada
+    for r in respuestas:
+        if r["status"] in ("API", "No existe"):
+            results.append({"cedula": r["cedula"], "nombre": r["nombre"], "status": r["status"]})
+        elif r["status"] in ("Agotado", "Error"):
+            fallos.append((r["cedula"], r["error"] or r["status"]))
+
+    cola = obtener_cola()
+    cola.encolar(fallos)
+    cola.quitar(r["cedula"] for r in results)
+    return results
+
+
+# --- DRENADO DE LA COLA DE REINTENTOS ---
+
+def drenar_cola(tokens, cache_dict, cache_negativa=None, limite=DRENADO_LOTE, cola=None):
+    """
+    Una ronda de reintentos: toma hasta `limite` cédulas ya listas (nunca más
+    que el cupo que queda), descarta las que ya se resolvieron y consulta el
+    resto. Lo que vuelve a fallar se re-encola con más espera.
+    Retorna la cantidad de cédulas resueltas.
+    """
+    cola = cola or obtener_cola()
+    cupo = sum(max(t.capacity - t.current_usage, 0) for t in tokens)
+    if not cupo:
+        return 0
+    listas = cola.listas(min(limite, cupo))
+    if not listas:
+        return 0
+    pendientes = cola.depurar(listas, cache_dict, cache_negativa)
+    resueltas = len(listas) - len(pendientes)
+    if pendientes:
+        resueltas += len(manage_api_requests(pendientes, tokens, cache_dict, cache_negativa))
+    METRICAS.contar("cola_reintentos_resueltas_total", resueltas)
+    METRICAS.fijar("cola_reintentos_pendientes", len(cola))
+    return resueltas
+
+
+class DrenadorCola():
+    """
+    Hilo que cada `intervalo` segundos corre drenar_cola mientras haya cupo:
+    la cola se vacía sola cuando el proveedor renueva los tokens.
+    """
+    def __init__(self, tokens, cache_dict, cache_negativa=None, intervalo=DRENADO_INTERVALO, cola=None):
+        self.tokens = tokens
+        self.cache_dict = cache_dict
+        self.cache_negativa = cache_negativa
+        self.intervalo = intervalo
+        self.cola = cola or obtener_cola()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._ejecutar, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._detener.set()
+
+    def _ejecutar(self):
+        while not self._detener.wait(self.intervalo):
+            try:
+                # Rondas seguidas mientras haya listas y cupo; después, a esperar
+                while not self._detener.is_set() and drenar_cola(
+                        self.tokens, self.cache_dict, self.cache_negativa, cola=self.cola):
+                    pass
+            except Exception as e:
+                print(f"Error drenando la cola de reintentos: {e}")
@@ -0,0 +1,162 @@
+"""
+Archivos en disco: rutas por defecto, conexión SQLite compartida entre
+procesos, escritura diferida del histórico y escritura atómica.
+"""
+
+import atexit
+import sqlite3
+import threading
+import os
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+
+# --- PERSISTENCIA ---
+HISTORIC_PATH = "historic.jsonl"
+PENDIENTES_PATH = "pendientes.jsonl"
+LEDGER_PATH = "cuotas.sqlite3"
+STORE_PATH = "identidades.sqlite3"
+NEGATIVOS_PATH = "no_encontrados.sqlite3"
+COLA_PATH = "reintentos.sqlite3"
+
+# Escritura diferida del histórico: se vuelca al juntar HISTORICO_MAX_LINEAS,
+# cada HISTORICO_INTERVALO segundos y al cerrar el proceso.
+# FSYNC_POLITICA: "siempre" (cada volcado), "intervalo" (solo en el volcado
+# periódico y al cerrar) o "nunca" (lo decide el sistema operativo).
+HISTORICO_MAX_LINEAS = 500
+HISTORICO_INTERVALO = 2.0
+FSYNC_POLITICA = "intervalo"
+
+
+# --- SQLITE ---
+
+def _conectar_sqlite(ruta):
+    """Conexión SQLite en modo WAL, pensada para varios procesos escribiendo a la vez."""
+    conn = sqlite3.connect(ruta, timeout=30, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class BaseSQLite():
+    """
+    Base de los almacenes en SQLite: una conexión por hilo sobre `ruta` y
+    consultas `IN (...)` partidas en bloques de TAMANO_LOTE_SQL parámetros.
+    """
+    TAMANO_LOTE_SQL = 900   # por debajo del límite de parámetros de SQLite
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self._local = threading.local()
+
+    def _conexion(self):
+        # Una conexión por hilo: sqlite3 no comparte bien conexiones entre hilos
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = _conectar_sqlite(self.ruta)
+        return conn
+
+    def _bloques(self, cedulas):
+        """Reparte las cédulas en bloques: (bloque, marcas "?,?,..." para el IN)."""
+        cedulas = [str(c) for c in cedulas]
+        for i in range(0, len(cedulas), self.TAMANO_LOTE_SQL):
+            bloque = cedulas[i:i + self.TAMANO_LOTE_SQL]
+            yield bloque, ",".join("?" * len(bloque))
+
+
+# --- ESCRITURA DIFERIDA ---
+
+class EscritorDiferido():
+    """
+    Escritor write-behind para archivos JSONL de solo anexar.
+    Junta las líneas en memoria y las escribe en bloque (una sola llamada a
+    write, con flock entre procesos) al llegar a `max_lineas`, cada `intervalo`
+    segundos y al terminar el proceso. Así ninguna línea queda a medias ni se
+    mezcla con la de otra sesión.
+    """
+    def __init__(self, ruta, max_lineas=HISTORICO_MAX_LINEAS, intervalo=HISTORICO_INTERVALO, fsync=FSYNC_POLITICA):
+        self.ruta = ruta
+        self.max_lineas = max_lineas
+        self.intervalo = intervalo
+        self.fsync = fsync
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._lock_escritura = threading.Lock()
+        self._cerrado = threading.Event()
+        self._hilo = threading.Thread(target=self._vaciar_periodicamente, daemon=True)
+        self._hilo.start()
+        atexit.register(self.cerrar)
+
+    def escribir(self, linea):
+        with self._lock:
+            self._buffer.append(linea)
+            lleno = len(self._buffer) >= self.max_lineas
+        if lleno:
+            self.vaciar()
+
+    def vaciar(self, sincronizar=None):
+        """Escribe lo acumulado. `sincronizar` fuerza (o evita) el fsync."""
+        with self._lock_escritura:
+            with self._lock:
+                lineas, self._buffer = self._buffer, []
+            if not lineas:
+                return
+            if sincronizar is None:
+                sincronizar = self.fsync == "siempre"
+            datos = "".join(linea + "\n" for linea in lineas)
+            with open(self.ruta, "a", encoding="utf-8") as file:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                file.write(datos)
+                file.flush()
+                if sincronizar:
+                    os.fsync(file.fileno())
+
+    def cerrar(self):
+        self._cerrado.set()
+        self.vaciar(sincronizar=self.fsync != "nunca")
+
+    def _vaciar_periodicamente(self):
+        while not self._cerrado.wait(self.intervalo):
+            try:
+                self.vaciar(sincronizar=self.fsync != "nunca")
+            except Exception as e:
+                print(f"Error volcando {self.ruta}: {e}")
+
+
+_escritores = {}
+_escritores_lock = threading.Lock()
+
+
+def obtener_escritor(ruta):
+    """Un EscritorDiferido por archivo y por proceso."""
+    with _escritores_lock:
+        escritor = _escritores.get(ruta)
+        if escritor is None:
+            escritor = _escritores[ruta] = EscritorDiferido(ruta)
+        return escritor
+
+
+def vaciar_escritores():
+    """Fuerza el volcado de todo lo pendiente (p. ej. antes de leer el histórico)."""
+    with _escritores_lock:
+        escritores = list(_escritores.values())
+    for escritor in escritores:
+        escritor.vaciar()
+
+
+def escribir_atomico(ruta, lineas, fsync=FSYNC_POLITICA):
+    """Reescribe un archivo completo vía archivo temporal + rename: nunca queda a medias."""
+    tmp = f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as file:
+        file.write("".join(linea + "\n" for linea in lineas))
+        file.flush()
+        if fsync != "nunca":
+            os.fsync(file.fileno())
+    os.replace(tmp, ruta)
+
+
+def add_to_historic(json_line, historial_path=HISTORIC_PATH):
+    obtener_escritor(historial_path).escribir(json_line)
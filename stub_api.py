@@ -0,0 +1,185 @@
+"""
+Imitación local de la API de cédulas para pruebas y benchmarks (sin red).
+
+Responde con el mismo esquema que https://api.cedula.com.ve/api/v1 y permite
+simular latencia, respuestas 429 / 5xx, cédulas inexistentes y el cupo de
+cada token.
+
+    python stub_api.py --puerto 8765 --latencia lognormal:-3,0.5 --tasa-429 0.02
+
+Desde código:
+
+    servidor = ServidorStub(latencia="fija:0.01", cuota=1000).iniciar()
+    motor.API_URL = servidor.url
+    ...
+    servidor.detener()
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+NOMBRES = ["JOSE", "MARIA", "LUIS", "ANA", "CARLOS", "CARMEN", "PEDRO", "ROSA", "JUAN", "LUISA",
+           "MIGUEL", "ELENA", "ANDRES", "SOFIA", "RAFAEL", "GABRIELA", "DANIEL", "VALENTINA"]
+APELLIDOS = ["PEREZ", "GONZALEZ", "RODRIGUEZ", "HERNANDEZ", "GARCIA", "MARTINEZ", "LOPEZ",
+             "RAMIREZ", "SANCHEZ", "TORRES", "DIAZ", "MORENO", "ROJAS", "MENDOZA", "CASTILLO"]
+
+
+def nombre_de(cedula):
+    """Nombre ficticio pero estable para cada cédula (misma cédula, mismo nombre)."""
+    h = hashlib.sha256(str(cedula).encode()).digest()
+    return {
+        "primer_nombre": NOMBRES[h[0] % len(NOMBRES)],
+        "segundo_nombre": NOMBRES[h[1] % len(NOMBRES)],
+        "primer_apellido": APELLIDOS[h[2] % len(APELLIDOS)],
+        "segundo_apellido": APELLIDOS[h[3] % len(APELLIDOS)],
+    }
+
+
+def crear_latencia(spec):
+    """
+    Convierte "fija:0.05", "uniforme:0.01,0.2", "exponencial:0.05" o
+    "lognormal:mu,sigma" en una función que devuelve segundos.
+    """
+    tipo, _, valores = str(spec).partition(":")
+    params = [float(v) for v in valores.split(",") if v]
+    if tipo == "fija":
+        return lambda: params[0]
+    if tipo == "uniforme":
+        return lambda: random.uniform(params[0], params[1])
+    if tipo == "exponencial":
+        return lambda: random.expovariate(1 / params[0])
+    if tipo == "lognormal":
+        return lambda: random.lognormvariate(params[0], params[1])
+    raise ValueError(f"Latencia desconocida: {spec}")
+
+
+class ServidorStub():
+    """
+    Servidor HTTP en un hilo. Cada petición espera la latencia sorteada y
+    luego, en este orden: 429 con probabilidad `tasa_429`, 5xx con `tasa_5xx`,
+    429 con Retry-After largo si el token ya gastó su `cuota`, "no existe" con
+    `tasa_no_existe` (estable por cédula) y si no, la persona (la única
+    respuesta que descuenta cupo).
+    `degradados` simula tokens en mal estado: {app_id: {"latencia": s, "tasa_5xx": p}}
+    suma latencia y fallos solo a las peticiones de ese app_id, y
+    {app_id: {"status": 401}} lo rechaza siempre (token revocado).
+    """
+    def __init__(self, puerto=0, latencia="fija:0", tasa_429=0.0, tasa_5xx=0.0, tasa_no_existe=0.0,
+                 cuota=None, retry_after=1, semilla=None, degradados=None):
+        self.latencia = crear_latencia(latencia)
+        self.tasa_429 = tasa_429
+        self.tasa_5xx = tasa_5xx
+        self.tasa_no_existe = tasa_no_existe
+        self.cuota = cuota
+        self.retry_after = retry_after
+        self.degradados = degradados or {}
+        self.uso = {}          # (app_id, token) -> consultas cobradas
+        self.contadores = {"peticiones": 0, "200": 0, "404": 0, "429": 0, "cuota": 0, "5xx": 0}
+        self._lock = threading.Lock()
+        self._azar = random.Random(semilla)
+        self._http = ThreadingHTTPServer(("127.0.0.1", puerto), self._manejador())
+        self._http.daemon_threads = True
+        self._hilo = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._http.server_address[1]}/api/v1"
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._http.serve_forever, daemon=True)
+        self._hilo.start()
+        return self
+
+    def detener(self):
+        self._http.shutdown()
+        self._http.server_close()
+
+    def reiniciar_contadores(self):
+        with self._lock:
+            self.uso.clear()
+            for clave in self.contadores:
+                self.contadores[clave] = 0
+
+    def responder(self, params):
+        """Decide (status, cuerpo, cabeceras) para una petición."""
+        cedula = params.get("cedula", "")
+        clave = (params.get("app_id", ""), params.get("token", ""))
+        with self._lock:
+            self.contadores["peticiones"] += 1
+            sorteo = self._azar.random()
+            degradado = self.degradados.get(clave[0], {})
+            if "status" in degradado:
+                return degradado["status"], {"error": True, "error_str": "Token inválido"}, {}
+            if degradado and self._azar.random() < degradado.get("tasa_5xx", 0):
+                self.contadores["5xx"] += 1
+                return 503, {"error": True, "error_str": "Service Unavailable"}, {}
+            if sorteo < self.tasa_429:
+                self.contadores["429"] += 1
+                return 429, {"error": True, "error_str": "Too Many Requests"}, {"Retry-After": str(self.retry_after)}
+            if sorteo < self.tasa_429 + self.tasa_5xx:
+                self.contadores["5xx"] += 1
+                return 503, {"error": True, "error_str": "Service Unavailable"}, {}
+            if self.cuota is not None and self.uso.get(clave, 0) >= self.cuota:
+                self.contadores["cuota"] += 1
+                return 429, {"error": True, "error_str": "Cuota agotada"}, {"Retry-After": "3600"}
+            # Como asume el motor, solo se cobran las consultas que encuentran a la persona
+            if int(hashlib.sha256(f"no-{cedula}".encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < self.tasa_no_existe:
+                self.contadores["404"] += 1
+                return 200, {"error": True, "error_str": "Cédula no encontrada", "data": None}, {}
+            self.uso[clave] = self.uso.get(clave, 0) + 1
+            self.contadores["200"] += 1
+        datos = {"nacionalidad": params.get("nacionalidad", "V"), "cedula": cedula, **nombre_de(cedula)}
+        return 200, {"error": False, "data": datos}, {}
+
+    def _manejador(self):
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, como la API real
+
+            def do_GET(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                extra = servidor.degradados.get(params.get("app_id"), {}).get("latencia", 0)
+                time.sleep(max(servidor.latencia(), 0) + extra)
+                status, cuerpo, cabeceras = servidor.responder(params)
+                datos = json.dumps(cuerpo).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                for nombre, valor in cabeceras.items():
+                    self.send_header(nombre, valor)
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def log_message(self, *args):
+                pass
+
+        return Manejador
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API de cédulas simulada.")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia", default="fija:0.05", help="fija:s | uniforme:a,b | exponencial:media | lognormal:mu,sigma")
+    parser.add_argument("--tasa-429", type=float, default=0.0)
+    parser.add_argument("--tasa-5xx", type=float, default=0.0)
+    parser.add_argument("--tasa-no-existe", type=float, default=0.0)
+    parser.add_argument("--cuota", type=int, default=None, help="consultas por token antes de responder 429")
+    args = parser.parse_args(argv)
+    servidor = ServidorStub(args.puerto, args.latencia, args.tasa_429, args.tasa_5xx,
+                            args.tasa_no_existe, args.cuota).iniciar()
+    print(f"API simulada en {servidor.url} (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        servidor.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import csv
+import os
+import tempfile
+from collections import Counter
+
+import cli
+import motor
+from stub_api import ServidorStub
+
+SECRETS = """[[tokens]]
+token = "prueba"
+app_id = "1"
+capacity = {capacidad}
+intervalo = 0
+"""
+
+
+def escribir_entrada(ruta, filas=200):
+    # Cédulas válidas, repetidas (en el mismo bloque y en bloques lejanos), rechazadas y vacías.
+    # Retorna cuántas filas no vacías escribió
+    no_vacias = 0
+    with open(ruta, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["cedula"])
+        for i in range(filas):
+            if i % 17 == 0:
+                writer.writerow(["123456"])
+            elif i % 23 == 0:
+                writer.writerow([""])
+            elif i % 7 == 0:
+                writer.writerow([f"V-{10_000_000 + i // 3}"])
+            else:
+                writer.writerow([str(10_000_000 + i)])
+            no_vacias += i % 17 == 0 or i % 23 != 0
+    return no_vacias
+
+
+def leer_salida(ruta):
+    with open(ruta, encoding="utf-8", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def correr(capacidad, entrada, salida, extra=()):
+    with open(os.path.join(".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.write(SECRETS.format(capacidad=capacidad))
+    return cli.main([entrada, salida, "--columna", "cedula", "--checkpoint-cada", "30", *extra])
+
+
+def test_reanudar_tras_agotar():
+    # Agotar el cupo a mitad de la lista y reanudar debe dar las mismas filas que una corrida de corrido
+    origen = os.getcwd()
+    servidor = ServidorStub(latencia="fija:0", tasa_no_existe=0.05).iniciar()
+    url = motor.API_URL
+    motor.API_URL = servidor.url
+    try:
+        for extra in ((), ("--procesos", "1")):
+            with tempfile.TemporaryDirectory() as tmp:
+                os.chdir(tmp)
+                os.makedirs(".streamlit")
+                esperadas = escribir_entrada("entrada.csv")
+
+                assert correr(60, "entrada.csv", "salida.csv", extra) == cli.SALIDA_AGOTADO
+                assert correr(100_000, "entrada.csv", "salida.csv", extra) == cli.SALIDA_OK
+                reanudada = leer_salida("salida.csv")
+
+                # De corrido, sin caché ni consumo previo
+                for archivo in ("identidades.sqlite3", "no_encontrados.sqlite3", "cuotas.sqlite3"):
+                    if os.path.exists(archivo):
+                        os.remove(archivo)
+                assert correr(100_000, "entrada.csv", "completa.csv", extra) == cli.SALIDA_OK
+                completa = leer_salida("completa.csv")
+
+                assert len(reanudada) == len(completa) == esperadas
+                assert Counter(f["Cédula"] for f in reanudada) == Counter(f["Cédula"] for f in completa)
+                assert Counter(f["Fuente"] == "Repetida" for f in reanudada) == Counter(
+                    f["Fuente"] == "Repetida" for f in completa)
+                assert cli.cargar_checkpoint("salida.csv")["procesadas"] == len(reanudada)
+                os.chdir(origen)
+    finally:
+        os.chdir(origen)
+        motor.API_URL = url
+        servidor.detener()
+    print("✅ Reanudar tras agotar el cupo: mismas filas que de corrido.")
+
+
+if __name__ == "__main__":
+    test_reanudar_tras_agotar()
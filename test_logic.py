@@ -1,48 +1,5 @@
 import pandas as pd
-import unicodedata
-import re
-
-# --- TU LÓGICA DE CONTENCIÓN ---
-def normalizar_sustituir(texto):
-    """Limpia tildes, caracteres especiales y vectoriza palabras."""
-    if not texto or pd.isna(texto): return set()
-    # 1. Quitar tildes
-    texto = unicodedata.normalize('NFD', str(texto))
-    texto = "".join([c for c in texto if unicodedata.category(c) != 'Mn'])
-    # 2. Mayúsculas y limpiar basura
-    texto = re.sub(r'[^A-Z0-9\s]', '', texto.upper())
-    # 3. Vectorizar (Palabras de más de 2 letras o conectores clave)
-    palabras = [p for p in texto.split() if len(p) > 2 or p in ["DE", "LA"]]
-    return set(palabras)
-
-def clasificador_contencion(row):
-    nombre_usuario = row['Tu Lista']
-    nombre_api = row['Nombre API']
-    
-    if not nombre_api or nombre_api == "NO ENCONTRADO":
-        return "NO ENCONTRADO", 0, ""
-
-    tokens_u = normalizar_sustituir(nombre_usuario)
-    tokens_a = normalizar_sustituir(nombre_api)
-    
-    if not tokens_u:
-        return "ERROR INPUT", 0, ""
-
-    # Lógica de contención
-    encontrados = [p for p in tokens_u if p in tokens_a]
-    faltantes = [p for p in tokens_u if p not in tokens_a]
-    
-    porcentaje = len(encontrados) / len(tokens_u)
-    
-    # Clasificación
-    if porcentaje == 1.0:
-        res = "IGUAL"
-    elif porcentaje >= 0.5:
-        res = "REVISAR"
-    else:
-        res = "DIFERENTE"
-        
-    return res, int(porcentaje * 100), ", ".join(faltantes)
+from utils import clasificador_contencion, comparar_nombres_lote
 
 # --- EJECUCIÓN DEL TEST ---
 def run_test():
@@ -55,10 +12,14 @@ def run_test():
 
     print(f"Analizando {len(df)} registros con la nueva lógica...\n")
 
-    # 2. Aplicar el clasificador
-    df[['Nuevo Resultado', 'Confianza %', 'Faltó en API']] = df.apply(
-        lambda row: pd.Series(clasificador_contencion(row)), axis=1
-    )
+    # 2. Aplicar el clasificador (en lote, toda la columna a la vez)
+    lote = comparar_nombres_lote(df['Tu Lista'], df['Nombre API'])
+    df[['Nuevo Resultado', 'Confianza %', 'Faltó en API']] = lote
+
+    # El lote debe dar exactamente lo mismo que la versión fila a fila
+    fila_a_fila = df.apply(lambda row: pd.Series(clasificador_contencion(row)), axis=1)
+    assert (fila_a_fila[0] == lote['Resultado']).all()
+    assert (fila_a_fila[1] == lote['Confianza %']).all()
 
     # 3. Mostrar casos que ANTES fallaban y AHORA son IGUAL
     # (Filtramos donde tu archivo viejo decía REVISAR/DIFERENTE pero el nuevo dice IGUAL)
@@ -74,5 +35,19 @@ def run_test():
     df.to_csv('test_mejorado.csv', index=False)
     print("\n🚀 Archivo 'test_mejorado.csv' generado para revisión.")
 
+def test_nombres_repetidos():
+    # El mismo nombre de tu lista contra nombres distintos de la API (y uno sin respuesta)
+    df = pd.DataFrame({
+        'Tu Lista': ['JUAN PEREZ', 'JUAN PEREZ', 'JUAN PEREZ', 'MARIA DIAZ'],
+        'Nombre API': ['JUAN PEREZ', 'PEDRO DIAZ', 'NO ENCONTRADO', 'MARIA DIAZ'],
+    })
+    lote = comparar_nombres_lote(df['Tu Lista'], df['Nombre API'])
+    fila_a_fila = df.apply(lambda row: pd.Series(clasificador_contencion(row)), axis=1)
+    assert list(lote['Resultado']) == ['IGUAL', 'DIFERENTE', 'NO ENCONTRADO', 'IGUAL']
+    assert (fila_a_fila[0] == lote['Resultado']).all()
+    assert (fila_a_fila[1] == lote['Confianza %']).all()
+    print("✅ Nombres repetidos: mismo veredicto que fila a fila.")
+
 if __name__ == "__main__":
-    run_test()
\ No newline at end of file
+    run_test()
+    test_nombres_repetidos()
\ No newline at end of file
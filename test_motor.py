@@ -0,0 +1,189 @@
+import contextlib
+import os
+import tempfile
+import threading
+import time
+
+import motor
+import utils
+from stub_api import ServidorStub, nombre_de
+
+
+@contextlib.contextmanager
+def entorno(**kwargs):
+    # Directorio temporal (historic.jsonl, SQLite) y la API simulada con planificadores limpios
+    origen = os.getcwd()
+    url = motor.API_URL
+    servidor = ServidorStub(**kwargs).iniciar()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        motor.API_URL = servidor.url
+        utils.descartar_planificadores()
+        try:
+            yield servidor
+        finally:
+            utils.vaciar_escritores()
+            os.chdir(origen)
+            motor.API_URL = url
+            servidor.detener()
+
+
+def crear_tokens(cantidad, capacidad=1000, ledger=None):
+    return [utils.Token(f"token{i}", f"app{i}", capacity=capacidad, intervalo=0, ledger=ledger)
+            for i in range(cantidad)]
+
+
+def correr_motor(tokens, ids, cache):
+    consultas = utils.MotorConsultas(tokens, cache).iniciar()
+    try:
+        for i, _id in enumerate(ids):
+            consultas.enviar(i, _id)
+        consultas.cerrar()
+        return sorted((consultas.recibir(timeout=30) for _ in ids), key=lambda r: r["idx"])
+    finally:
+        consultas.detener()
+
+
+def esperar(condicion, limite=30):
+    fin = time.monotonic() + limite
+    while not condicion():
+        assert time.monotonic() < fin, "se venció la espera"
+        time.sleep(0.02)
+
+
+def test_validar_cedula_bordes():
+    casos = {
+        "V-12.345.678": ("12345678", None),
+        " v 1234567 ": ("1234567", None),
+        "12345678.0": ("12345678", None),
+        "0012345678": ("12345678", None),
+        "E-81.234.567": ("E81234567", None),
+        "E81234567": ("E81234567", None),     # una clave ya validada da la misma clave
+        "": ("", "vacía"),
+        "nan": ("nan", "vacía"),
+        None: ("", "vacía"),
+        "J-12345678": ("J-12345678", "nacionalidad no admitida"),
+        "12a45678": ("12a45678", "formato inválido"),
+        "99999": ("99999", "fuera de rango"),
+        "100000000": ("100000000", "fuera de rango"),
+        "100000": ("100000", None),           # límites del rango incluidos
+        "99.999.999": ("99.999.999", "patrón inválido"),   # rechazada: queda el valor original
+        "11111111": ("11111111", "patrón inválido"),
+        "123456": ("123456", "patrón inválido"),
+    }
+    for valor, esperado in casos.items():
+        assert utils.validar_cedula(valor) == esperado, (valor, utils.validar_cedula(valor))
+
+    # El lote da lo mismo que valor por valor
+    claves, rechazos = utils.validar_cedulas_lote(list(casos))
+    assert claves == [clave for clave, _ in casos.values()]
+    assert rechazos == {clave: motivo for clave, motivo in casos.values() if motivo}
+    print("✅ validar_cedula: bordes y lote.")
+
+
+def test_ledger_reservar():
+    with tempfile.TemporaryDirectory() as tmp:
+        ruta = os.path.join(tmp, "cuotas.sqlite3")
+        token = utils.Token("t", "a", capacity=3, ledger=utils.LedgerCuotas(ruta))
+        assert [token.reservar() for _ in range(4)] == [True, True, True, False]
+        token.liberar()
+        assert token.reservar() and not token.reservar()
+
+        # Otro proceso (otro ledger sobre el mismo archivo) ve el mismo consumo
+        otro = utils.Token("t", "a", capacity=3, ledger=utils.LedgerCuotas(ruta))
+        assert otro.current_usage == 3 and not otro.has_capacity()
+
+        # Muchos hilos a la vez nunca pasan del cupo
+        token = utils.Token("u", "a", capacity=50, ledger=utils.LedgerCuotas(ruta))
+        logrados = []
+
+        def reservar():
+            for _ in range(20):
+                if token.reservar():
+                    logrados.append(1)
+
+        hilos = [threading.Thread(target=reservar) for _ in range(8)]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        assert len(logrados) == 50 and token.current_usage == 50
+    print("✅ LedgerCuotas.reservar: atómico y compartido.")
+
+
+def test_cola_reintentos_backoff():
+    with tempfile.TemporaryDirectory() as tmp:
+        cola = utils.ColaReintentos(os.path.join(tmp, "reintentos.sqlite3"), os.path.join(tmp, "pendientes.jsonl"))
+        for intentos in range(1, 12):
+            paso = min(utils.REINTENTO_MAX, utils.REINTENTO_BASE * 2 ** (intentos - 1))
+            assert paso / 2 <= cola.espera(intentos) <= paso
+
+        ahora = time.time()
+        cola.encolar([("10000001", "Error"), ("10000002", "Agotado")])
+        # Un error espera al menos medio paso; un agotado vuelve en la ronda de drenado
+        assert "10000001" not in cola.listas(ahora=ahora + utils.REINTENTO_BASE / 2 - 1)
+        assert "10000001" in cola.listas(ahora=ahora + utils.REINTENTO_BASE + 1)
+        assert "10000002" in cola.listas(ahora=ahora + utils.DRENADO_INTERVALO + 1)
+
+        # Pasado REINTENTOS_MAX queda retenida hasta liberarla a mano
+        for _ in range(utils.REINTENTOS_MAX - 1):
+            cola.encolar([("10000001", "Error")])
+        assert cola.resumen()["retenidas"] == 1
+        assert "10000001" not in cola.listas(ahora=ahora + 10 * utils.REINTENTO_MAX)
+        cola.liberar_retenidas()
+        assert "10000001" in cola.listas()
+
+        cola.quitar(["10000001", "10000002"])
+        assert len(cola) == 0
+    print("✅ ColaReintentos: backoff, retenidas y quitar.")
+
+
+def test_motor_consultas():
+    ids = [str(10_000_000 + i) for i in range(120)]
+    # Un token revocado (401) y un servidor con 5xx: todo sale por los otros tokens
+    with entorno(tasa_5xx=0.05, tasa_no_existe=0.1, semilla=3, degradados={"app0": {"status": 401}}):
+        cache = {}
+        resultados = correr_motor(crear_tokens(3), ids, cache)
+        assert [r["idx"] for r in resultados] == list(range(len(ids)))
+        assert {r["status"] for r in resultados} <= {"API", "No existe"}, {r["status"] for r in resultados}
+        for r in resultados:
+            if r["status"] == "API":
+                assert r["nombre"] == " ".join(nombre_de(r["cedula"]).values())
+                assert cache[r["cedula"]] == r["nombre"]
+
+    # Con el cupo de todos los tokens gastado, el resto sale "Agotado" (sin colgarse)
+    with entorno():
+        resultados = correr_motor(crear_tokens(2, capacidad=10), ids[:50], {})
+        estados = [r["status"] for r in resultados]
+        assert estados.count("API") == 20 and estados.count("Agotado") == 30
+    print("✅ MotorConsultas: reintenta en otro token y respeta el cupo.")
+
+
+def test_trabajo_detener_reanudar():
+    ids = [str(10_000_000 + i) for i in range(80)]
+    with entorno(latencia="fija:0.01"):
+        bloques = [(ids[:40], {}), (ids[40:] + ids[:5], {})]
+        trabajo = utils.TrabajoLote(bloques, crear_tokens(1), {}, total=85).iniciar()
+        esperar(lambda: trabajo.procesados >= 10)
+        trabajo.detener()
+        esperar(lambda: not trabajo.activo)
+        assert trabajo.estado == utils.TrabajoLote.DETENIDO
+        entregadas = len(trabajo.resultados)
+        assert entregadas < 85
+
+        trabajo.reanudar()
+        esperar(lambda: trabajo.estado == utils.TrabajoLote.TERMINADO)
+        filas = trabajo.resultados
+        assert len(filas) == 85 and trabajo.procesados == 85
+        # Cada cédula una sola vez como resultado; las repetidas del segundo bloque como "Repetida"
+        assert sorted(f["Cédula"] for f in filas if f["Fuente"] != "Repetida") == sorted(ids)
+        assert sum(f["Fuente"] == "Repetida" for f in filas) == 5
+    print("✅ TrabajoLote: detener y reanudar sin perder ni repetir filas.")
+
+
+if __name__ == "__main__":
+    test_validar_cedula_bordes()
+    test_ledger_reservar()
+    test_cola_reintentos_backoff()
+    test_motor_consultas()
+    test_trabajo_detener_reanudar()
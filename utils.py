@@ -1,165 +1,223 @@
+import codecs
+import csv
+import functools
+import hashlib
+import itertools
 import json
-import requests
+import multiprocessing
+import queue
+import threading
+import sys
 import time
 import os 
+import numpy as np
+import pandas as pd
 from fuzzywuzzy import fuzz
-import toml
 import unicodedata
-import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 
+# Almacén, motor de consultas, métricas y exportación viven en sus módulos;
+# aquí se re-exporta lo que app.py, cli.py y las pruebas importan de utils.
+import motor
+from almacen import (
+    CACHE_COMPACTA,
+    DRENADO_INTERVALO,
+    REINTENTO_BASE,
+    REINTENTO_MAX,
+    REINTENTOS_MAX,
+    AlmacenIdentidades,
+    CacheCompacta,
+    CacheNegativa,
+    ColaReintentos,
+    LedgerCuotas,
+    buscar_en_cache,
+    cargar_pendientes,
+    inicializar_sistema,
+    is_id_in_cache,
+    obtener_cola,
+)
+from exportacion import (
+    CODIFICACIONES_EXPORTACION,
+    COLUMNA_MOTIVO,
+    columnas_resultados,
+    exportar_historico,
+    exportar_resultados,
+    formatos_disponibles,
+)
+from metricas import METRICAS, registrar_cache, registrar_lote
+from motor import (
+    COALESCEDOR,
+    ENCONTRADO,
+    LIMITADO,
+    NO_ENCONTRADO,
+    DrenadorCola,
+    MotorConsultas,
+    RespuestaAPI,
+    Token,
+    cargar_configuracion,
+    configurar_sesion,
+    consultar_api,
+    descartar_planificadores,
+    drenar_cola,
+    manage_api_requests,
+    obtener_planificador,
+    parse_api_response,
+)
+from normalizacion import (
+    normalizar_cedula,
+    normalizar_sustituir,
+    separar_cedula,
+    validar_cedula,
+    validar_cedulas_lote,
+)
+from persistencia import HISTORIC_PATH, add_to_historic, escribir_atomico, vaciar_escritores
 
-# --- PERSISTENCIA ---
-HISTORIC_PATH = "historic.jsonl"
-PENDIENTES_PATH = "pendientes.jsonl"
 
+# --- RESULTADOS EN STREAMING ---
+TAMANO_LOTE_CACHE = 500   # cédulas por consulta en lote al caché
+VENTANA_ORDEN = 1000      # máximo de filas retenidas para re-ordenar
 
+# --- LECTURA DE CSV ---
+TAMANO_MUESTRA_CSV = 64 * 1024   # bytes usados para detectar separador y codificación
+TAMANO_BLOQUE_CSV = 50000        # filas por bloque al leer archivos grandes
 
-class Token():
-    def __init__(self, token, app_id, capacity=200):
-        self.capacity = capacity
-        self.current_usage = 0
-        self.token_id = token
-        self.app_id = app_id
+# --- COMPARACIÓN ---
+# "exacta": contención de palabras; "difusa": además acepta palabras con
+# similitud (fuzz.ratio) >= UMBRAL_PALABRA_DIFUSA.
+ESTRATEGIAS_COMPARACION = ("exacta", "difusa")
+UMBRAL_PALABRA_DIFUSA = 85
 
-    def has_capacity(self):
-        return self.current_usage < self.capacity
+# --- CONCURRENCIA ---
+# Procesos para normalizar y comparar en varios núcleos (reconciliar_en_procesos)
+PROCESOS_MAX = os.cpu_count() or 1
 
-    def get_credentials(self):
-        return {"app_id": self.app_id, "token": self.token_id}
+# Trabajos en segundo plano: un trabajo terminado que nadie consulta en
+# TTL_TRABAJO segundos (se cerró la pestaña) se olvida, y nunca quedan más de
+# MAX_TRABAJOS registrados (se olvidan primero los inactivos más viejos)
+TTL_TRABAJO = 3600
+MAX_TRABAJOS = 50
 
 
-# --- LÓGICA DE BÚSQUEDA Y CACHÉ ---
+# --- VALIDACIÓN PREVIA ---
 
-def inicializar_sistema(historial_path=HISTORIC_PATH):
-    cache = {}
-    if os.path.exists(historial_path):
-        with open(historial_path, "r", encoding="utf-8") as f:
-            for line in f:
-                try:
-                    item = json.loads(line)
-                    cache[str(item["cedula"])] = item["nombre"]
-                except: continue
-    return cache
+def fila_rechazada(valor, motivo):
+    return {"Cédula": valor, "Nombre API": "", "Fuente": "Rechazada", COLUMNA_MOTIVO: motivo}
 
 
-def is_id_in_cache(id_list, cache: dict):
-    ids_set = set(id_list)
-    cache_keys = set(cache.keys())
-    cached = ids_set.intersection(cache_keys)
-    non_cached = ids_set.difference(cached)
-    return list(cached), list(non_cached)
+def fila_repetida(clave):
+    """Fila de una cédula que ya apareció antes en la lista: no se consulta de nuevo."""
+    return {"Cédula": clave, "Nombre API": "", "Fuente": "Repetida", COLUMNA_MOTIVO: "repetida"}
 
 
-def cargar_configuracion(ruta_toml=".streamlit/secrets.toml"):
-    """
-    Lee los tokens del archivo TOML y retorna una lista de objetos Token.
-    """
-    try:
-        config = toml.load(ruta_toml)
-        tokens_objs = []
-        for t in config.get("tokens", []):
-            tokens_objs.append(Token(token=t["token"], app_id=t["app_id"]))
-        return tokens_objs
-    except Exception as e:
-        print(f"Error cargando configuración: {e}")
-        return []
-    
-# --- LÓGICA DE API Y PROCESAMIENTO ---
+def registrar_repetidas(cantidad):
+    """Cédulas repetidas que salen como filas "Repetida" sin consultar."""
+    if cantidad and METRICAS.habilitadas:
+        METRICAS.contar("validacion_rechazos_total", cantidad, motivo="repetida")
 
-def normalizar_cedula(input_id):
-    return re.sub(r'\D', '', str(input_id))
 
-def parse_api_response(data):
-    d = data.get("data", {})
-    if not d: return None
-    full_name = f"{d.get('primer_nombre', '')} {d.get('segundo_nombre', '')} {d.get('primer_apellido', '')} {d.get('segundo_apellido', '')}"
-    return " ".join(full_name.split()).upper()
+# --- LECTURA DE CSV POR BLOQUES ---
 
-def api_request_and_parse_data(query_params, api_url="https://api.cedula.com.ve/api/v1"):
-    try:
-        response = requests.get(api_url, params=query_params, timeout=10)
-        return response.json() if response.status_code == 200 else {}
-    except Exception as e:
-        print(f"Fallo de conexión: {e}")
-        return {}
-
-def manage_api_requests(non_cached_ids, tokens, cache_dict):
+def detectar_formato_csv(archivo, tam_muestra=TAMANO_MUESTRA_CSV):
     """
-    EL MOTOR: Rotación de tokens (Round Robin) y gestión de errores.
+    Detecta (separador, codificación) leyendo solo una muestra del archivo
+    (ruta o archivo binario abierto). Deja el archivo al inicio.
     """
-    results = []
-    token_list = tokens
-    token_index = 0
-    id_no_procesados = []
-
-    for i, _id in enumerate(non_cached_ids):
-        # 1. Verificar capacidad global
-        tokens_con_cupo = [t for t in token_list if t.has_capacity()]
-        if not tokens_con_cupo:
-            id_no_procesados = non_cached_ids[i:]
-            guardar_pendientes(id_no_procesados)
-            break
-
-        # 2. Rotar hasta encontrar uno con cupo
-        while not token_list[token_index].has_capacity():
-            token_index = (token_index + 1) % len(token_list)
-        
-        selected_token = token_list[token_index]
-        
-        # 3. Petición
+    if isinstance(archivo, (str, os.PathLike)):
+        with open(archivo, "rb") as f:
+            muestra = f.read(tam_muestra)
+    else:
+        archivo.seek(0)
+        muestra = archivo.read(tam_muestra)
+        archivo.seek(0)
+
+    # 1. Codificación: UTF-8 (con o sin BOM) y si no, latin-1
+    if muestra.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+    else:
         try:
-            params = selected_token.get_credentials()
-            params["cedula"] = _id
-            params["nacionalidad"] = "V"
-            
-            raw_data = api_request_and_parse_data(params)
-            nombre_api = parse_api_response(raw_data)
-            
-            if nombre_api:
-                cache_dict[_id] = nombre_api
-                add_to_historic(json.dumps({"cedula": _id, "nombre": nombre_api}))
-                selected_token.current_usage += 1
-                results.append({"cedula": _id, "nombre": nombre_api, "status": "API"})
-            
-            token_index = (token_index + 1) % len(token_list)
-            time.sleep(0.3) 
-            
-        except Exception as e:
-            id_no_procesados.append(_id)
-            print(f"Error en ID {_id}: {e}")
+            codecs.getincrementaldecoder("utf-8")().decode(muestra, final=False)
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            encoding = "latin-1"
 
-    if not id_no_procesados and os.path.exists(PENDIENTES_PATH):
-        os.remove(PENDIENTES_PATH)
-        
-    return results
+    # 2. Separador con csv.Sniffer sobre las líneas completas de la muestra
+    texto = muestra.decode(encoding, errors="replace")
+    if len(muestra) == tam_muestra and "\n" in texto:
+        texto = texto[:texto.rindex("\n")]
+    try:
+        sep = csv.Sniffer().sniff(texto, delimiters=",;\t|").delimiter
+    except csv.Error:
+        sep = ","
+    return sep, encoding
 
 
-# --- PERSISTENCIA ---
+def _abrir_csv(archivo, sep, encoding, **kwargs):
+    if not isinstance(archivo, (str, os.PathLike)):
+        archivo.seek(0)
+    return pd.read_csv(archivo, sep=sep, encoding=encoding, encoding_errors="replace",
+                       engine="c", dtype=str, **kwargs)
 
-def add_to_historic(json_line, historial_path=HISTORIC_PATH):
-    with open(historial_path, "a", encoding="utf-8") as file:
-        file.write(json_line + "\n")
 
+def leer_columnas_csv(archivo, formato=None):
+    """Solo el encabezado: para elegir columnas sin cargar el archivo."""
+    sep, encoding = formato or detectar_formato_csv(archivo)
+    return list(_abrir_csv(archivo, sep, encoding, nrows=0).columns)
 
-def guardar_pendientes(lista_pendientes):
-    """Guarda las cédulas que no se pudieron procesar por falta de tokens o error."""
-    # Usamos 'w' porque cada vez que guardamos, es la lista nueva de lo que quedó fuera
-    with open(PENDIENTES_PATH, "w") as file:
-        for _id in lista_pendientes:
-            file.write(json.dumps({"cedula": _id, "timestamp": time.time()}) + "\n")
 
+def contar_filas_csv(archivo):
+    """Cuenta filas de datos (sin encabezado) contando saltos de línea por bloques."""
+    if isinstance(archivo, (str, os.PathLike)):
+        with open(archivo, "rb") as f:
+            return contar_filas_csv(f)
+    archivo.seek(0)
+    lineas = 0
+    ultimo = b"\n"
+    for bloque in iter(lambda: archivo.read(1 << 20), b""):
+        lineas += bloque.count(b"\n")
+        ultimo = bloque[-1:]
+    archivo.seek(0)
+    if ultimo != b"\n":
+        lineas += 1
+    return max(0, lineas - 1)
+
+
+def _bloques_csv(archivo, sep, encoding, columnas, tam_bloque, saltar):
+    """Bloques de `tam_bloque` filas contados desde el inicio del archivo, sin las primeras `saltar`."""
+    for bloque in _abrir_csv(archivo, sep, encoding, usecols=columnas, chunksize=tam_bloque):
+        if saltar >= len(bloque):
+            saltar -= len(bloque)
+            continue
+        if saltar:
+            bloque, saltar = bloque.iloc[saltar:], 0
+        yield bloque
+
+
+def leer_csv_por_bloques(archivo, col_id, col_nombre=None, tam_bloque=TAMANO_BLOQUE_CSV, formato=None, saltar=0):
+    """
+    Generador: lee el CSV por bloques con el parser C y entrega
+    (ids, nombres_ref) por bloque, con las cédulas ya validadas y en el orden
+    del archivo. Las repetidas siguen ahí (el procesamiento las marca como
+    "Repetida"); las que no pasan la validación van tal cual vinieron, para
+    que se reporten como rechazadas; las vacías se descartan.
+    Con `saltar` se omiten las primeras filas de datos (p. ej. ya procesadas
+    al reanudar); los bloques siguen alineados a múltiplos de `tam_bloque`
+    desde el inicio del archivo, así que el primero puede venir más corto.
+    La memoria depende del tamaño del bloque, no del archivo.
+    """
+    sep, encoding = formato or detectar_formato_csv(archivo)
+    columnas = [col_id] if col_nombre is None or col_nombre == col_id else [col_id, col_nombre]
+    for bloque in _bloques_csv(archivo, sep, encoding, columnas, tam_bloque, saltar):
+        cedulas = validar_cedulas_lote(bloque[col_id].fillna("").tolist())[0]
+        quedan = np.array([c != "" for c in cedulas], dtype=bool)
+        ids = [c for c, queda in zip(cedulas, quedan) if queda]
+        nombres_ref = {}
+        if col_nombre is not None:
+            # El nombre de la primera aparición de cada cédula
+            for _id, nombre in zip(ids, bloque[col_nombre][quedan].fillna("").tolist()):
+                nombres_ref.setdefault(_id, nombre)
+        yield ids, nombres_ref
 
-def cargar_pendientes():
-    """Carga la lista de cédulas que quedaron a medias en la sesión anterior."""
-    if not os.path.exists(PENDIENTES_PATH):
-        return []
-    
-    pendientes = []
-    with open(PENDIENTES_PATH, "r") as file:
-        for line in file:
-            item = json.loads(line)
-            pendientes.append(item["cedula"])
-    return pendientes
 
 def comparar_nombres(nombre_usuario, nombre_api):
     """Lógica: Case Insensitive y contención de palabras."""
@@ -178,90 +236,834 @@ def comparar_nombres(nombre_usuario, nombre_api):
     return "IGUAL" if coinciden_todas else "REVISAR"
 
 
-def procesar_cedula_individual(_id, tokens, cache_dict, token_idx, nombres_ref, modo):
+def comparar_nombres_difuso(nombre_usuario, nombre_api, umbral_palabra=UMBRAL_PALABRA_DIFUSA):
+    """Contención tolerante a errores de tipeo para un solo par. Retorna (resultado, confianza, faltantes)."""
+    res = comparar_nombres_lote([nombre_usuario], [nombre_api], estrategia="difusa", umbral_palabra=umbral_palabra)
+    resultado, confianza, faltantes = res.iloc[0]
+    return resultado, int(confianza), faltantes
+
+
+# --- COMPARACIÓN POR CONTENCIÓN ---
+
+def clasificador_contencion(row):
+    """Versión fila a fila (referencia). Para listas grandes usar comparar_nombres_lote."""
+    nombre_usuario = row['Tu Lista']
+    nombre_api = row['Nombre API']
+    
+    if not nombre_api or nombre_api == "NO ENCONTRADO":
+        return "NO ENCONTRADO", 0, ""
+
+    tokens_u = normalizar_sustituir(nombre_usuario)
+    tokens_a = normalizar_sustituir(nombre_api)
+    
+    if not tokens_u:
+        return "ERROR INPUT", 0, ""
+
+    # Lógica de contención
+    encontrados = [p for p in tokens_u if p in tokens_a]
+    faltantes = [p for p in tokens_u if p not in tokens_a]
+    
+    porcentaje = len(encontrados) / len(tokens_u)
+    
+    # Clasificación
+    if porcentaje == 1.0:
+        res = "IGUAL"
+    elif porcentaje >= 0.5:
+        res = "REVISAR"
+    else:
+        res = "DIFERENTE"
+        
+    return res, int(porcentaje * 100), ", ".join(faltantes)
+
+
+@functools.lru_cache(maxsize=1)
+def _tabla_sin_marcas():
+    """Tabla para str.translate que borra los caracteres Mn (tildes combinantes), como normalizar_sustituir."""
+    return {c: None for c in range(sys.maxunicode + 1) if unicodedata.category(chr(c)) == "Mn"}
+
+
+def _texto_o_vacio(texto):
+    try:
+        return "" if not texto or pd.isna(texto) else str(texto)
+    except (TypeError, ValueError):
+        return str(texto)
+
+
+def palabras_normalizadas_lote(textos):
+    """
+    Igual que normalizar_sustituir pero para una columna entera.
+    Retorna un DataFrame largo (fila, palabra) sin palabras repetidas por fila,
+    en el orden en que aparecen en el texto.
+    """
+    textos = pd.Series([_texto_o_vacio(t) for t in textos], dtype=object)
+    limpios = (textos.str.normalize("NFD")
+               .str.translate(_tabla_sin_marcas())
+               .str.upper()
+               .str.replace(r"[^A-Z0-9\s]", "", regex=True))
+    palabras = limpios.str.split().explode().dropna()
+    palabras = palabras[(palabras.str.len() > 2) | palabras.isin(["DE", "LA"])]
+    largo = pd.DataFrame({"fila": palabras.index.to_numpy(), "palabra": palabras.to_numpy()})
+    return largo.drop_duplicates(ignore_index=True)
+
+
+def _palabras_desde_listas(listas):
+    """DataFrame largo (fila, palabra) a partir de palabras ya normalizadas."""
+    largos = [len(p) for p in listas]
+    return pd.DataFrame({
+        "fila": np.repeat(np.arange(len(listas)), largos),
+        "palabra": np.array([p for lista in listas for p in lista], dtype=object),
+    })
+
+
+def _marcar_coincidencias_difusas(cruce, pal_a, umbral):
+    """
+    Marca como encontradas las palabras del usuario que no están tal cual pero
+    se parecen a alguna palabra del nombre de la API (fuzz.ratio >= umbral).
+    Solo entra lo que la contención exacta dejó sin resolver, y antes de puntuar
+    se descartan por longitud los pares que no pueden llegar al umbral
+    (ratio <= 2*min(len)/(suma de len)). Cada par de palabras se puntúa una vez.
+    """
+    faltan = cruce.loc[~cruce["esta"], ["fila", "palabra"]].rename_axis("pos").reset_index()
+    if faltan.empty:
+        return
+    pares = faltan.merge(pal_a, on="fila", suffixes=("_u", "_a"))
+    if pares.empty:
+        return
+    lu = pares["palabra_u"].str.len().to_numpy()
+    la = pares["palabra_a"].str.len().to_numpy()
+    pares = pares[200 * np.minimum(lu, la) / (lu + la) + 0.5 >= umbral]
+    if pares.empty:
+        return
+    unicos = pares[["palabra_u", "palabra_a"]].drop_duplicates()
+    unicos["score"] = [fuzz.ratio(u, a) for u, a in zip(unicos["palabra_u"], unicos["palabra_a"])]
+    pares = pares.merge(unicos, on=["palabra_u", "palabra_a"])
+    cruce.loc[pares.loc[pares["score"] >= umbral, "pos"].unique(), "esta"] = True
+
+
+def comparar_nombres_lote(nombres_usuario, nombres_api, palabras_api=None, estrategia="exacta", umbral_palabra=UMBRAL_PALABRA_DIFUSA):
+    """
+    Compara dos columnas completas con la lógica de clasificador_contencion
+    (mismo veredicto y misma confianza) sin recorrer fila por fila:
+    normaliza en bloque, cruza las palabras con un merge y agrega por fila.
+    Los pares repetidos (usuario, api) se calculan una sola vez.
+    `palabras_api` (opcional) trae las palabras ya normalizadas de cada nombre
+    de la API (p. ej. las del almacén); las que vengan en None se calculan.
+    Con estrategia="difusa" una palabra también cuenta como encontrada si se
+    parece a una de la API al menos `umbral_palabra` (0-100), p. ej.
+    LEONILDE ~ LEONILDES.
+    Retorna un DataFrame con "Resultado", "Confianza %" y "Faltó en API",
+    alineado con el índice de `nombres_usuario`.
+    """
+    if estrategia not in ESTRATEGIAS_COMPARACION:
+        raise ValueError(f"Estrategia de comparación desconocida: {estrategia}")
+    indice = nombres_usuario.index if isinstance(nombres_usuario, pd.Series) else None
+    usuarios = list(nombres_usuario)
+    apis = list(nombres_api)
+
+    # 1. Trabajar solo con pares únicos
+    u_textos = [_texto_o_vacio(u) for u in usuarios]
+    a_textos = [a if isinstance(a, str) else repr(a) for a in apis]
+    codigos, _ = pd.MultiIndex.from_arrays([u_textos, a_textos]).factorize()
+    primeros = np.unique(codigos, return_index=True)[1]
+    u_unicos = np.array(u_textos, dtype=object)[primeros]
+    a_unicos = np.array(apis + [None], dtype=object)[:-1][primeros]
+    n = len(primeros)
+
+    # 2. Palabras de cada lado y cruce vectorizado
+    pal_u = palabras_normalizadas_lote(u_unicos)
+    if palabras_api is None:
+        pal_a = palabras_normalizadas_lote([_texto_o_vacio(a) for a in a_unicos])
+    else:
+        # Solo se normaliza el lado de la API que no venía precalculado
+        palabras_api = list(palabras_api)
+        precalc = [palabras_api[i] for i in primeros]
+        faltan_calc = [i for i, p in enumerate(precalc) if p is None]
+        if faltan_calc:
+            calculadas = palabras_normalizadas_lote([_texto_o_vacio(a_unicos[i]) for i in faltan_calc])
+            por_fila = calculadas.groupby("fila")["palabra"].agg(list)
+            for j, i in enumerate(faltan_calc):
+                precalc[i] = por_fila.get(j, [])
+        pal_a = _palabras_desde_listas(precalc)
+    cruce = pal_u.merge(pal_a.assign(esta=True), on=["fila", "palabra"], how="left")
+    cruce["esta"] = cruce["esta"].fillna(False).astype(bool)
+    if estrategia == "difusa":
+        _marcar_coincidencias_difusas(cruce, pal_a, umbral_palabra)
+
+    total = np.bincount(cruce["fila"].to_numpy(dtype=np.int64), minlength=n)
+    encontrados = np.bincount(cruce["fila"].to_numpy(dtype=np.int64), weights=cruce["esta"].to_numpy(), minlength=n)
+
+    # 3. Veredicto
+    with np.errstate(divide="ignore", invalid="ignore"):
+        porcentaje = np.where(total > 0, encontrados / np.maximum(total, 1), 0.0)
+    sin_api = np.array([(not a) or (isinstance(a, str) and a == "NO ENCONTRADO") for a in a_unicos], dtype=bool)
+    sin_usuario = total == 0
+
+    resultado = np.select(
+        [sin_api, sin_usuario, porcentaje == 1.0, porcentaje >= 0.5],
+        ["NO ENCONTRADO", "ERROR INPUT", "IGUAL", "REVISAR"],
+        default="DIFERENTE").astype(object)
+    confianza = np.where(sin_api | sin_usuario, 0, np.trunc(porcentaje * 100)).astype(int)
+    faltantes = np.full(n, "", dtype=object)
+    no_estan = cruce[~cruce["esta"]]
+    por_fila = {}
+    for fila, palabra in zip(no_estan["fila"].to_numpy(), no_estan["palabra"].to_numpy()):
+        por_fila.setdefault(fila, []).append(palabra)
+    for fila, palabras in por_fila.items():
+        faltantes[fila] = ", ".join(palabras)
+    faltantes[sin_api | sin_usuario] = ""
+
+    # 4. Volver a expandir a todas las filas
+    return pd.DataFrame({
+        "Resultado": resultado[codigos],
+        "Confianza %": confianza[codigos],
+        "Faltó en API": faltantes[codigos],
+    }, index=indice)
+
+
+def comparar_filas(filas, cache=None, estrategia="exacta"):
+    """
+    Agrega Resultado / Confianza % / Faltó en API a filas que traen "Tu Lista" (en lote).
+    Si `cache` guarda las palabras normalizadas de cada nombre, se usan tal cual.
+    """
+    a_comparar = [f for f in filas if "Tu Lista" in f]
+    if not a_comparar:
+        return filas
+    palabras_api = None
+    if hasattr(cache, "palabras_lote"):
+        precalc = cache.palabras_lote([f["Cédula"] for f in a_comparar])
+        palabras_api = [precalc.get(f["Cédula"]) for f in a_comparar]
+    res = comparar_nombres_lote([f["Tu Lista"] for f in a_comparar], [f["Nombre API"] for f in a_comparar],
+                                palabras_api, estrategia=estrategia)
+    for fila, (veredicto, confianza, faltantes) in zip(a_comparar, res.itertuples(index=False)):
+        fila["Resultado"] = veredicto
+        fila["Confianza %"] = int(confianza)
+        fila["Faltó en API"] = faltantes
+    return filas
+
+
+def construir_fila(_id, nombre_api, origen, nombres_ref=None, modo="Solo Consultar"):
+    """
+    Arma la fila de resultados que muestra el front.
+    En modo comparación solo agrega "Tu Lista"; el veredicto se calcula en
+    lote con comparar_filas.
+    """
+    res_row = {"Cédula": _id, "Nombre API": nombre_api, "Fuente": origen}
+    if modo == "Comparar con mi lista" and nombres_ref:
+        res_row["Tu Lista"] = nombres_ref.get(_id, "")
+    return res_row
+
+
+def procesar_cedula_individual(_id, tokens, cache_dict, token_idx, nombres_ref, modo, cache_negativa=None, estrategia="exacta"):
     """
     Esta función procesa UNA sola cédula. 
     Retorna: (nueva_fila, nuevo_token_idx, origen)
     """
     origen = ""
     nombre_api = ""
+
+    # 0. Validación previa: lo que no es una cédula no llega ni al caché
+    _id, motivo = validar_cedula(_id)
+    if motivo is not None:
+        return fila_rechazada(_id, motivo), token_idx, "Rechazada"
     
     # 1. Caché
-    if _id in cache_dict:
-        nombre_api = cache_dict[_id]
+    nombre_cache = cache_dict.get(_id)
+    if nombre_cache is not None:
+        nombre_api = nombre_cache
         origen = "Caché"
+        registrar_cache(aciertos=1)
+    elif cache_negativa is not None and _id in cache_negativa:
+        # 1b. Ya sabemos que no existe: no se gasta cupo
+        nombre_api = "NO ENCONTRADO"
+        origen = "Caché (no existe)"
+        registrar_cache(negativos=1)
     else:
-        # 2. API (Rotación de tokens)
-        tokens_con_cupo = [t for t in tokens if t.has_capacity()]
-        if not tokens_con_cupo:
-            return None, token_idx, "Agotado"
-            
-        while not tokens[token_idx].has_capacity():
-            token_idx = (token_idx + 1) % len(tokens)
-        
-        selected_token = tokens[token_idx]
-        params = selected_token.get_credentials()
-        params.update({"cedula": _id, "nacionalidad": "V"})
-        
-        raw_data = api_request_and_parse_data(params)
-        nombre_api = parse_api_response(raw_data)
-        
-        if nombre_api:
-            cache_dict[_id] = nombre_api
-            add_to_historic(json.dumps({"cedula": _id, "nombre": nombre_api}))
-            selected_token.current_usage += 1
-            origen = "API"
-            time.sleep(0.3)
-        else:
-            nombre_api = "NO ENCONTRADO"
-            origen = "No existe"
-            
-        token_idx = (token_idx + 1) % len(tokens)
+        registrar_cache(fallos=1)
+        # 2. Si otra sesión ya está consultando esta cédula, se usa su respuesta
+        futuro, lider = COALESCEDOR.unirse(_id)
+        if not lider:
+            compartido = futuro.result()
+            if compartido is not None and compartido[1] in ("API", "No existe"):
+                nombre_api, origen = (compartido[0], "API") if compartido[1] == "API" else ("NO ENCONTRADO", "No existe")
+                fila = construir_fila(_id, nombre_api, origen, nombres_ref, modo)
+                comparar_filas([fila], cache_dict, estrategia)
+                return fila, token_idx, origen
+            return procesar_cedula_individual(_id, tokens, cache_dict, token_idx, nombres_ref, modo,
+                                              cache_negativa, estrategia)
+        compartido = None
+        try:
+            fila, token_idx, origen = _consultar_cedula_individual(_id, tokens, cache_dict, token_idx, nombres_ref,
+                                                                   modo, cache_negativa, estrategia)
+            if origen in ("API", "No existe"):
+                compartido = (fila["Nombre API"] if origen == "API" else None, origen, None)
+            return fila, token_idx, origen
+        finally:
+            COALESCEDOR.resolver(_id, compartido)
 
     # 3. Construir Fila
-    res_row = {"Cédula": _id, "Nombre API": nombre_api, "Fuente": origen}
-    if modo == "Comparar con mi lista" and nombres_ref:
-        n_usuario = nombres_ref.get(_id, "")
-        res_row["Tu Lista"] = n_usuario
-        res_row["Resultado"] = comparar_nombres(n_usuario, nombre_api)
-        
-    return res_row, token_idx, origen
+    fila = construir_fila(_id, nombre_api, origen, nombres_ref, modo)
+    comparar_filas([fila], cache_dict, estrategia)
+    return fila, token_idx, origen
+
+
+def _consultar_cedula_individual(_id, tokens, cache_dict, token_idx, nombres_ref, modo, cache_negativa, estrategia):
+    """Parte de API de procesar_cedula_individual (se llama siendo líder del coalescedor)."""
+    # API (el planificador elige el token; token_idx se conserva por compatibilidad)
+    planificador = obtener_planificador(tokens)
+    selected_token, motivo = planificador.adquirir()
+    if selected_token is None:
+        obtener_cola().encolar([(_id, motivo)])
+        return None, token_idx, "Agotado" if motivo == "Agotado" else "Error"
+
+    params = selected_token.get_credentials()
+    nacionalidad, numero = separar_cedula(_id)
+    params.update({"cedula": numero, "nacionalidad": nacionalidad})
+    
+    inicio = time.perf_counter()
+    try:
+        selected_token.esperar_turno()
+        respuesta = consultar_api(params)
+    finally:
+        planificador.soltar(selected_token)
+    planificador.registrar(selected_token, respuesta.estado, time.perf_counter() - inicio)
+
+    if respuesta.estado not in (ENCONTRADO, NO_ENCONTRADO):
+        # Un 429 / 5xx / fallo de red no es "NO ENCONTRADO": se reporta como error
+        selected_token.liberar()
+        if respuesta.estado == LIMITADO:
+            selected_token.enfriar(respuesta.retry_after or motor.BACKOFF_BASE)
+        obtener_cola().encolar([(_id, respuesta.estado)])
+        return None, token_idx, "Error"
+
+    nombre_api = parse_api_response(respuesta.datos)
+    if nombre_api:
+        cache_dict[_id] = nombre_api
+        add_to_historic(json.dumps({"cedula": _id, "nombre": nombre_api}))
+        origen = "API"
+    else:
+        selected_token.liberar()
+        if cache_negativa is not None:
+            cache_negativa.registrar(_id)
+        nombre_api = "NO ENCONTRADO"
+        origen = "No existe"
+    obtener_cola().quitar([_id])
+
+    # Construir Fila
+    fila = construir_fila(_id, nombre_api, origen, nombres_ref, modo)
+    comparar_filas([fila], cache_dict, estrategia)
+    return fila, token_idx, origen
 
-def process_full_list(id_list, tokens, cache_dict, nombres_ref=None, modo="Solo Consultar"):
+
+def process_full_list(id_list, tokens, cache_dict, nombres_ref=None, modo="Solo Consultar", cache_negativa=None,
+                      estrategia="exacta", vistos=None):
     """
     ESTA ES LA FUNCIÓN QUE LLAMA EL FRONT.
-    Une Caché, API y Comparación en un solo paso.
+    Une Caché, API y Comparación en un solo paso. Las filas salen en el
+    orden de la lista (las que no se pudieron consultar se omiten).
+    Las cédulas repetidas (en la lista o en `vistos`, un set que se comparte
+    entre bloques) salen como filas "Repetida".
     """
-    # 1. Separar qué está en caché y qué no
-    cached, non_cached = is_id_in_cache(id_list, cache_dict)
-    
-    final_results = []
+    inicio = time.perf_counter()
+    # 0. Validación previa: las rechazadas no van ni al caché ni a la API
+    claves, rechazos = validar_cedulas_lote(id_list)
+    vistos = set() if vistos is None else vistos
+    primeras = []
+    repetidas = []    # posición en `claves` de cada repetida
+    for i, _id in enumerate(claves):
+        if _id in vistos:
+            repetidas.append(i)
+        else:
+            vistos.add(_id)
+            primeras.append(_id)
+    registrar_repetidas(len(repetidas))
+    filas = {_id: fila_rechazada(_id, rechazos[_id]) for _id in primeras if _id in rechazos}
+
+    # 1. Separar qué está en caché y qué no (una consulta por lote)
+    ids_unicos = [_id for _id in primeras if _id not in rechazos]
+    en_cache = buscar_en_cache(cache_dict, ids_unicos)
+    non_cached = [_id for _id in ids_unicos if _id not in en_cache]
+    no_existen = cache_negativa.contiene_lote(non_cached) if cache_negativa is not None else set()
     
-    # 2. Procesar lo que está en Caché
-    for _id in cached:
-        nombre_api = cache_dict[_id]
-        fila = {"Cédula": _id, "Nombre API": nombre_api, "Fuente": "Caché"}
-        
-        if modo == "Comparar con mi lista" and nombres_ref:
-            nom_usr = nombres_ref.get(_id, "")
-            fila["Tu Lista"] = nom_usr
-            fila["Resultado"] = comparar_nombres(nom_usr, nombre_api)
-        
-        final_results.append(fila)
+    # 2. Procesar lo que está en Caché (positiva y negativa)
+    for _id, nombre_api in en_cache.items():
+        filas[_id] = construir_fila(_id, nombre_api, "Caché", nombres_ref, modo)
+    for _id in non_cached:
+        if _id in no_existen:
+            filas[_id] = construir_fila(_id, "NO ENCONTRADO", "Caché (no existe)", nombres_ref, modo)
+    non_cached = [_id for _id in non_cached if _id not in no_existen]
+    registrar_cache(len(en_cache), len(no_existen), len(non_cached))
         
-    # 3. Procesar lo que NO está en Caché (llamando a la API)
+    # 3. Procesar lo que NO está en Caché (llamando a la API en paralelo)
     if non_cached:
-        api_data = manage_api_requests(non_cached, tokens, cache_dict)
+        api_data = manage_api_requests(non_cached, tokens, cache_dict, cache_negativa)
         for item in api_data:
-            nombre_api = item["nombre"]
-            fila = {"Cédula": item["cedula"], "Nombre API": nombre_api, "Fuente": "API"}
-            
-            if modo == "Comparar con mi lista" and nombres_ref:
-                nom_usr = nombres_ref.get(item["cedula"], "")
-                fila["Tu Lista"] = nom_usr
-                fila["Resultado"] = comparar_nombres(nom_usr, nombre_api)
-            
-            final_results.append(fila)
+            if item["status"] == "API":
+                filas[item["cedula"]] = construir_fila(item["cedula"], item["nombre"], "API", nombres_ref, modo)
+            else:
+                filas[item["cedula"]] = construir_fila(item["cedula"], "NO ENCONTRADO", "No existe", nombres_ref, modo)
+
+    # 4. En el orden de entrada, y comparación de nombres en una sola pasada
+    repetidas = set(repetidas)
+    final_results = [fila_repetida(_id) if i in repetidas else filas[_id]
+                     for i, _id in enumerate(claves) if i in repetidas or _id in filas]
+    comparar_filas(final_results, cache_dict, estrategia)
+    registrar_lote("process_full_list", len(final_results), time.perf_counter() - inicio)
             
     return final_results
 
+
+def iterar_lista(id_list, tokens, cache_dict, nombres_ref=None, modo="Solo Consultar", cache_negativa=None,
+                 estrategia="exacta", ordenado=False, ventana_orden=VENTANA_ORDEN,
+                 tam_lote=TAMANO_LOTE_CACHE, incluir_fallidos=False, vistos=None):
+    """
+    Versión generadora de process_full_list: entrega cada fila apenas está
+    lista. Los aciertos de caché salen de inmediato y las consultas a la API a
+    medida que llegan. `id_list` puede ser cualquier iterable (p. ej. un
+    lector de CSV), se consume por lotes de `tam_lote`.
+
+    Con ordenado=True las filas salen en el orden de entrada: se retienen como
+    máximo `ventana_orden` filas y, si la más antigua sigue en vuelo, se deja
+    de leer entrada hasta que llegue.
+    Con incluir_fallidos=True también salen filas con Fuente "Agotado" o
+    "Error" (las que process_full_list omite). Unas y otras quedan en la cola
+    de reintentos, que se actualiza cada `tam_lote` resultados de la API (la
+    memoria no crece con la lista). `vistos` como en process_full_list.
+    """
+    motor = None
+    en_vuelo = 0
+    siguiente = 0     # próximo índice a entregar (modo ordenado)
+    retenidas = {}    # idx -> fila o None (fallida que no se entrega)
+    vistos = set() if vistos is None else vistos
+    fallidos = []     # aún sin pasar a la cola de reintentos
+    resueltas = []
+
+    def actualizar_cola(minimo=1):
+        if len(fallidos) + len(resueltas) >= minimo:
+            cola = obtener_cola()
+            cola.encolar(fallidos)
+            cola.quitar(resueltas)
+            fallidos.clear()
+            resueltas.clear()
+
+    def a_fila(r):
+        if r["status"] in ("API", "No existe"):
+            resueltas.append(r["cedula"])
+        if r["status"] == "API":
+            return construir_fila(r["cedula"], r["nombre"], "API", nombres_ref, modo)
+        if r["status"] == "No existe":
+            return construir_fila(r["cedula"], "NO ENCONTRADO", "No existe", nombres_ref, modo)
+        fallidos.append((r["cedula"], r["error"] or r["status"]))
+        if incluir_fallidos:
+            return construir_fila(r["cedula"], "", r["status"], nombres_ref, modo)
+        return None
+
+    def entregar(pares):
+        # Compara en lote y entrega (o retiene hasta completar el orden)
+        nonlocal siguiente
+        comparar_filas([fila for _, fila in pares if fila is not None], cache_dict, estrategia)
+        if not ordenado:
+            for _, fila in pares:
+                if fila is not None:
+                    yield fila
+            return
+        retenidas.update(pares)
+        while siguiente in retenidas:
+            fila = retenidas.pop(siguiente)
+            siguiente += 1
+            if fila is not None:
+                yield fila
+
+    def recoger(bloquear):
+        # Junta lo que el motor ya tenga listo (o espera al menos uno)
+        nonlocal en_vuelo
+        pares = []
+        while en_vuelo:
+            try:
+                r = motor.recibir(timeout=None if bloquear and not pares else 0)
+            except queue.Empty:
+                break
+            en_vuelo -= 1
+            pares.append((r["idx"], a_fila(r)))
+        actualizar_cola(tam_lote)
+        return pares
+
+    entrada = iter(id_list)
+    contador = itertools.count()
+    inicio = time.perf_counter()
+    try:
+        while True:
+            crudos = list(itertools.islice(entrada, tam_lote))
+            if not crudos:
+                break
+            # 0. Validación previa y repetidas (después de validar: "V-1.234.567" y "1234567" son la misma)
+            claves, rechazos = validar_cedulas_lote(crudos)
+            repetidas = set()
+            lote = []
+            for _id in claves:
+                if _id in vistos:
+                    repetidas.add(len(lote))
+                else:
+                    vistos.add(_id)
+                lote.append(_id)
+            registrar_repetidas(len(repetidas))
+            validas = [_id for i, _id in enumerate(lote) if i not in repetidas and _id not in rechazos]
+
+            # 1. Caché positiva y negativa del lote en dos consultas
+            en_cache = buscar_en_cache(cache_dict, validas)
+            faltan = [_id for _id in validas if _id not in en_cache]
+            no_existen = cache_negativa.contiene_lote(faltan) if cache_negativa is not None and faltan else set()
+            registrar_cache(len(validas) - len(faltan), len(no_existen), len(faltan) - len(no_existen))
+
+            listos = []
+            for i, _id in enumerate(lote):
+                idx = next(contador)
+                # Ventana de re-orden llena: esperar a la más antigua
+                while ordenado and idx - siguiente >= ventana_orden and en_vuelo:
+                    yield from entregar(listos)
+                    listos = []
+                    yield from entregar(recoger(bloquear=True))
+                if i in repetidas:
+                    listos.append((idx, fila_repetida(_id)))
+                elif _id in rechazos:
+                    listos.append((idx, fila_rechazada(_id, rechazos[_id])))
+                elif _id in en_cache:
+                    listos.append((idx, construir_fila(_id, en_cache[_id], "Caché", nombres_ref, modo)))
+                elif _id in no_existen:
+                    listos.append((idx, construir_fila(_id, "NO ENCONTRADO", "Caché (no existe)", nombres_ref, modo)))
+                else:
+                    # 2. API: el motor arranca con el primer fallo de caché
+                    if motor is None:
+                        motor = MotorConsultas(tokens, cache_dict, cache_negativa=cache_negativa).iniciar()
+                    motor.enviar(idx, _id)
+                    en_vuelo += 1
+            yield from entregar(listos)
+            yield from entregar(recoger(bloquear=False))
+
+        # 3. Vaciar lo que sigue en vuelo
+        if motor is not None:
+            motor.cerrar()
+        while en_vuelo:
+            yield from entregar(recoger(bloquear=True))
+        registrar_lote("iterar_lista", next(contador), time.perf_counter() - inicio)
+    finally:
+        if motor is not None:
+            motor.detener()
+        # También si se cortó a medias (close() del generador): lo recibido no se pierde
+        actualizar_cola()
+
+
+# --- PROCESAMIENTO EN VARIOS NÚCLEOS ---
+
+# Almacén y caché negativa de cada proceso del pool (se abren una vez por proceso)
+_PROCESO = {}
+
+
+def _iniciar_proceso(ruta_store, ruta_negativos):
+    _PROCESO["store"] = AlmacenIdentidades(ruta_store)
+    _PROCESO["negativa"] = CacheNegativa(ruta_negativos) if ruta_negativos else None
+
+
+def _reconciliar_fragmento(valores, nombres, modo, estrategia, store=None, negativa=None):
+    """
+    Valida, busca en caché y compara un fragmento crudo. Corre en un
+    proceso del pool (o en línea si no hay pool). Retorna las cédulas del
+    fragmento en orden (con repetidas, sin vacías), las filas de cada cédula
+    distinta como tuplas (None si hay que ir a la API), las columnas de esas
+    tuplas, los nombres de referencia de las que faltan y los aciertos
+    (caché, caché negativa).
+    """
+    if store is None:
+        store, negativa = _PROCESO["store"], _PROCESO["negativa"]
+    # 1. Validar y juntar las distintas (las repetidas se marcan al volver)
+    validadas, rechazos = validar_cedulas_lote(valores)
+    todas, nombres_ref = [], {}
+    for i, _id in enumerate(validadas):
+        if _id:
+            todas.append(_id)
+            nombres_ref.setdefault(_id, nombres[i] if nombres is not None else "")
+    ids = list(nombres_ref)
+    if nombres is None:
+        nombres_ref = {}
+
+    # 2. Caché positiva y negativa
+    validas = [_id for _id in ids if _id not in rechazos]
+    en_cache = buscar_en_cache(store, validas)
+    faltan = [_id for _id in validas if _id not in en_cache]
+    no_existen = negativa.contiene_lote(faltan) if negativa is not None and faltan else set()
+
+    # 3. Filas y comparación en lote
+    filas = []
+    for _id in ids:
+        if _id in rechazos:
+            filas.append(fila_rechazada(_id, rechazos[_id]))
+        elif _id in en_cache:
+            filas.append(construir_fila(_id, en_cache[_id], "Caché", nombres_ref, modo))
+        elif _id in no_existen:
+            filas.append(construir_fila(_id, "NO ENCONTRADO", "Caché (no existe)", nombres_ref, modo))
+        else:
+            filas.append(None)
+    comparar_filas([f for f in filas if f is not None], store, estrategia)
+
+    # Tuplas en vez de dicts: menos bytes que serializar de vuelta. Sin
+    # valor (None) la columna no va en la fila: las rechazadas no traen
+    # "Tu Lista" y las demás no traen "Motivo"
+    columnas = list(dict.fromkeys(c for f in filas if f is not None for c in f))
+    tuplas = [None if f is None else tuple(f.get(c) for c in columnas) for f in filas]
+    faltantes = {_id: nombres_ref.get(_id, "") for _id in faltan if _id not in no_existen}
+    return todas, tuplas, columnas, faltantes, (len(en_cache), len(no_existen))
+
+
+def leer_csv_fragmentos(archivo, col_id, col_nombre=None, tam_bloque=TAMANO_BLOQUE_CSV, formato=None, saltar=0):
+    """
+    Como leer_csv_por_bloques pero sin validar: entrega (valores, nombres)
+    tal como vienen en el archivo, para que reconciliar_en_procesos haga ese
+    trabajo en otros núcleos.
+    """
+    sep, encoding = formato or detectar_formato_csv(archivo)
+    columnas = [col_id] if col_nombre is None or col_nombre == col_id else [col_id, col_nombre]
+    for bloque in _bloques_csv(archivo, sep, encoding, columnas, tam_bloque, saltar):
+        valores = bloque[col_id].fillna("").tolist()
+        nombres = bloque[col_nombre].fillna("").tolist() if col_nombre is not None else None
+        yield valores, nombres
+
+
+def reconciliar_en_procesos(fragmentos, tokens, cache_dict, modo="Solo Consultar", cache_negativa=None,
+                            estrategia="exacta", procesos=None, vistos=None):
+    """
+    Generador: por cada fragmento (valores, nombres) de leer_csv_fragmentos
+    entrega (ids, filas, nombres_ref), en el orden de entrada; nombres_ref
+    son los de las cédulas que fueron a la API (las únicas que pueden faltar
+    en `filas`). Normalizar, buscar en caché
+    y comparar (CPU pura) corre en un pool de `procesos` procesos
+    (PROCESOS_MAX por defecto) que abren el SQLite por su cuenta; aquí solo
+    se juntan los resultados y lo que falta se consulta a la API con
+    process_full_list. Con procesos=1, o un caché que no está
+    en un archivo (`ruta`), todo corre en este proceso.
+    Las cédulas repetidas (también entre fragmentos y con las de `vistos`,
+    p. ej. ya terminadas al reanudar) salen como filas "Repetida".
+    """
+    vistos = set() if vistos is None else vistos
+    procesos = max(1, procesos or PROCESOS_MAX)
+    if not isinstance(getattr(cache_dict, "ruta", None), str):
+        procesos = 1
+
+    def completar(resultado):
+        todas, tuplas, columnas, faltantes, (aciertos, negativos) = resultado
+        # Los fallos de caché los cuenta process_full_list al consultarlos
+        registrar_cache(aciertos, negativos)
+        por_cedula = dict(zip(dict.fromkeys(todas), tuplas))
+        # 1. Primeras apariciones y repetidas (en el fragmento o en anteriores)
+        ids = todas
+        primeras = set()
+        for _id in ids:
+            if _id not in vistos:
+                vistos.add(_id)
+                primeras.add(_id)
+        registrar_repetidas(len(ids) - len(primeras))
+        # 2. Lo que no estaba en caché va a la API desde este proceso
+        pendientes = [_id for _id in primeras if _id in faltantes]
+        de_api = {}
+        if pendientes:
+            de_api = {f["Cédula"]: f for f in process_full_list(
+                pendientes, tokens, cache_dict, faltantes, modo, cache_negativa, estrategia)}
+        filas = []
+        for _id in ids:
+            if _id not in primeras:
+                filas.append(fila_repetida(_id))
+                continue
+            primeras.discard(_id)
+            if por_cedula[_id] is not None:
+                filas.append({c: v for c, v in zip(columnas, por_cedula[_id]) if v is not None})
+            elif _id in de_api:
+                filas.append(de_api[_id])
+        return ids, filas, faltantes
+
+    if procesos == 1:
+        for valores, nombres in fragmentos:
+            yield completar(_reconciliar_fragmento(valores, nombres, modo, estrategia, cache_dict, cache_negativa))
+        return
+
+    # "spawn": no se copian los hilos de Streamlit ni las conexiones SQLite abiertas
+    ruta_negativos = cache_negativa.ruta if cache_negativa is not None else None
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_iniciar_proceso, initargs=(cache_dict.ruta, ruta_negativos)) as pool:
+        # Como mucho 2 fragmentos por proceso en vuelo: memoria acotada y entrega en orden
+        en_vuelo = deque()
+        for valores, nombres in fragmentos:
+            en_vuelo.append(pool.submit(_reconciliar_fragmento, valores, nombres, modo, estrategia))
+            if len(en_vuelo) >= 2 * procesos:
+                yield completar(en_vuelo.popleft().result())
+        while en_vuelo:
+            yield completar(en_vuelo.popleft().result())
+
+
+# --- TRABAJOS EN SEGUNDO PLANO ---
+
+class TrabajoLote():
+    """
+    Procesa una lista en un hilo propio, fuera de la ejecución del script de
+    Streamlit: un rerun o un clic en otro widget no lo corta. La interfaz solo
+    lee su progreso (`progreso`, `filas_desde`) cada tanto.
+
+    `fuente_bloques` es un iterable de (ids, nombres_ref) como el de
+    leer_csv_por_bloques. `detener` es cooperativo: el trabajo termina la fila
+    en curso, guarda lo que faltó y queda "detenido"; `reanudar` sigue desde
+    ahí sin volver a consultar lo ya entregado.
+    """
+    EN_COLA = "en cola"
+    EJECUTANDO = "ejecutando"
+    DETENIDO = "detenido"
+    AGOTADO = "agotado"
+    TERMINADO = "terminado"
+    FALLIDO = "error"
+
+    def __init__(self, fuente_bloques, tokens, cache_dict, modo="Solo Consultar", cache_negativa=None,
+                 estrategia="exacta", total=0):
+        self.id = hashlib.sha256(f"{time.time()}-{id(self)}".encode()).hexdigest()[:8]
+        self.tokens = tokens
+        self.cache_dict = cache_dict
+        self.modo = modo
+        self.cache_negativa = cache_negativa
+        self.estrategia = estrategia
+        self.total = total
+        self.estado = self.EN_COLA
+        self.error = None
+        self.procesados = 0
+        self.resultados = []    # solo se agregan filas: la interfaz lee desde donde quedó
+        self.nombres_ref = {}
+        self._bloques = iter(fuente_bloques)
+        self._faltantes = []    # cédulas de un bloque que quedaron sin procesar
+        self._vistos = set()    # para marcar repetidas entre bloques
+        self._detener = threading.Event()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.consultado = time.monotonic()    # última vez que la interfaz lo pidió
+
+    def iniciar(self):
+        with self._lock:
+            if self.estado == self.EJECUTANDO:
+                return self
+            self.estado = self.EJECUTANDO
+            self._detener.clear()
+            self._hilo = threading.Thread(target=self._ejecutar, daemon=True)
+            self._hilo.start()
+        return self
+
+    def detener(self):
+        """Pide parar; el hilo lo nota en la siguiente fila."""
+        self._detener.set()
+
+    def reanudar(self):
+        if self.estado in (self.DETENIDO, self.AGOTADO):
+            self.iniciar()
+        return self
+
+    @property
+    def activo(self):
+        return self.estado == self.EJECUTANDO
+
+    def progreso(self):
+        return {"id": self.id, "estado": self.estado, "procesados": self.procesados,
+                "total": self.total, "resultados": len(self.resultados), "error": self.error}
+
+    def filas_desde(self, inicio):
+        """Filas nuevas desde la posición `inicio` (para pintar la tabla de a poco)."""
+        return self.resultados[inicio:]
+
+    def _pendientes(self):
+        # Primero lo que quedó del bloque interrumpido, después el resto de la fuente
+        if self._faltantes:
+            faltantes, self._faltantes = self._faltantes, []
+            yield faltantes, {}
+        # Sin `yield from`: al cortar este generador la fuente no debe cerrarse
+        for bloque in self._bloques:
+            yield bloque
+
+    def _ejecutar(self):
+        estado = self.TERMINADO
+        try:
+            for ids, nombres_bloque in self._pendientes():
+                self.nombres_ref.update(nombres_bloque)
+                restantes = Counter(ids)
+                entregadas = set()
+                agotadas = []
+                errores = []
+                filas = iterar_lista(ids, self.tokens, self.cache_dict, self.nombres_ref, self.modo,
+                                     cache_negativa=self.cache_negativa, estrategia=self.estrategia,
+                                     incluir_fallidos=True, vistos=self._vistos)
+                try:
+                    for fila in filas:
+                        restantes[fila["Cédula"]] -= 1
+                        if fila["Fuente"] == "Agotado":
+                            agotadas.append(fila["Cédula"])
+                        elif fila["Fuente"] == "Error":
+                            # Ya quedó en la cola de reintentos; al reanudar se vuelve a intentar
+                            errores.append(fila["Cédula"])
+                        else:
+                            if fila["Fuente"] != "Repetida":
+                                entregadas.add(fila["Cédula"])
+                            self.resultados.append(fila)
+                        self.procesados += 1
+                        if self._detener.is_set():
+                            break
+                finally:
+                    # Cierra el motor del bloque: nada sigue gastando cupo
+                    filas.close()
+                if self._detener.is_set() or agotadas:
+                    self._faltantes = agotadas + errores + list((+restantes).elements())
+                    # Las que no llegaron a entregarse se vuelven a ver como nuevas al reanudar
+                    self._vistos.difference_update(c for c in self._faltantes if c not in entregadas)
+                    self.procesados -= len(agotadas) + len(errores)
+                    estado = self.AGOTADO if agotadas else self.DETENIDO
+                    break
+        except Exception as e:
+            self.error = str(e)
+            estado = self.FALLIDO
+        with self._lock:
+            self.estado = estado
+
+
+_TRABAJOS = {}
+_TRABAJOS_LOCK = threading.Lock()
+
+
+def _depurar_trabajos(ahora):
+    # Con _TRABAJOS_LOCK tomado. Nunca se olvida uno que está corriendo
+    for trabajo_id, trabajo in list(_TRABAJOS.items()):
+        if (trabajo.estado in (TrabajoLote.TERMINADO, TrabajoLote.FALLIDO)
+                and ahora - trabajo.consultado > TTL_TRABAJO):
+            del _TRABAJOS[trabajo_id]
+    sobran = len(_TRABAJOS) - MAX_TRABAJOS
+    if sobran > 0:
+        inactivos = sorted((t for t in _TRABAJOS.values() if t.estado != TrabajoLote.EJECUTANDO),
+                           key=lambda t: t.consultado)
+        for trabajo in inactivos[:sobran]:
+            del _TRABAJOS[trabajo.id]
+
+
+def crear_trabajo(*args, **kwargs):
+    """Crea un TrabajoLote y lo registra en el proceso (sobrevive a los reruns)."""
+    trabajo = TrabajoLote(*args, **kwargs)
+    with _TRABAJOS_LOCK:
+        _TRABAJOS[trabajo.id] = trabajo
+        _depurar_trabajos(trabajo.consultado)
+    return trabajo
+
+
+def obtener_trabajo(trabajo_id):
+    """El trabajo registrado (None si no existe o ya se olvidó); cuenta como consulta."""
+    ahora = time.monotonic()
+    with _TRABAJOS_LOCK:
+        _depurar_trabajos(ahora)
+        trabajo = _TRABAJOS.get(trabajo_id)
+        if trabajo is not None:
+            trabajo.consultado = ahora
+        return trabajo
+
+
+def descartar_trabajo(trabajo_id):
+    """Detiene (si corre) y olvida el trabajo."""
+    with _TRABAJOS_LOCK:
+        trabajo = _TRABAJOS.pop(trabajo_id, None)
+    if trabajo is not None:
+        trabajo.detener()